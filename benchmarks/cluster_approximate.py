@@ -0,0 +1,48 @@
+# Usage: python benchmarks/cluster_approximate.py --points 1000000 --sample_size 200000
+# Compares a full HDBSCAN fit against fitting on a sample and predicting the rest (ls-cluster --sample_size)
+import time
+import argparse
+
+from latentscope.scripts.cluster import approximate_hdbscan
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark approximate HDBSCAN against a full fit')
+    parser.add_argument('--points', type=int, help='Number of 2D points', default=500_000)
+    parser.add_argument('--centers', type=int, help='Number of blobs', default=50)
+    parser.add_argument('--sample_size', type=int, nargs='+', help='Sample sizes to try', default=[25_000, 50_000, 100_000])
+    parser.add_argument('--min_cluster_size', type=int, default=500)
+    parser.add_argument('--min_samples', type=int, default=25)
+    parser.add_argument('--skip_full', action='store_true', help='Skip the full fit (no agreement numbers)')
+    args = parser.parse_args()
+
+    import hdbscan
+    from sklearn.datasets import make_blobs
+    from sklearn.metrics import adjusted_rand_score, normalized_mutual_info_score
+
+    points, _ = make_blobs(n_samples=args.points, centers=args.centers, n_features=2, cluster_std=1.0, center_box=(-100, 100), random_state=42)
+
+    full_labels = None
+    full_time = None
+    if not args.skip_full:
+        start = time.perf_counter()
+        full_labels = hdbscan.HDBSCAN(min_cluster_size=args.min_cluster_size, min_samples=args.min_samples).fit(points).labels_
+        full_time = time.perf_counter() - start
+        print(f"full fit: {args.points} points, {full_labels.max() + 1} clusters, {full_time:.2f}s")
+
+    for sample_size in args.sample_size:
+        if sample_size >= args.points:
+            continue
+        start = time.perf_counter()
+        labels = approximate_hdbscan(points, sample_size, args.min_cluster_size, args.min_samples)
+        elapsed = time.perf_counter() - start
+        line = f"sample {sample_size}: {labels.max() + 1} clusters, {elapsed:.2f}s"
+        if full_labels is not None:
+            line += f", speedup {full_time / elapsed:.1f}x"
+            line += f", ARI {adjusted_rand_score(full_labels, labels):.3f}"
+            line += f", NMI {normalized_mutual_info_score(full_labels, labels):.3f}"
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+# Usage: python benchmarks/lexical_search.py --rows 100000 1000000
+# Times building the BM25 index over synthetic text (written to a temporary directory), indexing appended rows
+# and searching it, against the regex scan the column filter does with str.contains
+import os
+import json
+import time
+import argparse
+import tempfile
+
+
+def make_texts(rows, vocabulary=50_000, words=20, seed=42):
+    """Texts of about `words` words drawn from a Zipf-like distribution over a synthetic vocabulary"""
+    import numpy as np
+    rng = np.random.default_rng(seed)
+    terms = np.array([f"w{i}" for i in range(vocabulary)])
+    probabilities = 1 / np.arange(1, vocabulary + 1)
+    probabilities /= probabilities.sum()
+    counts = rng.integers(words // 2, words * 3 // 2, rows)
+    tokens = terms[rng.choice(vocabulary, counts.sum(), p=probabilities)]
+    ends = np.cumsum(counts)
+    return [" ".join(tokens[end - count:end]) for end, count in zip(ends, counts)]
+
+
+def timed(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return sorted(times)[len(times) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark BM25 indexing and search against row count')
+    parser.add_argument('--rows', type=int, nargs='+', help='Dataset sizes to try', default=[100_000, 1_000_000])
+    parser.add_argument('--append', type=float, help='Then append this fraction of rows and update the index', default=0.1)
+    parser.add_argument('--repeat', type=int, help='Median over this many searches', default=5)
+    args = parser.parse_args()
+
+    import pandas as pd
+    from latentscope.util.lexical import LexicalIndex, build_index, index_dir
+
+    queries = {"rare term": "w40000", "common term": "w3", "3 terms": "w3 w200 w40000"}
+    with tempfile.TemporaryDirectory() as directory:
+        for rows in args.rows:
+            dataset_dir = os.path.join(directory, f"dataset-{rows}")
+            os.makedirs(dataset_dir)
+            with open(os.path.join(dataset_dir, "meta.json"), "w") as f:
+                json.dump({"text_column": "text"}, f)
+            texts = make_texts(int(rows * (1 + args.append)))
+            df = pd.DataFrame({"text": texts[:rows]})
+            df.to_parquet(os.path.join(dataset_dir, "input.parquet"))
+
+            meta = build_index(dataset_dir)
+            size = sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(index_dir(dataset_dir)) for f in files)
+            line = f"{rows} rows: indexed in {meta['build_seconds']:.1f}s, {size / 2**20:.0f}MB"
+            line += f" (input.parquet {os.path.getsize(os.path.join(dataset_dir, 'input.parquet')) / 2**20:.0f}MB)"
+
+            pd.DataFrame({"text": texts}).to_parquet(os.path.join(dataset_dir, "input.parquet"))
+            meta = build_index(dataset_dir)
+            line += f", {meta['added']} appended rows indexed in {meta['build_seconds']:.1f}s"
+            print(line)
+
+            index = LexicalIndex.load(dataset_dir)
+            for name, query in queries.items():
+                print(f"  {name}: {timed(lambda: index.search(query, 150), args.repeat) * 1000:.1f}ms"
+                      f", str.contains {timed(lambda: df['text'].str.contains(query.split()[0]), 1) * 1000:.0f}ms")
+            del index
+
+
+if __name__ == "__main__":
+    main()
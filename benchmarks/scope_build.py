@@ -0,0 +1,76 @@
+# Usage: python benchmarks/scope_build.py --rows 100000 1000000 5000000
+# Times ls-scope on synthetic datasets of increasing size (written to a temporary data directory)
+import os
+import json
+import time
+import argparse
+import tempfile
+import contextlib
+
+
+def make_dataset(data_dir, rows, clusters, seed=42):
+    """Write the input, umap, cluster and default label files ls-scope reads"""
+    import numpy as np
+    import pandas as pd
+    from latentscope.util.clusters import group_indices, write_cluster_labels
+    rng = np.random.default_rng(seed)
+    directory = os.path.join(data_dir, "bench")
+    for sub in ["embeddings", "umaps", "clusters", "scopes"]:
+        os.makedirs(os.path.join(directory, sub), exist_ok=True)
+
+    cluster = rng.integers(0, clusters, rows)
+    pd.DataFrame({"text": pd.Series(cluster).map(lambda c: f"item from cluster {c}"), "value": rng.random(rows)}) \
+        .to_parquet(os.path.join(directory, "input.parquet"))
+    pd.DataFrame({"x": rng.random(rows, dtype=np.float32), "y": rng.random(rows, dtype=np.float32)}) \
+        .to_parquet(os.path.join(directory, "umaps", "umap-001.parquet"))
+    pd.DataFrame({"cluster": cluster, "raw_cluster": cluster}) \
+        .to_parquet(os.path.join(directory, "clusters", "cluster-001.parquet"))
+    _, offsets, indices = group_indices(cluster)
+    labels = pd.DataFrame({
+        "label": [f"Cluster {i}" for i in range(clusters)],
+        "description": "",
+        "hull": [indices[offsets[i]:offsets[i] + 3].tolist() for i in range(clusters)],
+    })
+    write_cluster_labels(labels, offsets, indices, os.path.join(directory, "clusters", "cluster-001-labels-default.parquet"))
+    for name, meta in [
+        ("meta.json", {"id": "bench", "length": rows, "text_column": "text"}),
+        ("embeddings/embedding-001.json", {"id": "embedding-001"}),
+        ("umaps/umap-001.json", {"id": "umap-001", "embedding_id": "embedding-001"}),
+        ("clusters/cluster-001.json", {"id": "cluster-001", "umap_id": "umap-001"}),
+    ]:
+        with open(os.path.join(directory, name), "w") as f:
+            json.dump(meta, f)
+    return directory
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark scope assembly against row count')
+    parser.add_argument('--rows', type=int, nargs='+', help='Dataset sizes to try', default=[100_000, 1_000_000])
+    parser.add_argument('--clusters', type=int, help='Number of clusters', default=500)
+    parser.add_argument('--legacy_max_rows', type=int, help='Also time the old per-row label lookup up to this many rows', default=1_000_000)
+    args = parser.parse_args()
+
+    import pandas as pd
+    from latentscope.scripts.scope import scope
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        os.environ["LATENT_SCOPE_DATA"] = data_dir
+        for rows in args.rows:
+            directory = make_dataset(data_dir, rows, args.clusters)
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(open(os.devnull, "w")):
+                scope("bench", "embedding-001", "umap-001", "cluster-001", "default", "bench", "", scope_id="scopes-001")
+            elapsed = time.perf_counter() - start
+            line = f"{rows} rows: scope built in {elapsed:.2f}s"
+
+            if rows <= args.legacy_max_rows:
+                cluster_df = pd.read_parquet(os.path.join(directory, "clusters", "cluster-001.parquet"))
+                cluster_labels_df = pd.read_parquet(os.path.join(directory, "clusters", "cluster-001-labels-default.parquet"))
+                start = time.perf_counter()
+                cluster_df["cluster"].apply(lambda x: cluster_labels_df.loc[x]["label"])
+                line += f", old per-row label lookup alone {time.perf_counter() - start:.2f}s"
+            print(line)
+
+
+if __name__ == "__main__":
+    main()
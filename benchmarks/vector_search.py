@@ -0,0 +1,111 @@
+# Usage: python benchmarks/vector_search.py --rows 100000 1000000 5000000 --dimensions 384
+# Times exact cosine search over synthetic embeddings (written to a temporary directory)
+# and with --index ivf binary also builds the approximate indexes and reports their latency and recall,
+# --filter 0.001 0.1 also times searches restricted to random subsets of that fraction of the rows
+import os
+import time
+import argparse
+import tempfile
+
+
+def make_embeddings(path, rows, dimensions, clusters=1000, seed=42, block_size=500_000):
+    """Write clustered random embeddings to an .h5 file in the layout ls-embed produces"""
+    import h5py
+    import numpy as np
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dimensions)).astype(np.float32)
+    with h5py.File(path, "w") as f:
+        dataset = f.create_dataset("embeddings", shape=(rows, dimensions), dtype=np.float32)
+        for start in range(0, rows, block_size):
+            n = min(block_size, rows - start)
+            dataset[start:start + n] = centers[rng.integers(0, clusters, n)] + rng.standard_normal((n, dimensions), dtype=np.float32)
+    return centers
+
+
+def timed(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return sorted(times)[len(times) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark exact cosine search against row count')
+    parser.add_argument('--rows', type=int, nargs='+', help='Dataset sizes to try', default=[100_000, 1_000_000])
+    parser.add_argument('--dimensions', type=int, help='Embedding dimensions', default=384)
+    parser.add_argument('--k', type=int, help='Number of neighbors', default=150)
+    parser.add_argument('--batch', type=int, help='Number of queries in a batched search', default=32)
+    parser.add_argument('--repeat', type=int, help='Median over this many searches', default=5)
+    parser.add_argument('--index', type=str, nargs='*', choices=['ivf', 'binary'], help='Also build and time these approximate index types', default=[])
+    parser.add_argument('--filter', type=float, nargs='*', help='Also time searches restricted to this fraction of the rows', default=[])
+    parser.add_argument('--legacy_max_rows', type=int, help='Also time sklearn NearestNeighbors up to this many rows', default=1_000_000)
+    args = parser.parse_args()
+
+    import numpy as np
+    import shutil
+    from latentscope.util.vectors import ExactIndex, normalized_file, build_index, load_index, index_dir, recall
+
+    with tempfile.TemporaryDirectory() as directory:
+        for rows in args.rows:
+            path = os.path.join(directory, f"embedding-{rows}.h5")
+            centers = make_embeddings(path, rows, args.dimensions)
+            rng = np.random.default_rng(0)
+            queries = centers[rng.integers(0, len(centers), args.batch)] + rng.standard_normal((args.batch, args.dimensions), dtype=np.float32)
+
+            start = time.perf_counter()
+            index = ExactIndex.from_embedding(path)
+            line = f"{rows} rows: normalized in {time.perf_counter() - start:.2f}s"
+            index.search(queries[0], args.k)
+            line += f", 1 query {timed(lambda: index.search(queries[0], args.k), args.repeat) * 1000:.1f}ms"
+            line += f", {args.batch} queries {timed(lambda: index.search(queries, args.k), args.repeat) * 1000:.1f}ms"
+
+            if rows <= args.legacy_max_rows:
+                import h5py
+                from sklearn.neighbors import NearestNeighbors
+                start = time.perf_counter()
+                with h5py.File(path, "r") as f:
+                    embeddings = np.array(f["embeddings"])
+                nne = NearestNeighbors(n_neighbors=args.k, metric="cosine").fit(embeddings)
+                line += f", sklearn load+fit {time.perf_counter() - start:.2f}s"
+                line += f" 1 query {timed(lambda: nne.kneighbors(queries[:1]), args.repeat) * 1000:.1f}ms"
+                _, expected = nne.kneighbors(queries[:1])
+                found, _ = index.search(queries[0], args.k)
+                line += f" (same neighbors: {len(np.intersect1d(expected, found)) / args.k:.0%})"
+                del embeddings, nne
+            print(line)
+            masks = {fraction: rng.random(rows) < fraction for fraction in args.filter}
+            for fraction, mask in masks.items():
+                found, _ = index.search(queries[0], args.k, mask=mask)
+                print(f"  {fraction:.1%} of rows: 1 query {timed(lambda: index.search(queries[0], args.k, mask=mask), args.repeat) * 1000:.1f}ms"
+                      f", {np.sum(found >= 0)} results")
+
+            for index_type in args.index:
+                import contextlib
+                with contextlib.redirect_stdout(open(os.devnull, "w")):
+                    meta = build_index(path, index_type, k=args.k)
+                approximate = load_index(path)
+                if index_type == "ivf":
+                    setting = f"{meta['nlist']} partitions probing {meta['nprobe']}"
+                else:
+                    setting = f"{approximate.codes.nbytes / 2**20:.0f}MB of codes for {index.vectors.nbytes / 2**20:.0f}MB of vectors, re-ranking {meta['candidates']}"
+                unfiltered = timed(lambda: approximate.search(queries[0], args.k), args.repeat)
+                print(f"  {index_type}: built in {meta['build_seconds']:.1f}s, {setting}"
+                      f", 1 query {unfiltered * 1000:.1f}ms"
+                      f", {args.batch} queries {timed(lambda: approximate.search(queries, args.k), args.repeat) * 1000:.1f}ms"
+                      f", recall@{args.k} {meta['recall']:.3f} at build, {recall(approximate, index, queries, args.k):.3f} on the benchmark queries")
+                for fraction, mask in masks.items():
+                    # filtered IVF searches probe more partitions, up to sqrt(nlist/nprobe) times as many
+                    filtered = timed(lambda: approximate.search(queries[0], args.k, mask=mask), args.repeat)
+                    print(f"    {fraction:.1%} of rows: 1 query {filtered * 1000:.1f}ms ({filtered / unfiltered:.1f}x unfiltered)"
+                          f", recall@{args.k} {recall(approximate, index, queries, args.k, mask=mask):.3f}")
+                del approximate
+                shutil.rmtree(index_dir(path))
+            del index
+            os.remove(normalized_file(path))
+            os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -6,7 +6,8 @@ from .scripts.embed import import_embeddings
 from .scripts.umapper import umapper as umap
 from .scripts.cluster import clusterer as cluster
 from .scripts.label_clusters import labeler as label
-from .scripts.scope import scope
+from .scripts.scope import scope, export_scope, undo_scope, replay_scope, checkpoint_scope
+from .util.scopes import ScopeView
 
 from .server import serve
 
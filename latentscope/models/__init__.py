@@ -7,6 +7,7 @@ from .providers.togetherai import TogetherAIEmbedProvider
 from .providers.voyageai import VoyageAIEmbedProvider
 from .providers.ollama import OllamaEmbedProvider, OllamaChatProvider
 from .providers.nltk import NLTKChatProvider
+from .providers.ctfidf import CTFIDFChatProvider
 
 # We use a universal id system for models where its:
 # <provider>-<model-name> with model-name replacing "/"" with "___"
@@ -95,6 +96,8 @@ def get_chat_model(id):
         return MistralAIChatProvider(model['name'], model['params'])
     if model['provider'] == "nltk":
         return NLTKChatProvider(model['name'], model['params'])
+    if model['provider'] == "ctfidf":
+        return CTFIDFChatProvider(model['name'], model['params'])
     if model['provider'] == "ollama":
         return OllamaChatProvider(model['name'], model['params'])
     
@@ -1,3 +1,9 @@
+import re
+
+def extract_list_items(content):
+    """Return the items of a prompt built from <ListItem>...</ListItem> tags"""
+    return re.findall(r"<\s*ListItem\s*>(.*?)<\s*/\s*ListItem\s*>", content, re.DOTALL)
+
 class EmbedModelProvider:
     def __init__(self, name, params):
         self.name = name
@@ -10,6 +16,13 @@ class EmbedModelProvider:
         raise NotImplementedError("This method should be implemented by subclasses.")
 
 class ChatModelProvider:
+    # True if chat_batch runs all prompts through the model in one batched call
+    batched_generation = False
+    # optional ResponseCache used by the chat methods of each provider
+    response_cache = None
+    # True if label_clusters labels every cluster at once from the raw texts instead of prompting per cluster
+    labels_corpus = False
+
     def __init__(self, name, params):
         self.name = name
         self.params = params
@@ -20,3 +33,8 @@ class ChatModelProvider:
     def chat(self, messages):
         raise NotImplementedError("This method should be implemented by subclasses.")
 
+    def chat_batch(self, messages_list):
+        return [self.chat(messages) for messages in messages_list]
+
+    def label_clusters(self, texts, offsets, indices):
+        raise NotImplementedError("Only providers with labels_corpus = True label all clusters at once.")
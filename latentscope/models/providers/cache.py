@@ -0,0 +1,125 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import functools
+import threading
+
+
+class ResponseCache:
+    """
+    Persistent cache of chat responses stored in a sqlite file.
+    Entries are keyed by a hash of the provider, model name, params and messages
+    and the least recently used entries are evicted once the cache grows past max_bytes.
+    """
+    def __init__(self, path, max_bytes=512 * 1024 * 1024):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT, size INTEGER, accessed REAL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        self.conn.commit()
+        self.size = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    @staticmethod
+    def key(model, messages, *args, **kwargs):
+        payload = json.dumps({
+            "provider": type(model).__name__,
+            "name": model.name,
+            "params": model.params,
+            "sampling": getattr(model, "sampling", None),
+            "messages": messages,
+            "args": args,
+            "kwargs": kwargs,
+        }, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            row = self.conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (time.time(), key))
+            self.conn.commit()
+            return row[0]
+
+    def put(self, key, response):
+        if not isinstance(response, str):
+            return
+        size = len(response.encode("utf-8"))
+        with self.lock:
+            previous = self.conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self.conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)", (key, response, size, time.time()))
+            self.size += size - (previous[0] if previous else 0)
+            if self.size > self.max_bytes:
+                self.evict()
+            self.conn.commit()
+
+    def evict(self):
+        # drop the least recently used entries until we are back under 90% of the limit
+        target = self.max_bytes * 0.9
+        rows = self.conn.execute("SELECT key, size FROM responses ORDER BY accessed").fetchall()
+        evicted = []
+        for key, size in rows:
+            if self.size <= target:
+                break
+            evicted.append((key,))
+            self.size -= size
+        self.conn.executemany("DELETE FROM responses WHERE key = ?", evicted)
+
+    def stats(self):
+        total = self.hits + self.misses
+        hit_rate = self.hits / total if total else 0
+        return f"{self.hits} hits, {self.misses} misses ({hit_rate:.0%} hit rate)"
+
+
+def response_cache(model):
+    """
+    The model's response cache, or None when it shouldn't be used: a model that samples its responses
+    would have its first random sample returned forever, defeating reruns
+    """
+    if (getattr(model, "sampling", None) or {}).get("do_sample"):
+        return None
+    return getattr(model, "response_cache", None)
+
+
+def cached_chat(chat):
+    """Decorate a provider's chat method to go through its response_cache when one is set"""
+    @functools.wraps(chat)
+    def wrapper(self, messages, *args, **kwargs):
+        cache = response_cache(self)
+        if cache is None:
+            return chat(self, messages, *args, **kwargs)
+        key = cache.key(self, messages, *args, **kwargs)
+        response = cache.get(key)
+        if response is None:
+            response = chat(self, messages, *args, **kwargs)
+            cache.put(key, response)
+        return response
+    return wrapper
+
+
+def cached_chat_batch(chat_batch):
+    """Decorate a provider's chat_batch method so only the uncached prompts are sent to the model"""
+    @functools.wraps(chat_batch)
+    def wrapper(self, messages_list, *args, **kwargs):
+        cache = response_cache(self)
+        if cache is None:
+            return chat_batch(self, messages_list, *args, **kwargs)
+        keys = [cache.key(self, messages, *args, **kwargs) for messages in messages_list]
+        responses = [cache.get(key) for key in keys]
+        missing = [i for i, response in enumerate(responses) if response is None]
+        if missing:
+            generated = chat_batch(self, [messages_list[i] for i in missing], *args, **kwargs)
+            for i, response in zip(missing, generated):
+                cache.put(keys[i], response)
+                responses[i] = response
+        return responses
+    return wrapper
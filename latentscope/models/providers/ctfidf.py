@@ -0,0 +1,86 @@
+from .base import ChatModelProvider, extract_list_items
+
+class CTFIDFChatProvider(ChatModelProvider):
+    """
+    Keyword labeler using class-based TF-IDF: each cluster is treated as a single document
+    and labeled with the words that are frequent in it but rare across the other clusters.
+    All clusters are scored at once with sparse matrices, no LLM or network needed.
+    """
+    labels_corpus = True
+
+    def load_model(self):
+        import re
+        from sklearn.feature_extraction.text import CountVectorizer
+        # words of at least two letters, digits and underscores are not useful in a label
+        self.vectorizer = CountVectorizer(stop_words="english", token_pattern=r"(?u)\b[^\W\d_]{2,}\b")
+        self.vocabulary = None
+        self.idf = None
+
+        class Encoder():
+            def encode(self, text):
+                return re.findall(r"\w+|[^\w\s]", text)
+            def decode(self, tokens):
+                return " ".join(tokens)
+
+        self.encoder = Encoder()
+
+    def top_words(self, scores, vocabulary):
+        """Return a label made of the highest scoring words in each row of a sparse score matrix"""
+        import numpy as np
+        top = self.params.get("top_words", 3)
+        scores = scores.tocsr()
+        scores.eliminate_zeros()
+        rows = np.repeat(np.arange(scores.shape[0]), np.diff(scores.indptr))
+        # sort every row by descending score in one pass and keep the first few entries of each
+        order = np.lexsort((-scores.data, rows))
+        rank = np.arange(len(order)) - scores.indptr[rows[order]]
+        keep = order[rank < top]
+        words = vocabulary[scores.indices[keep]]
+        ends = np.searchsorted(rows[keep], np.arange(scores.shape[0] + 1))
+        return [" ".join(words[ends[i]:ends[i+1]]) for i in range(scores.shape[0])]
+
+    def label_clusters(self, texts, offsets, indices):
+        """
+        Label every cluster from the texts of all rows and the (offsets, flat indices) of each cluster.
+        Returns one label per cluster.
+        """
+        import numpy as np
+        from scipy.sparse import csr_matrix, diags
+        texts = ["" if text is None else str(text) for text in texts]
+        try:
+            counts = self.vectorizer.fit_transform(texts)
+        except ValueError:
+            # nothing but stopwords
+            return [""] * (len(offsets) - 1)
+        self.vocabulary = self.vectorizer.get_feature_names_out()
+        offsets = np.asarray(offsets)
+        indices = np.asarray(indices)
+        # the (offsets, indices) pair is already the CSR layout of the cluster membership matrix
+        membership = csr_matrix((np.ones(len(indices), dtype=counts.dtype), indices, offsets), shape=(len(offsets) - 1, len(texts)))
+        class_counts = membership @ counts
+        # c-TF-IDF: term frequency within each cluster weighted by log(1 + average words per cluster / term frequency overall)
+        words_per_class = np.asarray(class_counts.sum(axis=1)).ravel()
+        term_counts = np.asarray(class_counts.sum(axis=0)).ravel()
+        self.idf = np.log(1 + words_per_class.mean() / np.maximum(term_counts, 1))
+        tf = diags(1 / np.maximum(words_per_class, 1)) @ class_counts
+        return self.top_words(tf @ diags(self.idf), self.vocabulary)
+
+    # not cached: this is local and cheap, and the answer depends on the corpus last fit by label_clusters
+    def chat(self, messages):
+        # a single prompt only has one cluster to go on, so unless the corpus was already scored
+        # by label_clusters this falls back to the most frequent words
+        from scipy.sparse import csr_matrix, diags
+        items = extract_list_items(messages[-1]["content"])
+        if self.idf is None:
+            try:
+                counts = self.vectorizer.fit_transform(items)
+            except ValueError:
+                # nothing but stopwords
+                return ""
+            vocabulary = self.vectorizer.get_feature_names_out()
+            scores = csr_matrix(counts.sum(axis=0))
+        else:
+            counts = self.vectorizer.transform(items)
+            vocabulary = self.vocabulary
+            scores = csr_matrix(counts.sum(axis=0)) @ diags(self.idf)
+        return self.top_words(scores, vocabulary)[0]
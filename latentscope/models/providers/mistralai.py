@@ -1,6 +1,7 @@
 import os
 import time
 from .base import EmbedModelProvider,ChatModelProvider
+from .cache import cached_chat
 
 from latentscope.util import get_key
 
@@ -41,6 +42,7 @@ class MistralAIChatProvider(ChatModelProvider):
         self.client = MistralClient(api_key=api_key)
         self.encoder = AutoTokenizer.from_pretrained(encoders[self.name])
 
+    @cached_chat
     def chat(self, messages):
         instances = [self.ChatMessage(content=message["content"], role=message["role"]) for message in messages]
         response = self.client.chat(
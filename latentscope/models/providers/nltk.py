@@ -1,13 +1,20 @@
-from .base import ChatModelProvider
+from .base import ChatModelProvider, extract_list_items
+from .cache import cached_chat
 
 class NLTKChatProvider(ChatModelProvider):
     def load_model(self):
         from collections import Counter
+        import nltk
+        # only download the corpora we don't already have
+        for resource, path in [("punkt", "tokenizers/punkt"), ("stopwords", "corpora/stopwords")]:
+            try:
+                nltk.data.find(path)
+            except LookupError:
+                nltk.download(resource)
         from nltk.corpus import stopwords
-        self.Counter = Counter
-        self.stopwords = stopwords
         from nltk.tokenize import word_tokenize
-        import nltk
+        self.Counter = Counter
+        self.stopwords = set(stopwords.words('english'))
 
         class Encoder():
             def encode(self, text):
@@ -16,23 +23,17 @@ class NLTKChatProvider(ChatModelProvider):
             def decode(self, tokens):
                 return " ".join(tokens)
 
-        nltk.download('punkt')
-        nltk.download('stopwords')
         self.encoder = Encoder()
 
+    @cached_chat
     def chat(self, messages):
         # TODO: this is kind of hacky, since we aren't really using a chat model
-        # We are slicing off the first 86 characters because it contains the prompt for LLMs
-        text = messages[1]["content"][86:]
-        text = text.replace("<ListItem>", "")
-        text = text.replace("< ListItem >", "")
-        text = text.replace("</ListItem>", "")
-        text = text.replace("</ ListItem >", "")
+        # We only count the words inside the <ListItem> tags, the rest of the message is the prompt for LLMs
+        text = "\n".join(extract_list_items(messages[-1]["content"]))
         tokens = self.encoder.encode(text)
         # Remove stopwords
-        tokens = [word for word in tokens if word.isalpha() and word.lower() not in self.stopwords.words('english')]
+        tokens = [word for word in tokens if word.isalpha() and word.lower() not in self.stopwords]
         # Get the top 3 words
         top_words = [word for word, count in self.Counter(tokens).most_common(self.params["top_words"])]
         label = " ".join(top_words)
         return label
-
@@ -1,6 +1,7 @@
 import os
 import time
 from .base import EmbedModelProvider, ChatModelProvider
+from .cache import cached_chat
 
 import os
 import time
@@ -36,6 +37,7 @@ class OllamaChatProvider(ChatModelProvider):
         import tiktoken
         self.encoder = tiktoken.get_encoding("cl100k_base")
 
+    @cached_chat
     def chat(self, messages):
         response = self.client.chat(
             model=self.name,
@@ -1,6 +1,7 @@
 import os
 import time
 from .base import EmbedModelProvider, ChatModelProvider
+from .cache import cached_chat
 
 from latentscope.util import get_key
 
@@ -49,6 +50,7 @@ class OpenAIChatProvider(ChatModelProvider):
         self.encoder = tiktoken.encoding_for_model(self.name)
 
 
+    @cached_chat
     def chat(self, messages):
         response = self.client.chat.completions.create(
             model=self.name,
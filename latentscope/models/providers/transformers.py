@@ -1,4 +1,5 @@
 from .base import EmbedModelProvider, ChatModelProvider
+from .cache import cached_chat, cached_chat_batch
 
 class TransformersEmbedProvider(EmbedModelProvider):
     def __init__(self, name, params):
@@ -68,6 +69,10 @@ class TransformersEmbedProvider(EmbedModelProvider):
 
 
 class TransformersChatProvider(ChatModelProvider):
+    batched_generation = True
+    # generation settings, the response cache is skipped while do_sample is on
+    sampling = {"do_sample": True, "temperature": 0.7, "top_k": 50, "top_p": 0.95}
+
     def __init__(self, name, params):
         super().__init__(name, params)
         import torch
@@ -81,11 +86,26 @@ class TransformersChatProvider(ChatModelProvider):
         self.pipe = self.pipeline("text-generation", model=self.name, torch_dtype=self.torch.float16, device=self.device, trust_remote_code=True)
         self.encoder = self.pipe.tokenizer
 
+    @cached_chat
     def chat(self, messages, max_new_tokens=24):
         prompt = self.pipe.tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
-        outputs = self.pipe(prompt, max_new_tokens=max_new_tokens, do_sample=True, temperature=0.7, top_k=50, top_p=0.95)
+        outputs = self.pipe(prompt, max_new_tokens=max_new_tokens, **self.sampling)
         generated_text = outputs[0]["generated_text"]
         print("GENERATED TEXT", generated_text)
+        return self.response_text(generated_text)
+
+    @cached_chat_batch
+    def chat_batch(self, messages_list, max_new_tokens=24):
+        tokenizer = self.pipe.tokenizer
+        # batched generation with a decoder-only model needs left padding and a pad token
+        tokenizer.padding_side = "left"
+        if tokenizer.pad_token_id is None:
+            tokenizer.pad_token_id = tokenizer.eos_token_id
+        prompts = [tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True) for messages in messages_list]
+        outputs = self.pipe(prompts, batch_size=len(prompts), max_new_tokens=max_new_tokens, **self.sampling)
+        return [self.response_text(output[0]["generated_text"]) for output in outputs]
+
+    def response_text(self, generated_text):
         if "<|start_header_id|>assistant<|end_header_id|>" in generated_text:
             generated_text = generated_text.split("<|start_header_id|>assistant<|end_header_id|>")[1].strip()
         elif "<|assistant|>" in generated_text:
@@ -17,6 +17,8 @@ except ImportError as e:
     from tqdm import tqdm
 
 from latentscope.util import get_data_dir
+from latentscope.util.clusters import group_indices, to_list_array
+from latentscope.util.hulls import cluster_hulls
 
 # TODO move this into shared space
 def calculate_point_size(num_points, min_size=10, max_size=30, base_num_points=100):
@@ -30,6 +32,88 @@ def calculate_point_size(num_points, min_size=10, max_size=30, base_num_points=1
     else:
         return min(min_size + min_size * np.log(num_points / base_num_points), max_size)
 
+def extract_clusters(single_linkage_tree, min_cluster_size, cluster_selection_epsilon=0.0):
+    """
+    Extract flat HDBSCAN cluster labels from a previously computed single linkage tree.
+    This is what HDBSCAN.fit does after building the tree, so it gives the same labels without refitting.
+    Relies on hdbscan's private _hdbscan_tree module, raises ImportError if this version of hdbscan doesn't have it.
+    """
+    from hdbscan._hdbscan_tree import condense_tree, compute_stability, get_clusters
+    condensed_tree = condense_tree(single_linkage_tree, min_cluster_size)
+    stability = compute_stability(condensed_tree)
+    labels, _, _ = get_clusters(condensed_tree, stability, cluster_selection_epsilon=cluster_selection_epsilon)
+    return labels
+
+
+def approximate_hdbscan(points, sample_size, min_cluster_size, min_samples, cluster_selection_epsilon=0.0, block_size=100_000, seed=42):
+    """
+    Fit HDBSCAN on a random sample of the points and assign the remaining points with approximate_predict.
+    min_cluster_size and min_samples are scaled down with the sample so the same clusters stay above the size
+    threshold and core distances cover about the same neighborhoods.
+    Prediction runs over blocks of points one after the other: approximate_predict loops in Python and holds
+    the GIL, so a thread pool doesn't speed it up.
+    """
+    import hdbscan
+    import numpy as np
+    n = points.shape[0]
+    if sample_size <= 0:
+        raise ValueError(f"sample_size must be positive, got {sample_size}")
+    fraction = sample_size / n
+    rng = np.random.default_rng(seed)
+    in_sample = np.zeros(n, dtype=bool)
+    in_sample[rng.choice(n, size=sample_size, replace=False)] = True
+
+    clusterer = hdbscan.HDBSCAN(
+        min_cluster_size=max(2, int(round(min_cluster_size * fraction))),
+        min_samples=max(1, int(round(min_samples * fraction))),
+        metric='euclidean',
+        cluster_selection_epsilon=cluster_selection_epsilon,
+        prediction_data=True
+    )
+    clusterer.fit(points[in_sample])
+
+    labels = np.empty(n, dtype=np.int64)
+    labels[in_sample] = clusterer.labels_
+    rest = np.flatnonzero(~in_sample)
+    for start in range(0, len(rest), block_size):
+        block = rest[start:start + block_size]
+        labels[block], _ = hdbscan.approximate_predict(clusterer, points[block])
+    return labels
+
+
+def cluster_centroids(embeddings, labels, cluster_ids):
+    """
+    Compute the mean point of each cluster in cluster_ids with a single grouped reduction.
+    Points whose label is not in cluster_ids (i.e. noise) are ignored.
+    """
+    import numpy as np
+    positions = np.searchsorted(cluster_ids, labels)
+    positions = np.clip(positions, 0, len(cluster_ids) - 1)
+    member = cluster_ids[positions] == labels
+    positions = positions[member]
+    points = embeddings[member]
+    counts = np.bincount(positions, minlength=len(cluster_ids)).astype(np.float64)
+    sums = np.column_stack([
+        np.bincount(positions, weights=points[:, d], minlength=len(cluster_ids))
+        for d in range(embeddings.shape[1])
+    ])
+    return sums / counts[:, None]
+
+
+def nearest_centroids(points, centroids, block_size=100_000):
+    """
+    Return the index of the closest centroid for each point.
+    Uses a KD-tree over the centroids and queries in blocks so memory stays O(N).
+    """
+    import numpy as np
+    from scipy.spatial import cKDTree
+    tree = cKDTree(centroids)
+    closest = np.empty(points.shape[0], dtype=np.int64)
+    for start in range(0, points.shape[0], block_size):
+        _, idx = tree.query(points[start:start + block_size], k=1)
+        closest[start:start + block_size] = idx
+    return closest
+
 
 def main():
     parser = argparse.ArgumentParser(description='Cluster UMAP embeddings')
@@ -39,12 +123,14 @@ def main():
     parser.add_argument('min_samples', type=int, help='Minimum samples for HDBSCAN')
     parser.add_argument('cluster_selection_epsilon', type=float, help='Cluster selection Epsilon', default=0)
     parser.add_argument('column', type=str, nargs='?', help='Use column as cluster labels', default=None)
+    parser.add_argument('--max_hull_vertices', type=int, help='Simplify cluster hulls to at most this many vertices', default=None)
+    parser.add_argument('--sample_size', type=int, help='Fit HDBSCAN on a random sample of this many points and predict the rest', default=None)
     
     args = parser.parse_args()
-    clusterer(args.dataset_id, args.umap_id, args.samples, args.min_samples, args.cluster_selection_epsilon, args.column)
+    clusterer(args.dataset_id, args.umap_id, args.samples, args.min_samples, args.cluster_selection_epsilon, args.column, args.max_hull_vertices, args.sample_size)
 
 
-def clusterer(dataset_id, umap_id, samples, min_samples, cluster_selection_epsilon, column):
+def clusterer(dataset_id, umap_id, samples, min_samples, cluster_selection_epsilon, column, max_hull_vertices=None, sample_size=None):
     DATA_DIR = get_data_dir()
     cluster_dir = os.path.join(DATA_DIR, dataset_id, "clusters")
     # Check if clusters directory exists, if not, create it
@@ -67,45 +153,65 @@ def clusterer(dataset_id, umap_id, samples, min_samples, cluster_selection_epsil
     import hdbscan
     import numpy as np
     import pandas as pd
+    import pyarrow as pa
+    import pyarrow.parquet as pq
     import matplotlib.pyplot as plt
-    from scipy.spatial import ConvexHull
-    from scipy.spatial.distance import cdist
 
     umap_embeddings_df = pd.read_parquet(os.path.join(DATA_DIR, dataset_id, "umaps", f"{umap_id}.parquet"))
     umap_embeddings = umap_embeddings_df.to_numpy()
 
+    reused_tree = False
+    predicted_fraction = 0
     if column is not None:
         input_df = pd.read_parquet(os.path.join(DATA_DIR, dataset_id, f"input.parquet"))
         # use the column as the cluster labels
         cluster_labels = input_df[column].to_numpy()
+    elif sample_size is not None and sample_size < umap_embeddings.shape[0]:
+        # Fit on a random subsample and predict the rest, for projections too large to fit directly
+        print("fitting HDBSCAN on a sample of", sample_size, "points")
+        cluster_labels = approximate_hdbscan(umap_embeddings, sample_size, samples, min_samples, cluster_selection_epsilon)
+        predicted_fraction = 1 - sample_size / umap_embeddings.shape[0]
+        print("fraction of points assigned by prediction:", predicted_fraction)
     else:
-        clusterer = hdbscan.HDBSCAN(min_cluster_size=samples, min_samples=min_samples, metric='euclidean', cluster_selection_epsilon=cluster_selection_epsilon)
-        clusterer.fit(umap_embeddings)
-        # Get the cluster labels
-        cluster_labels = clusterer.labels_
+        # The expensive part of HDBSCAN (core distances, MST and single linkage tree) only depends on
+        # the points and min_samples, so we keep the tree next to the umap and reuse it when only
+        # min_cluster_size or cluster_selection_epsilon change
+        tree_file = os.path.join(DATA_DIR, dataset_id, "umaps", f"{umap_id}-hdbscan-{min_samples}.npy")
+        single_linkage_tree = np.load(tree_file) if os.path.exists(tree_file) else None
+        if single_linkage_tree is not None and single_linkage_tree.shape[0] == umap_embeddings.shape[0] - 1:
+            try:
+                cluster_labels = extract_clusters(single_linkage_tree, samples, cluster_selection_epsilon)
+                reused_tree = True
+                print("reused single linkage tree", tree_file)
+            except ImportError as e:
+                print("could not reuse the single linkage tree, refitting:", e)
+        if not reused_tree:
+            clusterer = hdbscan.HDBSCAN(min_cluster_size=samples, min_samples=min_samples, metric='euclidean', cluster_selection_epsilon=cluster_selection_epsilon)
+            clusterer.fit(umap_embeddings)
+            # Get the cluster labels
+            cluster_labels = clusterer.labels_
+            np.save(tree_file, clusterer.single_linkage_tree_.to_numpy())
+            print("saved single linkage tree", tree_file)
     # copy cluster labels to another array
     raw_cluster_labels = cluster_labels.copy()
 
     # Determine points with no assigned cluster
     unique_labels = np.unique(cluster_labels)
     non_noise_labels = unique_labels[unique_labels != -1]
-    centroids = [umap_embeddings[cluster_labels == label].mean(axis=0) for label in non_noise_labels]
+    noise_mask = cluster_labels == -1
+    n_noise = int(noise_mask.sum())
 
     # TODO: look into soft clustering
     # https://hdbscan.readthedocs.io/en/latest/soft_clustering.html
     # Assign noise points to the closest cluster centroid
-    noise_points = umap_embeddings[cluster_labels == -1]
-    if(non_noise_labels.shape[0] > 0):
-      closest_centroid_indices = np.argmin(cdist(noise_points, centroids), axis=1)
-
-      # Update cluster_labels with the new assignments for noise points
-      noise_indices = np.where(cluster_labels == -1)[0]
-      new_assignments = [non_noise_labels[index] for index in closest_centroid_indices]
-      cluster_labels[noise_indices] = new_assignments
+    if non_noise_labels.shape[0] > 0 and n_noise > 0:
+        centroids = cluster_centroids(umap_embeddings, cluster_labels, non_noise_labels)
+        closest_centroid_indices = nearest_centroids(umap_embeddings[noise_mask], centroids)
+        # Update cluster_labels with the new assignments for noise points
+        cluster_labels[noise_mask] = non_noise_labels[closest_centroid_indices]
 
-    
     print("n_clusters:", len(non_noise_labels))
-    print("noise points assigned to clusters:", len(noise_points))
+    print("noise points assigned to clusters:", n_noise)
 
     # save umap embeddings to a parquet file with columns x,y
     df = pd.DataFrame({"cluster": cluster_labels, "raw_cluster": raw_cluster_labels})
@@ -119,17 +225,18 @@ def clusterer(dataset_id, umap_id, samples, min_samples, cluster_selection_epsil
     point_size = calculate_point_size(umap_embeddings.shape[0])
     print("POINT SIZE", point_size, "for", umap_embeddings.shape[0], "points")
     plt.scatter(umap_embeddings[:, 0], umap_embeddings[:, 1], s=point_size, alpha=0.5, c=cluster_labels, cmap='Spectral')
-    # plot a convex hull around each cluster
-    hulls = []
-    for label in non_noise_labels:
-        indices = np.where(cluster_labels == label)[0]
-        points = umap_embeddings[indices]
-        # points = umap_embeddings[cluster_labels == label]
-        hull = ConvexHull(points)
-        hull_list = [indices[s] for s in hull.vertices.tolist()]
-        hulls.append(hull_list)
-        for simplex in hull.simplices:
-            plt.plot(points[simplex, 0], points[simplex, 1], 'k-')
+    # group the row indices of each cluster once, we use it for the hulls and the labels table
+    cluster_ids, offsets, flat_indices = group_indices(cluster_labels)
+
+    # compute the convex hull around each cluster in parallel and plot it
+    hulls = cluster_hulls(umap_embeddings, offsets, flat_indices, max_vertices=max_hull_vertices)
+    for i, label in enumerate(cluster_ids):
+        if label == -1:
+            hulls[i] = []
+        if len(hulls[i]) == 0:
+            continue
+        outline = umap_embeddings[hulls[i] + hulls[i][:1]]
+        plt.plot(outline[:, 0], outline[:, 1], 'k-')
 
     plt.axis('off')  # remove axis
     plt.gca().set_position([0, 0, 1, 1])  # remove margins
@@ -143,24 +250,27 @@ def clusterer(dataset_id, umap_id, samples, min_samples, cluster_selection_epsil
             "min_samples": min_samples,
             "cluster_selection_epsilon": cluster_selection_epsilon,
             "n_clusters": len(non_noise_labels),
-            "n_noise": len(noise_points)
+            "n_noise": n_noise,
+            "reused_tree": reused_tree,
+            "max_hull_vertices": max_hull_vertices,
+            "sample_size": sample_size,
+            "predicted_fraction": predicted_fraction
         }, f, indent=2)
     f.close()
 
     # create the data structure for labeling clusters
-    # get the indices of each item in a cluster
-    cluster_indices = df.groupby('cluster').groups
-
-    # iterate over the clusters and create a row for each in a new dataframe with a label, description and array of indicies
-    slides_df = pd.DataFrame(columns=['label', 'description', 'indices'])
-    for cluster, indices in tqdm(cluster_indices.items()):
-        label = f"Cluster {cluster}"
-        description = f"This is cluster {cluster} with {len(indices)} items."
-        new_row = pd.DataFrame({'label': [label], 'description': [description], 'indices': [list(indices)], 'hull': [hulls[cluster]]})
-        slides_df = pd.concat([slides_df, new_row], ignore_index=True)
-
-    # write the df to parquet
-    slides_df.to_parquet(os.path.join(cluster_dir, f"{cluster_id}-labels-default.parquet"))
+    # one row per cluster with a label, description, the indices of its items and its hull
+    # the indices are written as an arrow list array straight from the grouped offsets
+    counts = np.diff(offsets)
+    slides_table = pa.table({
+        "label": [f"Cluster {cluster}" for cluster in cluster_ids],
+        "description": [f"This is cluster {cluster} with {count} items." for cluster, count in zip(cluster_ids, counts)],
+        "indices": to_list_array(offsets, flat_indices),
+        "hull": pa.array(hulls, type=pa.list_(pa.int64())),
+    })
+
+    # write the table to parquet
+    pq.write_table(slides_table, os.path.join(cluster_dir, f"{cluster_id}-labels-default.parquet"))
     print("done with", cluster_id)
 
 if __name__ == "__main__":
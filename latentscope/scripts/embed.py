@@ -19,6 +19,7 @@ except ImportError as e:
 
 from latentscope.models import get_embedding_model, TransformersEmbedProvider
 from latentscope.util import get_data_dir
+from latentscope.util.vectors import write_normalized
 
 def chunked_iterable(iterable, size):
     """Yield successive chunks from an iterable."""
@@ -57,10 +58,13 @@ def main():
     parser.add_argument('--rerun', type=str, help='Rerun the given embedding from last completed batch')
     parser.add_argument('--batch_size', type=int, help='Set the batch size (number of sentences to embed in one call)', default=100)
     parser.add_argument('--max_seq_length', type=int, help='Set the max sequence length for the model', default=None)
+    parser.add_argument('--index', action='store_true', help='Also build the approximate nearest neighbor search index (see ls-embed-index)')
 
     # Parse arguments
     args = parser.parse_args()
-    embed(args.dataset_id, args.text_column, args.model_id, args.prefix, args.rerun, args.dimensions, args.batch_size, args.max_seq_length)
+    embedding_id = embed(args.dataset_id, args.text_column, args.model_id, args.prefix, args.rerun, args.dimensions, args.batch_size, args.max_seq_length)
+    if args.index:
+        embed_index(args.dataset_id, embedding_id)
 
 def embed(dataset_id, text_column, model_id, prefix, rerun, dimensions, batch_size=100, max_seq_length=None):
     import pandas as pd
@@ -168,7 +172,47 @@ def embed(dataset_id, text_column, model_id, prefix, rerun, dimensions, batch_si
 
 
     # np.save(os.path.join(embedding_dir, f"{embedding_id}.npy"), np_embeds)
+    # normalize for search now rather than in the first search request
+    write_normalized(os.path.join(embedding_dir, f"{embedding_id}.h5"))
     print("done with", embedding_id)
+    return embedding_id
+
+def index():
+    parser = argparse.ArgumentParser(description='Build the approximate nearest neighbor index used to search an embedding')
+    parser.add_argument('dataset_id', type=str, help='Dataset id (directory name in data/)')
+    parser.add_argument('embedding_id', type=str, help='ID of embedding to index')
+    parser.add_argument('--type', type=str, choices=['ivf', 'binary'], help='ivf: partitioned full vectors, binary: 1 bit per dimension codes re-ranked from disk (32x less memory)', default='ivf')
+    parser.add_argument('--nlist', type=int, help='Number of partitions of an ivf index (default 2 * sqrt(rows))', default=None)
+    parser.add_argument('--target_recall', type=float, help='Tune the search until recall@150 against exact search reaches this', default=0.95)
+    args = parser.parse_args()
+    embed_index(args.dataset_id, args.embedding_id, args.type, args.nlist, args.target_recall)
+
+def embed_index(dataset_id, embedding_id, type="ivf", nlist=None, target_recall=0.95):
+    from latentscope.util.vectors import build_index, index_dir
+    DATA_DIR = get_data_dir()
+    embedding_dir = os.path.join(DATA_DIR, dataset_id, "embeddings")
+    embedding_path = os.path.join(embedding_dir, f"{embedding_id}.h5")
+
+    print("RUNNING:", embedding_id)
+    if type == "ivf":
+        meta = build_index(embedding_path, type, target_recall=target_recall, nlist=nlist)
+    else:
+        meta = build_index(embedding_path, type, target_recall=target_recall)
+
+    # keep a summary with the embedding metadata so it shows up with the embedding
+    metadata_path = os.path.join(embedding_dir, f"{embedding_id}.json")
+    with open(metadata_path, 'r') as f:
+        metadata = json.load(f)
+    metadata['search_index'] = {key: meta[key] for key in ["type", "nlist", "nprobe", "candidates", "k", "recall"] if key in meta}
+    with open(metadata_path, 'w') as f:
+        json.dump(metadata, f, indent=2)
+
+    print(f"built {type} index of {meta['rows']} rows in {meta['build_seconds']:.1f}s")
+    if type == "ivf":
+        print(f"searching {meta['nprobe']} of {meta['nlist']} partitions, recall@{meta['k']} {meta['recall']:.3f}")
+    else:
+        print(f"re-ranking {meta['candidates']} candidates, recall@{meta['k']} {meta['recall']:.3f}")
+    print("wrote", index_dir(embedding_path))
 
 def truncate():
     parser = argparse.ArgumentParser(description='Make a copy of an existing embedding truncated to a smaller number of dimensions')
@@ -241,6 +285,7 @@ def embed_truncate(dataset_id, embedding_id, dimensions):
             "max_values": max_values.tolist(),
             }, f, indent=2)
 
+    write_normalized(os.path.join(embedding_dir, f"{new_embedding_id}.h5"))
     print("wrote", os.path.join(embedding_dir, f"{new_embedding_id}.h5"))
     print("done")
 
@@ -370,6 +415,7 @@ def import_embeddings(dataset_id, embeddings, model_id="", text_column="", prefi
             "min_values": min_values.tolist(),
             "max_values": max_values.tolist(),
         }, f, indent=2)
+    write_normalized(os.path.join(embedding_dir, f"{embedding_id}.h5"))
     print("done with", embedding_id)
 
 if __name__ == "__main__":
@@ -3,6 +3,7 @@ import re
 import json
 import argparse
 from latentscope.util import get_data_dir
+from latentscope.util.scopes import read_scope
 from latentscope import __version__
 
 
@@ -73,7 +74,7 @@ def dmp(dataset_id, scope_id, plot_config=None):
 
     print("loaded dataset and scope")
     # load the actual labels and save everything but the indices in a dict
-    scope_parquet = pd.read_parquet(
+    scope_parquet = read_scope(
         os.path.join(DATA_DIR, dataset_id, "scopes", scope_id + ".parquet")
     )
     print("loaded scope parquet", scope_parquet.columns)
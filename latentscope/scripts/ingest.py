@@ -134,7 +134,8 @@ def ingest(dataset_id, df, text_column = None):
             column_metadata[column]["extent"] = extent.tolist()
 
     output_file = f"{directory}/input.parquet"
-    df.to_parquet(output_file)
+    # small row groups let the server read a page of rows without decoding the whole file
+    df.to_parquet(output_file, row_group_size=65536)
     print("wrote", output_file)
 
     # write out a json file with the model name and shape of the embeddings
@@ -170,6 +171,30 @@ def ingest(dataset_id, df, text_column = None):
             with open(file_path, 'w') as file:
                 file.write('')  # Initialize with an empty JSON object
 
+    # the input was (re)written, so index its text from scratch
+    if text_column is not None:
+        ingest_index(dataset_id, text_column, rebuild=True)
+
+
+def index():
+    parser = argparse.ArgumentParser(description='Build or update the full text (BM25) search index of a dataset')
+    parser.add_argument('id', type=str, help='Dataset id (directory name in data folder)')
+    parser.add_argument('--text_column', type=str, help='Column to index, defaults to the text_column of the dataset')
+    parser.add_argument('--rebuild', action='store_true', help='Index every row again rather than just the rows added since the last run')
+    args = parser.parse_args()
+    ingest_index(args.id, args.text_column, args.rebuild)
+
+def ingest_index(dataset_id, text_column=None, rebuild=False):
+    from latentscope.util.lexical import build_index, index_dir
+    DATA_DIR = get_data_dir()
+    directory = os.path.join(DATA_DIR, dataset_id)
+    meta = build_index(directory, text_column, rebuild=rebuild)
+    if not meta["added"]:
+        print(f"lexical index of {meta['text_column']} is up to date with {meta['rows']} rows")
+        return
+    print(f"indexed {meta['added']} rows of {meta['text_column']} in {meta['build_seconds']:.1f}s, {len(meta['segments'])} segments")
+    print("wrote", index_dir(directory))
+
 
 if __name__ == "__main__":
     main()
@@ -5,6 +5,7 @@ import sys
 import json
 import time
 import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 try:
     # Check if the runtime environment is a Jupyter notebook
@@ -17,7 +18,10 @@ except ImportError as e:
     from tqdm import tqdm
 
 from latentscope.util import get_data_dir
+from latentscope.util.clusters import read_cluster_labels, read_cluster_indices, write_cluster_labels
+from latentscope.util.ratelimit import TokenBucket, retry_with_backoff
 from latentscope.models import get_chat_model
+from latentscope.models.providers.cache import ResponseCache
 
 def chunked_iterable(iterable, size):
     """Yield successive chunks from an iterable."""
@@ -33,6 +37,114 @@ def too_many_duplicates(line, threshold=100):
         word_count[word] = word_count.get(word, 0) + 1
     return any(count > threshold for count in word_count.values())
 
+def representative_items(indices, points, max_items=200, nearest_fraction=0.5, seed=42):
+    """
+    Pick at most max_items of a cluster's rows to represent it.
+    The rows closest to the cluster's centroid come first, followed by a sample stratified
+    by distance from the centroid so the outskirts of the cluster are represented too.
+    """
+    import numpy as np
+    cluster_points = points[indices]
+    distances = ((cluster_points - cluster_points.mean(axis=0)) ** 2).sum(axis=1)
+    order = np.argsort(distances)
+    if len(order) <= max_items:
+        return indices[order]
+    n_nearest = int(max_items * nearest_fraction)
+    nearest = order[:n_nearest]
+    rest = order[n_nearest:]
+    # one random pick from each of n_strata equally sized bins of the remaining rows
+    n_strata = max_items - n_nearest
+    edges = np.linspace(0, len(rest), n_strata + 1).astype(np.int64)
+    rng = np.random.default_rng(seed)
+    picks = edges[:-1] + (rng.random(n_strata) * (edges[1:] - edges[:-1])).astype(np.int64)
+    return indices[np.concatenate([nearest, rest[picks]])]
+
+def build_extract(items, enc, max_tokens):
+    """
+    Join items into a list for the prompt, counting tokens per item and stopping once the budget is used.
+    Duplicates and items with too many repeated words are skipped.
+    """
+    lines = []
+    seen = set()
+    used = 0
+    for t in items:
+        if t in seen or too_many_duplicates(t):
+            continue
+        seen.add(t)
+        line = f"<ListItem>{t}</ListItem>"
+        n_tokens = len(enc.encode(line)) + 1 # +1 for the newline
+        if used + n_tokens > max_tokens:
+            if not lines:
+                # a single item larger than the budget gets truncated
+                lines.append(enc.decode(enc.encode(line)[:max_tokens]))
+            break
+        lines.append(line)
+        used += n_tokens
+    return '\n'.join(lines)
+
+def append_progress(progress_file, rows):
+    """Append labeled clusters to the progress log, one JSON object per line"""
+    with open(progress_file, 'a') as f:
+        for row in rows:
+            f.write(json.dumps(row) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+def replay_progress(clusters, progress_file):
+    """Apply the labels recorded in a progress log to the clusters dataframe, returns how many were applied"""
+    if not os.path.exists(progress_file):
+        return 0
+    rows = []
+    with open(progress_file) as f:
+        for line in f:
+            try:
+                rows.append(json.loads(line))
+            except json.JSONDecodeError:
+                # a partially written last line from an interrupted run
+                continue
+    if not rows:
+        return 0
+    index = [row["cluster"] for row in rows]
+    clusters.loc[index, 'label'] = [row["label"] for row in rows]
+    clusters.loc[index, 'label_raw'] = [row["label_raw"] for row in rows]
+    clusters.loc[index, 'labeled'] = True
+    return len(rows)
+
+def compact_progress(clusters, offsets, cluster_indices, labels_file, progress_file):
+    """Write the labels parquet with all progress applied and remove the progress log"""
+    tmp_file = labels_file + ".tmp"
+    write_cluster_labels(clusters, offsets, cluster_indices, tmp_file)
+    os.replace(tmp_file, labels_file)
+    if os.path.exists(progress_file):
+        os.remove(progress_file)
+
+def parse_batch_labels(response, batch):
+    """
+    Parse the JSON object returned for a packed prompt into a dict of cluster index to raw label.
+    Ids that are missing or can't be parsed are left out.
+    """
+    start = response.find("{")
+    end = response.rfind("}")
+    if start < 0 or end < start:
+        return {}
+    try:
+        parsed = json.loads(response[start:end + 1])
+    except json.JSONDecodeError:
+        return {}
+    if not isinstance(parsed, dict):
+        return {}
+    return {i: str(parsed[str(i)]) for i in batch if parsed.get(str(i))}
+
+def clean_up_label(label):
+    """Clean up labels when the model doesn't follow instructions"""
+    clean_label = label.replace("\n", " ")
+    clean_label = clean_label.replace('"', '')
+    clean_label = clean_label.replace("'", '')
+    # clean_label = clean_label.replace("-", '')
+    clean_label = ' '.join(clean_label.split())
+    clean_label = " ".join(clean_label.split(" ")[0:5])
+    return clean_label
+
 def main():
     parser = argparse.ArgumentParser(description='Label a set of slides using OpenAI')
     parser.add_argument('dataset_id', type=str, help='Dataset ID (directory name in data/)')
@@ -41,34 +153,43 @@ def main():
     parser.add_argument('model_id', type=str, help='ID of model to use', default="openai-gpt-3.5-turbo")
     parser.add_argument('context', type=str, help='Additional context for labeling model', default="")
     parser.add_argument('--rerun', type=str, help='Rerun the given embedding from last completed batch')
+    parser.add_argument('--concurrency', type=int, help='Number of clusters to label at the same time', default=1)
+    parser.add_argument('--rate_limit', type=float, help='Maximum requests per second to the model', default=None)
+    parser.add_argument('--max_retries', type=int, help='Retries with exponential backoff for a failed request', default=5)
+    parser.add_argument('--max_items', type=int, help='Maximum number of representative items per cluster sent to the model', default=200)
+    parser.add_argument('--batch_size', type=int, help='Number of clusters labeled per request', default=1)
+    parser.add_argument('--no_cache', action='store_true', help='Always ask the model instead of using cached responses')
 
     # Parse arguments
     args = parser.parse_args()
 
-    labeler(args.dataset_id, args.text_column, args.cluster_id, args.model_id, args.context, args.rerun)
+    labeler(args.dataset_id, args.text_column, args.cluster_id, args.model_id, args.context, args.rerun, args.concurrency, args.rate_limit, args.max_retries, args.max_items, args.batch_size, not args.no_cache)
 
 
-def labeler(dataset_id, text_column="text", cluster_id="cluster-001", model_id="openai-gpt-3.5-turbo", context="", rerun=""):
+def labeler(dataset_id, text_column="text", cluster_id="cluster-001", model_id="openai-gpt-3.5-turbo", context="", rerun=None, concurrency=1, rate_limit=None, max_retries=5, max_items=200, batch_size=1, use_cache=True):
     import numpy as np
     import pandas as pd
     DATA_DIR = get_data_dir()
-    df = pd.read_parquet(os.path.join(DATA_DIR, dataset_id, "input.parquet"))
+    df = pd.read_parquet(os.path.join(DATA_DIR, dataset_id, "input.parquet"), columns=[text_column])
 
     # Load the indices for each cluster from the prepopulated labels file generated by cluster.py
     cluster_dir = os.path.join(DATA_DIR, dataset_id, "clusters")
-    clusters = pd.read_parquet(os.path.join(cluster_dir, f"{cluster_id}-labels-default.parquet"))
+    # the indices of each cluster are kept in compact (offsets, flat indices) form
+    clusters_file = os.path.join(cluster_dir, f"{cluster_id}-labels-default.parquet")
+    clusters = read_cluster_labels(clusters_file)
+    offsets, cluster_indices = read_cluster_indices(clusters_file)
     # initialize the labeled property to false when loading default clusters
-    clusters = clusters.copy()
     clusters['labeled'] = False
 
-    unlabeled_row = 0
     if rerun is not None:
         label_id = rerun
-        clusters = pd.read_parquet(os.path.join(cluster_dir, f"{label_id}.parquet"))
-        # print(clusters.columns)
-        # find the first row where labeled isnt True
-        unlabeled_row = clusters[~clusters['labeled']].first_valid_index()
-        tqdm.write(f"First unlabeled row: {unlabeled_row}")
+        clusters_file = os.path.join(cluster_dir, f"{label_id}.parquet")
+        clusters = read_cluster_labels(clusters_file)
+        offsets, cluster_indices = read_cluster_indices(clusters_file)
+        # apply the labels that were logged but not yet compacted into the parquet
+        replayed = replay_progress(clusters, os.path.join(cluster_dir, f"{label_id}-progress.jsonl"))
+        tqdm.write(f"Replayed {replayed} labels from progress log")
+        tqdm.write(f"Unlabeled rows: {int((~clusters['labeled']).sum())}")
         
 
     else:
@@ -85,6 +206,9 @@ def labeler(dataset_id, text_column="text", cluster_id="cluster-001", model_id="
 
     model = get_chat_model(model_id)
     model.load_model()
+    if use_cache:
+        # identical prompts to the same model are answered from a persistent cache in the data directory
+        model.response_cache = ResponseCache(os.path.join(DATA_DIR, "cache", "chat_responses.sqlite"))
     # Set max_tokens to either model.params["max_tokens"] or model.params["num_ctx"] depending on which is defined
     max_tokens = model.params.get("max_tokens", model.params.get("num_ctx", 512))
     enc = model.encoder
@@ -99,80 +223,143 @@ The user will submit a list of items in the format:
 You should choose a label that best summarizes the theme of the list so that someone browsing the labels will have a good idea of what is in the list. 
 Do not use punctuation, Do not explain yourself, respond with only a few words that summarize the list."""}
 
+    # When packing several clusters into one request we ask for a JSON object with one label per list
+    batch_system_prompt = {"role":"system", "content": system_prompt["content"] + """
+Several lists may be submitted at once, each wrapped in <List id="...">...</List>.
+In that case respond with only a JSON object mapping each list id to its label, e.g. {"3": "first label", "7": "second label"}."""}
+    # models that can generate for several prompts in one call get one normal prompt per cluster instead
+    pack_clusters = batch_size > 1 and not model.batched_generation
+
     # TODO: why the extra 50 for openai?
-    max_tokens = max_tokens - len(enc.encode(system_prompt["content"])) - 50
-
-    # Create the lists of items we will send for summarization
-    # Current looks like:
-    # 1. item 1
-    # 2. item 2
-    # ...
-    # we truncate the list based on tokens and we also remove items that have too many duplicate words
-    extracts = []
-    for i, row in tqdm(clusters.iterrows(), total=clusters.shape[0], desc="Preparing extracts"):
-        indices = row['indices']
-        items = df.loc[list(indices), text_column]
-        items = items.drop_duplicates()
-        # text = '\n'.join([f"{i+1}. {t}" for i, t in enumerate(items) if not too_many_duplicates(t)])
-        text = '\n'.join([f"<ListItem>{t}</ListItem>" for i, t in enumerate(items) if not too_many_duplicates(t)])
-        encoded_text = enc.encode(text)
-        print(encoded_text)
-        print(enc.decode(encoded_text))
-        if len(encoded_text) > max_tokens:
-            encoded_text = encoded_text[:max_tokens]
-        extract = enc.decode(encoded_text)
-        extracts.append(extract)
-    # TODO we arent really batching these
-    batch_size = 1
+    if pack_clusters:
+        # the token budget is shared by all the lists in a request
+        max_tokens = (max_tokens - len(enc.encode(batch_system_prompt["content"])) - 50) // batch_size
+    else:
+        max_tokens = max_tokens - len(enc.encode(system_prompt["content"])) - 50
+
+    labels_file = os.path.join(cluster_dir, f"{label_id}.parquet")
+    # progress is appended to a log after every batch and only compacted into the parquet at the end
+    progress_file = os.path.join(cluster_dir, f"{label_id}-progress.jsonl")
+    if rerun is None:
+        # write the unlabeled clusters right away so a failed run can always be rerun
+        write_cluster_labels(clusters, offsets, cluster_indices, labels_file)
+
     labels = []
-    clean_labels = []
+    failed = []
+    if model.labels_corpus:
+        # keyword models score every cluster against the whole corpus in one pass, no prompts needed
+        start_time = time.time()
+        pending = np.flatnonzero(~clusters['labeled'].to_numpy(dtype=bool))
+        raw_labels = model.label_clusters(df[text_column].to_numpy(), offsets, cluster_indices)
+        labels = [raw_labels[i] for i in pending]
+        clusters.loc[pending, 'label'] = [clean_up_label(label) for label in labels]
+        clusters.loc[pending, 'label_raw'] = labels
+        clusters.loc[pending, 'labeled'] = True
+    else:
+        # Create the lists of items we will send for summarization
+        # Current looks like:
+        # <ListItem>item 1</ListItem>
+        # <ListItem>item 2</ListItem>
+        # ...
+        # Each list is built from a bounded set of representative items (closest to the cluster's centroid
+        # in the UMAP plus a stratified sample of the rest) and filled up to the token budget
+        with open(os.path.join(cluster_dir, f"{cluster_id}.json")) as f:
+            umap_id = json.load(f)["umap_id"]
+        points = pd.read_parquet(os.path.join(DATA_DIR, dataset_id, "umaps", f"{umap_id}.parquet"), columns=["x", "y"]).to_numpy()
+        texts = df[text_column].to_numpy()
 
+        def prepare_extract(i):
+            indices = cluster_indices[offsets[i]:offsets[i+1]]
+            items = texts[representative_items(indices, points, max_items)]
+            return build_extract(items, enc, max_tokens)
 
-    for i,batch in enumerate(tqdm(chunked_iterable(extracts, batch_size),  total=len(extracts)//batch_size)):
-        # tqdm.write(batch[0])
-        if(unlabeled_row > 0):
-            if clusters.loc[i, 'labeled']:
-                tqdm.write(f"skipping {i} already labeled {clusters.loc[i, 'label']}")
-                time.sleep(0.01)
-                continue
+        with ThreadPoolExecutor() as pool:
+            extracts = list(tqdm(pool.map(prepare_extract, range(clusters.shape[0])), total=clusters.shape[0], desc="Preparing extracts"))
+
+        # Label the clusters concurrently, each request goes through the rate limiter and is retried with backoff
+        limiter = TokenBucket(rate_limit)
+
+        def on_retry(attempt, e, delay):
+            tqdm.write(f"retrying after error ({e}), attempt {attempt + 1}/{max_retries} in {delay:.1f}s")
+
+        def request(fn):
+            def attempt():
+                limiter.acquire()
+                return fn()
+            return retry_with_backoff(attempt, max_retries=max_retries, on_retry=on_retry)
+
+        def cluster_messages(i):
+            return [
+                system_prompt, {"role":"user", "content": "Here is a list of items, please summarize the list into a label using only a few words:\n" + extracts[i]}
+            ]
 
-        try:
-            time.sleep(0.01)
-            messages=[
-                system_prompt, {"role":"user", "content": "Here is a list of items, please summarize the list into a label using only a few words:\n" + batch[0]} # TODO hardcoded batch size
+        def label_batch(batch):
+            """Label a batch of clusters, returns a dict of cluster index to raw label"""
+            if len(batch) == 1:
+                return {batch[0]: request(lambda: model.chat(cluster_messages(batch[0])))}
+            if not pack_clusters:
+                # one batched generate call with a prompt per cluster
+                raw_labels = request(lambda: model.chat_batch([cluster_messages(i) for i in batch]))
+                return dict(zip(batch, raw_labels))
+            lists = "\n".join([f'<List id="{i}">\n{extracts[i]}\n</List>' for i in batch])
+            messages = [
+                batch_system_prompt, {"role":"user", "content": "Here are several lists of items, please summarize each list into a label using only a few words:\n" + lists}
             ]
-            label = model.chat(messages)
-            labels.append(label)
-            
-            # do some cleanup of the labels when the model doesn't follow instructions
-            clean_label = label.replace("\n", " ")
-            clean_label = clean_label.replace('"', '')
-            clean_label = clean_label.replace("'", '')
-            # clean_label = clean_label.replace("-", '')
-            clean_label = ' '.join(clean_label.split())
-            clean_label = " ".join(clean_label.split(" ")[0:5])
-            clean_labels.append(clean_label)
-            if re.search(r"please provide", label, re.IGNORECASE):
-                tqdm.write(f"cluster {i} label: {clean_label}")
-                tqdm.write(f"batch: {batch[0]}")
-                tqdm.write(f"label: {label}")
-            
-            tqdm.write(f"cluster {i} label: {clean_label}")
-            clusters.loc[i, 'label'] = clean_label
-            clusters.loc[i, 'label_raw'] = label
-            clusters.loc[i, 'labeled'] = True
-            # length = len(clean_labels) - 1
-            # clusters_df.loc[unlabled_row:unlabled_row+length, 'label'] = clean_labels
-            # clusters_df.loc[unlabled_row:unlabled_row+length, 'label_raw'] = labels
-            # clusters_df.loc[unlabled_row:unlabled_row+length, 'labeled'] = [True for i in range(0, len(labels))]
-            clusters.to_parquet(os.path.join(cluster_dir, f"{label_id}.parquet"))
-            # update 
-
-        except Exception as e: 
-            tqdm.write(f"{batch[0]}")
-            tqdm.write(f"ERROR: {e}")
-            tqdm.write("exiting")
-            exit(1)
+            raw_labels = parse_batch_labels(request(lambda: model.chat(messages)), batch)
+            # anything the model skipped or we couldn't parse gets labeled on its own
+            for i in batch:
+                if i not in raw_labels:
+                    raw_labels[i] = request(lambda: model.chat(cluster_messages(i)))
+            return raw_labels
+
+        pending = [i for i in range(len(extracts)) if not clusters.loc[i, 'labeled']]
+        if len(pending) < len(extracts):
+            tqdm.write(f"skipping {len(extracts) - len(pending)} already labeled clusters")
+        start_time = time.time()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            futures = {pool.submit(label_batch, batch): batch for batch in chunked_iterable(pending, batch_size)}
+            progress = tqdm(total=len(pending))
+            for future in as_completed(futures):
+                batch = futures[future]
+                progress.update(len(batch))
+                try:
+                    raw_labels = future.result()
+                except Exception as e:
+                    tqdm.write(f"ERROR labeling clusters {batch}: {e}")
+                    failed.extend(batch)
+                    continue
+
+                progress_rows = []
+                for i, label in raw_labels.items():
+                    labels.append(label)
+                    clean_label = clean_up_label(label)
+                    if re.search(r"please provide", label, re.IGNORECASE):
+                        tqdm.write(f"batch: {extracts[i]}")
+                        tqdm.write(f"label: {label}")
+
+                    tqdm.write(f"cluster {i} label: {clean_label}")
+                    clusters.loc[i, 'label'] = clean_label
+                    clusters.loc[i, 'label_raw'] = label
+                    clusters.loc[i, 'labeled'] = True
+                    progress_rows.append({"cluster": int(i), "label": clean_label, "label_raw": label})
+                # checkpoint after every batch so a partial failure keeps the finished labels
+                append_progress(progress_file, progress_rows)
+            progress.close()
+
+    # materialize the labels parquet once and drop the log it now contains
+    compact_progress(clusters, offsets, cluster_indices, labels_file, progress_file)
+
+    elapsed = time.time() - start_time
+    clusters_per_minute = len(labels) / elapsed * 60 if elapsed > 0 else 0
+    tqdm.write(f"labeled {len(labels)} clusters in {elapsed:.1f}s ({clusters_per_minute:.1f} clusters/minute)")
+    if model.response_cache is not None:
+        tqdm.write(f"response cache: {model.response_cache.stats()}")
+
+    if failed:
+        tqdm.write(f"{len(failed)} clusters failed to label: {sorted(failed)}")
+        tqdm.write(f"rerun with --rerun {label_id} to label the remaining clusters")
+        tqdm.write("exiting")
+        sys.exit(1)
 
     print("labels:", len(labels))
     # add lables to slides df
@@ -187,6 +374,11 @@ Do not use punctuation, Do not explain yourself, respond with only a few words t
             "context": context,
             "system_prompt": system_prompt,
             "max_tokens": max_tokens,
+            "concurrency": concurrency,
+            "rate_limit": rate_limit,
+            "max_items": max_items,
+            "batch_size": batch_size,
+            "clusters_per_minute": clusters_per_minute,
         }, f, indent=2)
     f.close()
     print("done with", label_id)
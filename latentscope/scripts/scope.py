@@ -4,6 +4,8 @@ import json
 import argparse
 from datetime import datetime
 from latentscope.util import get_data_dir
+from latentscope.util.scopes import ScopeView, edits_file, build_scope_table
+from latentscope.util import transactions
 from latentscope import __version__
 
 
@@ -17,11 +19,36 @@ def main():
     parser.add_argument('label', type=str, help='Label for the scope')
     parser.add_argument('description', type=str, help='Description of the scope')
     parser.add_argument('--scope_id', type=str, help='Scope id to overwrite existing scope', default=None)
+    parser.add_argument('--export', action='store_true', help='Also write the input joined with the scope to <scope_id>-input.parquet')
 
     args = parser.parse_args()
     scope(**vars(args))
 
-def scope(dataset_id, embedding_id, umap_id, cluster_id, cluster_labels_id, label, description, scope_id=None):
+def export_scope(dataset_id, scope_id, path=None):
+    """Materialize the input joined with the scope columns, by default to scopes/<scope_id>-input.parquet"""
+    DATA_DIR = get_data_dir()
+    if path is None:
+        path = os.path.join(DATA_DIR, dataset_id, "scopes", scope_id + "-input.parquet")
+    ScopeView(dataset_id, scope_id, DATA_DIR).export(path)
+    print("exported scope", scope_id, "to", path)
+    return path
+
+def undo_scope(dataset_id, scope_id, count=1):
+    """Take back the last count edits made to a scope, returns the number of edits undone"""
+    DATA_DIR = get_data_dir()
+    return transactions.undo_scope(os.path.join(DATA_DIR, dataset_id, "scopes", scope_id + ".parquet"), count)
+
+def replay_scope(dataset_id, scope_id, transaction=None):
+    """Return the scope DataFrame and cluster lookup as they were after the given number of logged transactions"""
+    DATA_DIR = get_data_dir()
+    return transactions.replay_scope(os.path.join(DATA_DIR, dataset_id, "scopes", scope_id + ".parquet"), transaction)
+
+def checkpoint_scope(dataset_id, scope_id):
+    """Snapshot the current state of a scope to speed up later undos and replays"""
+    DATA_DIR = get_data_dir()
+    return transactions.checkpoint_scope(os.path.join(DATA_DIR, dataset_id, "scopes", scope_id + ".parquet"))
+
+def scope(dataset_id, embedding_id, umap_id, cluster_id, cluster_labels_id, label, description, scope_id=None, export=False):
     DATA_DIR = get_data_dir()
     print("DATA DIR", DATA_DIR)
     directory = os.path.join(DATA_DIR, dataset_id, "scopes")
@@ -46,7 +73,7 @@ def scope(dataset_id, embedding_id, umap_id, cluster_id, cluster_labels_id, labe
 
     print("RUNNING:", id)
 
-    import pandas as pd
+    import pyarrow.parquet as pq
 
     scope = {
         "ls_version": __version__,
@@ -89,34 +116,17 @@ def scope(dataset_id, embedding_id, umap_id, cluster_id, cluster_labels_id, labe
             cluster_labels = json.load(f)
             scope["cluster_labels"] = cluster_labels
 
-    # load the actual labels and save everything but the indices in a dict
-    cluster_labels_df = pd.read_parquet(os.path.join(DATA_DIR, dataset_id, "clusters", cluster_labels_id + ".parquet"))
-    # remove the indices column
-
-    cluster_labels_df = cluster_labels_df.drop(columns=[col for col in ["indices", "labeled", "label_raw"] if col in cluster_labels_df.columns])
-    # cluster_labels_df = cluster_labels_df.drop(columns=["indices", "labeled", "label_raw"])
-    # change hulls to a list of lists
-    cluster_labels_df["hull"] = cluster_labels_df["hull"].apply(lambda x: x.tolist())
-    cluster_labels_df["cluster"] = cluster_labels_df.index
-    scope["cluster_labels_lookup"] = cluster_labels_df.to_dict(orient="records")
-    
     # create a scope parquet by combining the parquets from umap and cluster, as well as getting the labels from cluster_labels
     # then write the parquet to the scopes directory
-    umap_df = pd.read_parquet(os.path.join(DATA_DIR, dataset_id, "umaps", umap_id + ".parquet"))
-    print("umap columns", umap_df.columns)
-    cluster_df = pd.read_parquet(os.path.join(DATA_DIR, dataset_id, "clusters", cluster_id + ".parquet"))
-    cluster_labels_df = pd.read_parquet(os.path.join(DATA_DIR, dataset_id, "clusters", cluster_labels_id + ".parquet"))
-    # create a column where we lookup the label from cluster_labels_df for the index found in the cluster_df
-    cluster_df["label"] = cluster_df["cluster"].apply(lambda x: cluster_labels_df.loc[x]["label"])
-    print("cluster columns", cluster_df.columns)
-    scope_parquet = pd.concat([umap_df, cluster_df], axis=1)
-    # Add an ls_index column that is the index of each row in the dataframe
-    scope_parquet['ls_index'] = scope_parquet.index
-    print("scope columns", scope_parquet.columns)
-    scope_parquet.to_parquet(os.path.join(directory, id + ".parquet"))
-
-    scope["rows"] = len(scope_parquet)
-    scope["columns"] = scope_parquet.columns.tolist()
+    scope_table, scope["cluster_labels_lookup"] = build_scope_table(os.path.join(DATA_DIR, dataset_id), umap_id, cluster_id, cluster_labels_id)
+    print("scope columns", scope_table.column_names)
+    pq.write_table(scope_table, os.path.join(directory, id + ".parquet"))
+    # edits made to a scope we are overwriting don't apply to the new one
+    if os.path.exists(edits_file(os.path.join(directory, id + ".parquet"))):
+        os.remove(edits_file(os.path.join(directory, id + ".parquet")))
+
+    scope["rows"] = scope_table.num_rows
+    scope["columns"] = scope_table.column_names
     scope["size"] = os.path.getsize(os.path.join(directory, id + ".parquet"))
     scope["timestamp"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     
@@ -124,16 +134,17 @@ def scope(dataset_id, embedding_id, umap_id, cluster_id, cluster_labels_id, labe
     with open(file_path, 'w') as f:
         json.dump(scope, f, indent=2)
     
-    transactions_file_path = os.path.join(directory, id + "-transactions.json")
-    if not os.path.exists(transactions_file_path):
-        with open(transactions_file_path, 'w') as f:
-            json.dump([], f)
+    # edits logged from here on apply to this build of the scope
+    transactions.append_transaction(os.path.join(directory, id + ".parquet"), "create_scope", {
+        "embedding_id": embedding_id,
+        "umap_id": umap_id,
+        "cluster_id": cluster_id,
+        "cluster_labels_id": cluster_labels_id
+    })
     
-    input_df = pd.read_parquet(os.path.join(DATA_DIR, dataset_id, "input.parquet"))
-    input_df.reset_index(inplace=True)
-    input_df = input_df[input_df['index'].isin(scope_parquet['ls_index'])]
-    combined_df = input_df.join(scope_parquet.set_index('ls_index'), on='index', rsuffix='_ls')
-    combined_df.to_parquet(os.path.join(directory, id + "-input.parquet"))
+    # the scope is read together with the input through a ScopeView, a joined copy is only written on request
+    if export:
+        export_scope(dataset_id, id)
 
     print("wrote scope", id)
 
@@ -16,6 +16,8 @@ from flask_cors import CORS
 
 # from latentscope.util import update_data_dir
 from latentscope.util import get_data_dir, get_supported_api_keys
+from latentscope.util.scopes import ScopeView, compact_scope
+from latentscope.util.selection import filter_mask
 
 app = Flask(__name__)
 
@@ -50,6 +52,9 @@ if(not READ_ONLY):
 from .search import search_bp
 app.register_blueprint(search_bp, url_prefix='/api/search') 
 
+from .selection import select_bp
+app.register_blueprint(select_bp, url_prefix='/api/select')
+
 from .tags import tags_bp, tags_write_bp
 app.register_blueprint(tags_bp, url_prefix='/api/tags') 
 if(not READ_ONLY):
@@ -117,6 +122,11 @@ Allow fetching of dataset files directly from disk
 @app.route('/api/files/<path:datasetPath>', methods=['GET'])
 def send_file(datasetPath):
     print("req url", request.url)
+    if re.match(r".*/scopes/[^/]+\.parquet$", datasetPath):
+        # make sure a downloaded scope includes the edits still pending in its overlay
+        scope_file = os.path.join(DATA_DIR, datasetPath)
+        if os.path.exists(scope_file):
+            compact_scope(scope_file)
     return send_from_directory(DATA_DIR, datasetPath)
 
 """
@@ -129,19 +139,26 @@ def indexed():
     indices = data['indices']
     columns = data.get('columns')
     embedding_id = data.get('embedding_id')
+    scope_id = data.get('scope_id')
 
-    if dataset not in DATAFRAMES:
-        df = pd.read_parquet(os.path.join(DATA_DIR, dataset, "input.parquet"))
-        DATAFRAMES[dataset] = df
+    if scope_id:
+        # read the rows joined with their scope columns, skipping rows that aren't in the scope
+        view = ScopeView(dataset, scope_id, DATA_DIR)
+        valid_indices = [i for i, valid in zip(indices, np.isin(indices, view.ls_index())) if valid]
+        rows = view.to_pandas(columns, valid_indices)
     else:
-        df = DATAFRAMES[dataset]
-
-    if columns:
-        df = df[columns]
-    
-    # get the indexed rows, handling missing indices
-    valid_indices = [i for i in indices if i < len(df)]
-    rows = df.iloc[valid_indices]
+        if dataset not in DATAFRAMES:
+            df = pd.read_parquet(os.path.join(DATA_DIR, dataset, "input.parquet"))
+            DATAFRAMES[dataset] = df
+        else:
+            df = DATAFRAMES[dataset]
+
+        if columns:
+            df = df[columns]
+        
+        # get the indexed rows, handling missing indices
+        valid_indices = [i for i in indices if i < len(df)]
+        rows = df.iloc[valid_indices]
     rows['index'] = valid_indices
 
     if embedding_id:
@@ -169,27 +186,14 @@ def column_filter():
         df = DATAFRAMES[dataset]
     
     # apply filters
-    rows = df.copy()
+    mask = np.ones(len(df), dtype=bool)
 
     print("FILTERS", filters)
     if filters:
         for f in filters:
-            if f["type"] == "eq":
-                rows = rows[rows[f['column']] == f['value']]
-            elif f["type"] == "gt":
-                rows = rows[rows[f['column']] > f['value']]
-            elif f["type"] == "lt":
-                rows = rows[rows[f['column']] < f['value']]
-            elif f["type"] == "gte":
-                rows = rows[rows[f['column']] >= f['value']]
-            elif f["type"] == "lte":
-                rows = rows[rows[f['column']] <= f['value']]
-            elif f["type"] == "in":
-                rows = rows[rows[f['column']].isin(f['value'])]
-            elif f["type"] == "contains":
-                rows = rows[rows[f['column']].str.contains(f['value'])]
-
-    return jsonify(indices=rows.index.to_list())
+            mask &= filter_mask(df[f['column']], f['type'], f['value'])
+
+    return jsonify(indices=df.index[mask].to_list())
 
 @app.route('/api/query', methods=['POST'])
 def query():
@@ -201,21 +205,27 @@ def query():
     embedding_id = data['embedding_id'] if 'embedding_id' in data else None
     # filters = data['filters'] if 'filters' in data else None
     sort = data['sort'] if 'sort' in data else None
-    if dataset not in DATAFRAMES:
-        df = pd.read_parquet(os.path.join(DATA_DIR, dataset, "input.parquet"))
-        DATAFRAMES[dataset] = df
+    scope_id = data['scope_id'] if 'scope_id' in data else None
+    if scope_id:
+        # only read the requested rows of the input joined with the scope columns
+        rows = ScopeView(dataset, scope_id, DATA_DIR).to_pandas(indices=indices if len(indices) else None)
+        rows.index = rows['index'].to_numpy()
+        rows['ls_index'] = rows.index
     else:
-        df = DATAFRAMES[dataset]
-    
-    # apply filters
-    rows = df.copy()
-    rows['ls_index'] = rows.index
-    
-
-    # get the indexed rows
-    # print("INDICES", indices)
-    if len(indices):
-        rows = rows.loc[indices]
+        if dataset not in DATAFRAMES:
+            df = pd.read_parquet(os.path.join(DATA_DIR, dataset, "input.parquet"))
+            DATAFRAMES[dataset] = df
+        else:
+            df = DATAFRAMES[dataset]
+        
+        # apply filters
+        rows = df.copy()
+        rows['ls_index'] = rows.index
+        
+
+        # get the indexed rows
+        if len(indices):
+            rows = rows.loc[indices]
 
     if embedding_id:
         embedding_path = os.path.join(DATA_DIR, dataset, "embeddings", f"{embedding_id}.h5")
@@ -278,6 +288,10 @@ def catch_all(path):
     return send_from_directory(directory, pth.name)
 
 def serve(host="0.0.0.0", port=5001, debug=True):
+    from .search import load_search_indexes
+    # in debug mode the reloader's parent process only watches files, the child serves
+    if not debug or os.environ.get("WERKZEUG_RUN_MAIN"):
+        load_search_indexes()
     app.run(host=host, port=port, debug=debug)
 
 if __name__ == "__main__":
@@ -1,35 +1,92 @@
 import os
 import sys
 import json
+import time
+import functools
+import threading
 import numpy as np
 import pandas as pd
-from datetime import datetime
-from scipy.spatial import ConvexHull
 from flask import Blueprint, jsonify, request
+from latentscope.util.transactions import append_transaction, read_transactions, checkpoint_scope, list_checkpoints, prune_checkpoints, undo_scope, read_scope_meta, write_scope_meta
+from latentscope.util.scopes import scope_lock, edits_file, count_edits, append_edit, scope_state, scope_key, compact_scope
 
 # Create a Blueprint
 bulk_bp = Blueprint('bulk_bp', __name__)
 bulk_write_bp = Blueprint('bulk_write_bp', __name__)
 DATA_DIR = os.getenv('LATENT_SCOPE_DATA')
+# number of pending edits in a scope's overlay before it is compacted into the scope parquet in the background
+COMPACT_AFTER_EDITS = 100
+# transactions logged since the last checkpoint before compaction also checkpoints the scope,
+# so undo replays about this many transactions at most instead of rebuilding the scope from its source files
+CHECKPOINT_AFTER_TRANSACTIONS = 100
+# automatic checkpoints kept per scope, older ones are removed
+KEEP_CHECKPOINTS = 5
+
+def scope_path(dataset_id, scope_id):
+  return os.path.join(DATA_DIR, dataset_id, "scopes", scope_id + ".parquet")
 
 def write_transaction(dataset_id, scope_id, action, payload):
-    transactions_file_path = os.path.join(DATA_DIR, dataset_id, "scopes", scope_id + "-transactions.json")
-    if not os.path.exists(transactions_file_path):
-        with open(transactions_file_path, 'w') as f:
-            json.dump([], f)
-    with open(transactions_file_path, 'r') as f:
-        transactions = json.load(f)
-    new_transaction = {
-        "action": action,
-        "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-        "payload": payload
-    }
-    transactions.append(new_transaction)
-    with open(transactions_file_path, 'w') as f:
-        json.dump(transactions, f, indent=2)
+  append_transaction(scope_path(dataset_id, scope_id), action, payload)
+
+def with_scope_lock(handler):
+  """Run a bulk request while holding the lock of the scope it edits, so edits, undos and compaction don't interleave"""
+  @functools.wraps(handler)
+  def wrapper(*args, **kwargs):
+    data = request.get_json(silent=True) or request.args
+    scope_file = scope_path(data["dataset_id"], data["scope_id"])
+    with scope_lock(scope_file):
+      return handler(*args, **kwargs)
+  return wrapper
+
+class Timer:
+  """Collects the seconds spent in each step of a request, reported back with the response"""
+  def __init__(self):
+    self.start = self.last = time.perf_counter()
+    self.laps = {}
+
+  def lap(self, name):
+    now = time.perf_counter()
+    self.laps[name] = round(now - self.last, 4)
+    self.laps.pop("total", None)
+    self.laps["total"] = round(now - self.start, 4)
+    self.last = now
+
+def compact_and_checkpoint(scope_file):
+  """
+  Compact a scope's overlay and checkpoint it when enough transactions were logged since the last checkpoint.
+  Runs in the background from edit_scope: the request that started it holds the scope lock until its transaction
+  is logged, so by the time we get the lock the log and the scope agree.
+  """
+  with scope_lock(scope_file):
+    compact_scope(scope_file)
+    checkpoints = list_checkpoints(scope_file)
+    if len(read_transactions(scope_file)) - (checkpoints[-1] if checkpoints else 0) >= CHECKPOINT_AFTER_TRANSACTIONS:
+      checkpoint_scope(scope_file, auto=True)
+      prune_checkpoints(scope_file, KEEP_CHECKPOINTS)
+
+def edit_scope(dataset_id, scope_id, edit):
+  """
+  Apply an edit to the cached scope state and record it in the scope's overlay.
+  Returns the state along with the clusters whose rows changed.
+  The scope parquet itself is only rewritten by compaction, once enough edits have piled up.
+  """
+  scope_file = scope_path(dataset_id, scope_id)
+  with scope_lock(scope_file):
+    state = scope_state(scope_file)
+    touched = state.apply(edit)
+    append_edit(edits_file(scope_file), edit)
+    # the state already includes the edit we just wrote, no need to reload it
+    state.key = scope_key(scope_file)
+    pending = count_edits(edits_file(scope_file))
+  if pending >= COMPACT_AFTER_EDITS:
+    threading.Thread(target=compact_and_checkpoint, args=(scope_file,)).start()
+  # the joined export is out of date now
+  remove_export(dataset_id, scope_id)
+  return state, touched
 
 # Change the cluster of rows
 @bulk_write_bp.route('/change-cluster', methods=['POST'])
+@with_scope_lock
 def change_cluster():
   data = request.get_json()
   print(data)
@@ -37,134 +94,149 @@ def change_cluster():
   scope_id = data["scope_id"]
   row_ids = data["row_ids"]
   new_cluster = int(data["new_cluster"])
-
-  # read in the scope parquet
-  scope_file = os.path.join(DATA_DIR, dataset_id, "scopes", scope_id + ".parquet")
-  df = pd.read_parquet(scope_file)
+  timing = Timer()
 
   # read the scope metadata for the cluster_label_map
-  scope_meta_file = os.path.join(DATA_DIR, dataset_id, "scopes", scope_id + ".json")
-  with open(scope_meta_file) as f:
-    scope_meta = json.load(f)
-
-
+  scope_meta = read_scope_meta(scope_path(dataset_id, scope_id))
   clusters = scope_meta["cluster_labels_lookup"]
   new_label = clusters[new_cluster]
+
   # change the cluster of the rows
-  df.loc[df['ls_index'].isin(row_ids), "cluster"] = new_cluster
-  df.loc[df['ls_index'].isin(row_ids), "label"] = new_label["label"]
-
-  # write the parquet
-  df.to_parquet(scope_file)
-  update_combined(df, dataset_id, scope_id)
-
-  # recalculate the hulls
-  for c in clusters:
-      indices = df[df['cluster'] == c["cluster"]]["ls_index"].tolist()
-      label_points = df[df['cluster'] == c["cluster"]][['x', 'y']].values
-      if(len(label_points) > 0):
-        hull = ConvexHull(label_points)
-        hull_list = [indices[s] for s in hull.vertices.tolist()]
-        c["hull"] = hull_list
-      else:
-        c["hull"] = []
+  state, touched = edit_scope(dataset_id, scope_id, {
+    "action": "change_cluster",
+    "row_ids": row_ids,
+    "cluster": new_cluster,
+    "label": new_label["label"]
+  })
+  timing.lap("edit")
+
+  # recalculate the hulls of the clusters that lost or gained rows
+  state.update_hulls(clusters, scope_meta.get("cluster", {}).get("max_hull_vertices"), touched)
+  timing.lap("hulls")
 
   #write the scope meta to file
-  with open(scope_meta_file, "w") as f:
-    json.dump(scope_meta, f, indent=2)
+  write_scope_meta(scope_path(dataset_id, scope_id), scope_meta)
 
   write_transaction(dataset_id, scope_id, "change_cluster", {
     "row_ids": row_ids,
     "new_cluster": new_cluster
   })
+  timing.lap("write")
 
-  return jsonify({"success": True})
+  return jsonify({"success": True, "updated_hulls": touched.tolist(), "timing": timing.laps})
 
 # change cluster name
 # Change the cluster of rows
 @bulk_write_bp.route('/change-cluster-name', methods=['GET'])
+@with_scope_lock
 def change_cluster_name():
   dataset_id = request.args["dataset_id"]
   scope_id = request.args["scope_id"]
   cluster = int(request.args["cluster"])
   new_label = request.args["new_label"]
 
-  # read in the scope parquet
-  scope_file = os.path.join(DATA_DIR, dataset_id, "scopes", scope_id + ".parquet")
-  df = pd.read_parquet(scope_file)
+  timing = Timer()
 
   # read the scope metadata for the cluster_label_map
-  scope_meta_file = os.path.join(DATA_DIR, dataset_id, "scopes", scope_id + ".json")
-  with open(scope_meta_file) as f:
-    scope_meta = json.load(f)
+  scope_meta = read_scope_meta(scope_path(dataset_id, scope_id))
+
+  # update the label column of the cluster's rows
+  edit_scope(dataset_id, scope_id, {
+    "action": "change_cluster_name",
+    "cluster": cluster,
+    "label": new_label
+  })
+  timing.lap("edit")
 
   clusters = scope_meta["cluster_labels_lookup"]
   updated = clusters[cluster]
   updated["label"] = new_label
 
-  # update the label column in the parquet
-  df[df['cluster'] == cluster]['label'] = new_label
-  df.to_parquet(scope_file)
-
-  update_combined(df, dataset_id, scope_id)
-
   #write the scope meta to file
-  with open(scope_meta_file, "w") as f:
-    json.dump(scope_meta, f, indent=2)
+  write_scope_meta(scope_path(dataset_id, scope_id), scope_meta)
 
   write_transaction(dataset_id, scope_id, "change_cluster_name", {
     "cluster": cluster,
     "new_label": new_label
   })
-  return jsonify({"success": True})
+  timing.lap("write")
+  return jsonify({"success": True, "timing": timing.laps})
 
 
 # Delete rows
 @bulk_write_bp.route('/delete-rows', methods=['POST'])
+@with_scope_lock
 def delete_rows():
   data = request.get_json()
   print(data)
   dataset_id = data["dataset_id"]
   scope_id = data["scope_id"]
   row_ids = data["row_ids"]
-  # read in the scope parquet
-  scope_file = os.path.join(DATA_DIR, dataset_id, "scopes", scope_id + ".parquet")
-  df = pd.read_parquet(scope_file)
-  df = df[~df['ls_index'].isin(row_ids)]
-  df.reset_index(drop=True, inplace=True)
-
-  df.to_parquet(scope_file)
+  timing = Timer()
 
-  update_combined(df, dataset_id, scope_id)
+  state, touched = edit_scope(dataset_id, scope_id, {
+    "action": "delete_rows",
+    "row_ids": row_ids
+  })
+  timing.lap("edit")
 
-  # recalculate hulls
-  scope_meta_file = os.path.join(DATA_DIR, dataset_id, "scopes", scope_id + ".json")
-  with open(scope_meta_file) as f:
-    scope_meta = json.load(f)
+  # recalculate the hulls of the clusters that lost rows
+  scope_meta = read_scope_meta(scope_path(dataset_id, scope_id))
   clusters = scope_meta["cluster_labels_lookup"]
-  for c in clusters:
-    indices = df[df['cluster'] == c["cluster"]]["ls_index"].tolist()
-    label_points = df[df['cluster'] == c["cluster"]][['x', 'y']].values
-    try:
-      hull = ConvexHull(label_points)
-      hull_list = [indices[s] for s in hull.vertices.tolist()]
-      c["hull"] = hull_list
-    except:
-      c["hull"] = []
-
-  scope_meta["rows"] = len(df)
+  state.update_hulls(clusters, scope_meta.get("cluster", {}).get("max_hull_vertices"), touched)
+  timing.lap("hulls")
+
+  scope_meta["rows"] = len(state)
   # write the scope meta to file
-  with open(scope_meta_file, "w") as f:
-    json.dump(scope_meta, f, indent=2)
+  write_scope_meta(scope_path(dataset_id, scope_id), scope_meta)
 
   write_transaction(dataset_id, scope_id, "delete_rows", {
     "row_ids": row_ids
   })
-  return jsonify({"success": True})
-
-def update_combined(df, dataset_id, scope_id):
-  input_df = pd.read_parquet(os.path.join(DATA_DIR, dataset_id, "input.parquet"))
-  input_df.reset_index(inplace=True)
-  input_df = input_df[input_df['index'].isin(df['ls_index'])]
-  combined_df = input_df.join(df.set_index('ls_index'), on='index', rsuffix='_ls')
-  combined_df.to_parquet(os.path.join(DATA_DIR, dataset_id, "scopes", scope_id + "-input.parquet"))
+  timing.lap("write")
+  return jsonify({"success": True, "updated_hulls": touched.tolist(), "timing": timing.laps})
+
+# Write the pending edits of a scope into its parquet
+@bulk_write_bp.route('/compact', methods=['GET'])
+def compact():
+  dataset_id = request.args["dataset_id"]
+  scope_id = request.args["scope_id"]
+  scope_file = scope_path(dataset_id, scope_id)
+  return jsonify({"success": True, "compacted": compact_scope(scope_file)})
+
+# Take back the last edits of a scope
+@bulk_write_bp.route('/undo', methods=['GET'])
+@with_scope_lock
+def undo():
+  dataset_id = request.args["dataset_id"]
+  scope_id = request.args["scope_id"]
+  count = int(request.args.get("count", 1))
+  timing = Timer()
+  undone = undo_scope(scope_path(dataset_id, scope_id), count)
+  remove_export(dataset_id, scope_id)
+  timing.lap("undo")
+  return jsonify({"success": True, "undone": undone, "timing": timing.laps})
+
+# Snapshot a scope so undos and replays don't have to start from the original scope
+@bulk_write_bp.route('/checkpoint', methods=['GET'])
+def checkpoint():
+  dataset_id = request.args["dataset_id"]
+  scope_id = request.args["scope_id"]
+  position = checkpoint_scope(scope_path(dataset_id, scope_id))
+  return jsonify({"success": True, "transaction": position})
+
+# The transaction log of a scope
+@bulk_bp.route('/transactions', methods=['GET'])
+def transactions():
+  dataset_id = request.args["dataset_id"]
+  scope_id = request.args["scope_id"]
+  return jsonify(read_transactions(scope_path(dataset_id, scope_id)))
+
+def remove_export(dataset_id, scope_id):
+  """
+  The input joined with the scope is read through a ScopeView instead of being rewritten on every edit,
+  so we just drop a previously exported copy that is now out of date.
+  """
+  export_file = os.path.join(DATA_DIR, dataset_id, "scopes", scope_id + "-input.parquet")
+  if os.path.exists(export_file):
+    os.remove(export_file)
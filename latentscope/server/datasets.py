@@ -3,7 +3,9 @@ import re
 import json
 import fnmatch
 import pandas as pd
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, jsonify, request, send_from_directory
+from latentscope.util.scopes import ScopeView, read_scope
+from latentscope.util.transactions import append_transaction
 
 # Create a Blueprint
 datasets_bp = Blueprint('datasets_bp', __name__)
@@ -217,9 +219,19 @@ def get_dataset_scope(dataset, scope):
 def get_dataset_scope_parquet(dataset, scope):
     directory_path = os.path.join(DATA_DIR, dataset, "scopes")
     file_path = os.path.join(directory_path, scope + ".parquet")
-    df = pd.read_parquet(file_path)
+    df = read_scope(file_path)
     return df.to_json(orient="records")
 
+"""
+Materialize the input joined with the scope columns to <scope>-input.parquet and download it.
+The app reads scopes through a ScopeView, so this is only needed to use the joined data elsewhere.
+"""
+@datasets_write_bp.route('/<dataset>/scopes/<scope>/export', methods=['GET'])
+def export_scope_parquet(dataset, scope):
+    file_name = scope + "-input.parquet"
+    ScopeView(dataset, scope, DATA_DIR).export(os.path.join(DATA_DIR, dataset, "scopes", file_name))
+    return send_from_directory(os.path.join(DATA_DIR, dataset, "scopes"), file_name, as_attachment=True)
+
 @datasets_write_bp.route('/<dataset>/scopes/<scope>/description', methods=['GET'])
 def overwrite_scope_description(dataset, scope):
     new_label = request.args.get('label')
@@ -260,6 +272,11 @@ def new_scope_cluster(dataset, scope):
     with open(file_path, 'w', encoding='utf-8') as json_file:
         json.dump(json_contents, json_file)
     
+    append_transaction(os.path.join(DATA_DIR, dataset, "scopes", scope + ".parquet"), "new_cluster", {
+        "cluster": clusterIndex,
+        "label": new_label
+    })
+
     return jsonify({"success": True, "message": "Description updated successfully"})
 
 
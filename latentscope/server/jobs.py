@@ -145,6 +145,21 @@ def run_reingest():
     threading.Thread(target=run_job, args=(dataset, job_id, command)).start()
     return jsonify({"job_id": job_id})
 
+@jobs_write_bp.route('/ingest_index')
+def run_ingest_index():
+    dataset = request.args.get('dataset')
+    text_column = request.args.get('text_column')
+    rebuild = request.args.get('rebuild')
+
+    job_id = str(uuid.uuid4())
+    command = f'ls-ingest-index "{dataset}"'
+    if text_column:
+        command += f' --text_column="{text_column}"'
+    if rebuild:
+        command += " --rebuild"
+    threading.Thread(target=run_job, args=(dataset, job_id, command)).start()
+    return jsonify({"job_id": job_id})
+
 
 
 @jobs_write_bp.route('/embed')
@@ -156,6 +171,7 @@ def run_embed():
     dimensions = request.args.get('dimensions')
     batch_size = request.args.get('batch_size')
     max_seq_length = request.args.get('max_seq_length')
+    index = request.args.get('index')
 
     job_id = str(uuid.uuid4())
     command = f'ls-embed "{dataset}" "{text_column}" "{model_id}" --prefix="{prefix}" --batch_size={batch_size}'
@@ -163,6 +179,8 @@ def run_embed():
         command += f" --dimensions={dimensions}"
     if max_seq_length is not None:
         command += f" --max_seq_length={max_seq_length}"
+    if index:
+        command += " --index"
     threading.Thread(target=run_job, args=(dataset, job_id, command)).start()
     return jsonify({"job_id": job_id})
 
@@ -177,6 +195,27 @@ def run_embed_truncate():
     threading.Thread(target=run_job, args=(dataset, job_id, command)).start()
     return jsonify({"job_id": job_id})
 
+@jobs_write_bp.route('/embed_index')
+def run_embed_index():
+    dataset = request.args.get('dataset')
+    embedding_id = request.args.get('embedding_id')
+    index_type = request.args.get('type')
+    nlist = request.args.get('nlist')
+
+    job_id = str(uuid.uuid4())
+    command = f'ls-embed-index "{dataset}" "{embedding_id}"'
+    if index_type is not None:
+        if index_type not in ('ivf', 'binary'):
+            return jsonify({"error": f"Unknown index type {index_type}, expected one of ivf, binary"}), 400
+        command += f" --type={index_type}"
+    if nlist is not None:
+        try:
+            command += f" --nlist={int(nlist)}"
+        except ValueError:
+            return jsonify({"error": f"nlist must be an integer, got {nlist}"}), 400
+    threading.Thread(target=run_job, args=(dataset, job_id, command)).start()
+    return jsonify({"job_id": job_id})
+
 @jobs_write_bp.route('/embed_importer')
 def run_embed_importer():
     dataset = request.args.get('dataset')
@@ -304,10 +343,16 @@ def run_cluster():
     samples = request.args.get('samples')
     min_samples = request.args.get('min_samples')
     cluster_selection_epsilon = request.args.get('cluster_selection_epsilon')
+    max_hull_vertices = request.args.get('max_hull_vertices')
+    sample_size = request.args.get('sample_size')
     print("run cluster", dataset, umap_id, samples, min_samples, cluster_selection_epsilon)
 
     job_id = str(uuid.uuid4())
     command = f'ls-cluster "{dataset}" "{umap_id}" {samples} {min_samples} {cluster_selection_epsilon}'
+    if max_hull_vertices:
+        command += f' --max_hull_vertices={int(max_hull_vertices)}'
+    if sample_size:
+        command += f' --sample_size={int(sample_size)}'
     threading.Thread(target=run_job, args=(dataset, job_id, command)).start()
     return jsonify({"job_id": job_id})
 
@@ -328,11 +373,20 @@ def run_cluster_label():
     text_column = request.args.get('text_column')
     cluster_id = request.args.get('cluster_id')
     context = request.args.get('context')
+    concurrency = request.args.get('concurrency')
+    rate_limit = request.args.get('rate_limit')
+    batch_size = request.args.get('batch_size')
     print("run cluster label", dataset, chat_id, text_column, cluster_id)
     print("context", context)
 
     job_id = str(uuid.uuid4())
     command = f'ls-label "{dataset}" "{text_column}" "{cluster_id}" "{chat_id}" "{context}"'
+    if concurrency:
+        command += f' --concurrency={int(concurrency)}'
+    if rate_limit:
+        command += f' --rate_limit={float(rate_limit)}'
+    if batch_size:
+        command += f' --batch_size={int(batch_size)}'
     threading.Thread(target=run_job, args=(dataset, job_id, command)).start()
     return jsonify({"job_id": job_id})
 
@@ -346,12 +400,15 @@ def run_scope():
     label = request.args.get('label')
     description = request.args.get('description')
     scope_id = request.args.get('scope_id')
+    export = request.args.get('export')
     print("run scope", dataset, embedding_id, umap_id, cluster_id, cluster_labels_id, label, description, scope_id)
 
     job_id = str(uuid.uuid4())
     command = f'ls-scope "{dataset}" "{embedding_id}" "{umap_id}" "{cluster_id}" "{cluster_labels_id}" "{label}" "{description}"'
     if scope_id:
         command += f' --scope_id={scope_id}'
+    if export:
+        command += ' --export'
     threading.Thread(target=run_job, args=(dataset, job_id, command)).start()
     return jsonify({"job_id": job_id})
 
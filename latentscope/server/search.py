@@ -1,35 +1,62 @@
 import os
 import json
-import h5py
 import pandas as pd
 import numpy as np
 from flask import Blueprint, jsonify, request
-from sklearn.neighbors import NearestNeighbors
 
 from latentscope.models import get_embedding_model
+from latentscope.util.vectors import load_index, index_dir
 
 # Create a Blueprint
 search_bp = Blueprint('search_bp', __name__)
 DATA_DIR = os.getenv('LATENT_SCOPE_DATA')
 
-# in memory cache of dataset metadata, embeddings, models and tokenizers
+# in memory cache of search indexes, models and tokenizers
 DATASETS = {}
 EMBEDDINGS = {}
+LEXICAL = {}
 
-"""
-Returns nearest neighbors for a given query string
-Hard coded to 150 results currently
-"""
-@search_bp.route('/nn', methods=['GET'])
-def nn():
-    dataset = request.args.get('dataset')
-    embedding_id = request.args.get('embedding_id')
-    dimensions = request.args.get('dimensions')
-    dimensions = int(dimensions) if dimensions else None
-    # return_embeddings = True if request.args.get('return_embeddings') else False
-    print("dimensions", dimensions)
+def index_version(embedding_path):
+    """mtime of the embedding's built index, if any, so we notice when one is (re)built while the server runs"""
+    path = os.path.join(index_dir(embedding_path), "index.json")
+    return os.path.getmtime(path) if os.path.exists(path) else None
 
-    num = 150
+def search_index(dataset, embedding_id, exact=False):
+    """The (cached) search index of an embedding: its prebuilt approximate index if there is one, else exact search"""
+    embedding_path = os.path.join(DATA_DIR, dataset, "embeddings", f"{embedding_id}.h5")
+    key = (embedding_id, exact)
+    version = None if exact else index_version(embedding_path)
+    cached = DATASETS.get(dataset, {}).get(key)
+    if cached is None or cached[0] != version:
+        print("loading search index", embedding_id, "(exact)" if exact else "")
+        DATASETS.setdefault(dataset, {})[key] = (version, load_index(embedding_path, exact=exact))
+    return DATASETS[dataset][key][1]
+
+def load_search_indexes():
+    """
+    Memory-map the prebuilt indexes of every dataset so the first search doesn't have to,
+    called when the server starts (search_index loads them lazily otherwise)
+    """
+    if not DATA_DIR or not os.path.exists(DATA_DIR):
+        return
+    for dataset in os.listdir(DATA_DIR):
+        embedding_dir = os.path.join(DATA_DIR, dataset, "embeddings")
+        if not os.path.isdir(embedding_dir):
+            continue
+        for f in os.listdir(embedding_dir):
+            if f.endswith("-index") and os.path.exists(os.path.join(embedding_dir, f, "index.json")):
+                try:
+                    search_index(dataset, f[:-len("-index")])
+                except Exception as e:
+                    print("could not load search index", dataset, f, e)
+
+def nearest(dataset, embedding_id, query, dimensions=None, exact=False, k=150, offset=0, mask=None):
+    """
+    Embed the query string and find its nearest neighbors in the dataset's embeddings
+    with the embedding's approximate index if it has one, unless exact is set
+    Returns results offset to offset+k (fewer if there aren't enough rows) among the rows allowed by the boolean mask, if any
+    Returns the indices, distances and query embedding
+    """
     if embedding_id not in EMBEDDINGS:
         print("loading model", embedding_id)
         with open(os.path.join(DATA_DIR, dataset, "embeddings", embedding_id + ".json"), 'r') as f:
@@ -42,32 +69,150 @@ def nn():
     else:
         model = EMBEDDINGS[embedding_id]
 
-    if dataset not in DATASETS or embedding_id not in DATASETS[dataset]:
-        # load the dataset embeddings
-        # embeddings = np.load(os.path.join(DATA_DIR, dataset, "embeddings", embedding_id + ".npy"))
-        embedding_path = os.path.join(DATA_DIR, dataset, "embeddings", f"{embedding_id}.h5")
-        with h5py.File(embedding_path, 'r') as f:
-            embeddings = np.array(f["embeddings"])
-        print("fitting embeddings")
-        nne = NearestNeighbors(n_neighbors=num, metric="cosine")
-        nne.fit(embeddings)
-        if dataset not in DATASETS:
-          DATASETS[dataset] = {}
-        DATASETS[dataset][embedding_id] = nne
-    else:
-        nne = DATASETS[dataset][embedding_id]
+    index = search_index(dataset, embedding_id, exact)
     
     # embed the query string and find the nearest neighbor
-    query = request.args.get('query')
     print("query", query)
     embedding = np.array(model.embed([query], dimensions=dimensions))
-    distances, indices = nne.kneighbors(embedding)
-    filtered_indices = indices[0]
-    filtered_distances = distances[0]
-    indices = filtered_indices
-    distances = filtered_distances
+    if mask is not None and len(mask) != len(index):
+        raise ValueError(f"The row filter has {len(mask)} rows, the embeddings have {len(index)}")
+    indices, distances = index.search(embedding, k + offset, mask=mask)
+    # approximate searches can come up short
+    found = indices[0] >= 0
+    return indices[0][found][offset:], distances[0][found][offset:], embedding
+
+def search_mask(dataset, embedding_id, params):
+    """
+    The rows a search is restricted to, from the indices, bitmap (base64, see /api/tags) or selection expression
+    (see /api/select) parameters, intersected together, or None to search every row.
+    A scope_id restricts the search to the rows of the scope, leaving out its deleted rows.
+    """
+    from latentscope.util.tags import decode_bitmap
+    from latentscope.util.selection import parse, evaluate
+    from .selection import Selection, bitmap_of
+    indices = params.get('indices')
+    bitmap = params.get('bitmap')
+    expression = params.get('selection')
+    scope_id = params.get('scope_id')
+    if indices is None and bitmap is None and not expression and not scope_id:
+        return None
+    selection = Selection(dataset, scope_id, embedding_id)
+    mask = selection.universe()
+    if expression:
+        mask = evaluate(parse(expression), selection.resolve, mask)
+    if indices is not None:
+        if isinstance(indices, str):
+            indices = [int(i) for i in indices.split(",") if i.strip()]
+        mask = mask & bitmap_of(selection.length, indices)
+    if bitmap is not None:
+        mask = mask & decode_bitmap(bitmap, selection.length)
+    return mask
+
+def search_params(dataset, embedding_id, params):
+    """The k, offset and row mask of a search request"""
+    k = int(params.get('k') or 150)
+    offset = int(params.get('offset') or 0)
+    if k < 1 or offset < 0:
+        raise ValueError("k must be positive and offset can't be negative")
+    return k, offset, search_mask(dataset, embedding_id, params)
+
+def lexical_index(dataset):
+    """The (cached) BM25 index of a dataset, reloaded when it is updated"""
+    from latentscope.util.lexical import LexicalIndex, index_dir
+    path = os.path.join(index_dir(os.path.join(DATA_DIR, dataset)), "index.json")
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"{dataset} has no full text index yet, build it with ls-ingest-index")
+    version = os.path.getmtime(path)
+    cached = LEXICAL.get(dataset)
+    if cached is None or cached[0] != version:
+        print("loading lexical index", dataset)
+        LEXICAL[dataset] = (version, LexicalIndex.load(os.path.join(DATA_DIR, dataset)))
+    return LEXICAL[dataset][1]
+
+def lexical(dataset, query, k=150, offset=0, mask=None):
+    """BM25 search of the dataset's text column, returns results offset to offset+k as indices and scores"""
+    index = lexical_index(dataset)
+    if mask is not None:
+        # rows appended since the index was last updated can't match yet
+        mask = mask[:len(index)]
+    indices, scores = index.search(query, k + offset, mask=mask)
+    return indices[offset:], scores[offset:]
+
+"""
+Returns nearest neighbors for a given query string
+Uses the embedding's approximate index (ls-embed-index) when there is one, pass exact=1 to search exhaustively
+k results (150 by default) starting from offset, for paging through results
+Searches can be restricted to a subset of rows with any of
+indices (a list, or comma separated in a GET), bitmap (base64 like /api/tags?encoding=bitmap),
+selection (an expression like /api/select) and scope_id (only rows the scope hasn't deleted);
+long lists of indices are better POSTed as JSON with the same parameters
+"""
+@search_bp.route('/nn', methods=['GET', 'POST'])
+def nn():
+    from latentscope.util.selection import SelectionError
+    params = request.get_json() if request.method == 'POST' else request.args
+    dataset = params.get('dataset')
+    embedding_id = params.get('embedding_id')
+    dimensions = params.get('dimensions')
+    dimensions = int(dimensions) if dimensions else None
+    # return_embeddings = True if request.args.get('return_embeddings') else False
+    print("dimensions", dimensions)
+
+    exact = str(params.get('exact')).lower() in ['1', 'true']
+    query = params.get('query')
+    try:
+        k, offset, mask = search_params(dataset, embedding_id, params)
+        indices, distances, embedding = nearest(dataset, embedding_id, query, dimensions, exact, k, offset, mask)
+    except (ValueError, SelectionError) as e:
+        return jsonify({"error": str(e)}), 400
     return jsonify(indices=indices.tolist(), distances=distances.tolist(), search_embedding=embedding.tolist())
 
+"""
+Full text search of the dataset's text column, ranked by BM25 (see ls-ingest-index)
+Takes the same k, offset and row filter parameters as /nn, returns the indices and their scores
+"""
+@search_bp.route('/lexical', methods=['GET', 'POST'])
+def lexical_search():
+    from latentscope.util.selection import SelectionError
+    params = request.get_json() if request.method == 'POST' else request.args
+    dataset = params.get('dataset')
+    try:
+        k, offset, mask = search_params(dataset, params.get('embedding_id'), params)
+        indices, scores = lexical(dataset, params.get('query') or "", k, offset, mask)
+    except (ValueError, SelectionError) as e:
+        return jsonify({"error": str(e)}), 400
+    except FileNotFoundError as e:
+        return jsonify({"error": str(e)}), 404
+    return jsonify(indices=indices.tolist(), scores=scores.tolist())
+
+"""
+Hybrid search: the full text (BM25) and nearest neighbor results for the query, fused by reciprocal rank
+Takes the same parameters as /nn, returns the indices, their fused scores and the query embedding
+"""
+@search_bp.route('/hybrid', methods=['GET', 'POST'])
+def hybrid_search():
+    from latentscope.util.selection import SelectionError
+    from latentscope.util.lexical import reciprocal_rank_fusion
+    params = request.get_json() if request.method == 'POST' else request.args
+    dataset = params.get('dataset')
+    embedding_id = params.get('embedding_id')
+    dimensions = params.get('dimensions')
+    dimensions = int(dimensions) if dimensions else None
+    exact = str(params.get('exact')).lower() in ['1', 'true']
+    query = params.get('query') or ""
+    try:
+        k, offset, mask = search_params(dataset, embedding_id, params)
+        # rank deeper than the page so rows that only one of the searches ranks high can still make it
+        depth = 2 * (k + offset)
+        lexical_indices, _ = lexical(dataset, query, depth, 0, mask)
+        vector_indices, _, embedding = nearest(dataset, embedding_id, query, dimensions, exact, depth, 0, mask)
+    except (ValueError, SelectionError) as e:
+        return jsonify({"error": str(e)}), 400
+    except FileNotFoundError as e:
+        return jsonify({"error": str(e)}), 404
+    indices, scores = reciprocal_rank_fusion([lexical_indices, vector_indices], k + offset)
+    return jsonify(indices=indices[offset:].tolist(), scores=scores[offset:].tolist(), search_embedding=embedding.tolist())
+
 
 @search_bp.route('/compare', methods=['GET'])
 def compare():
@@ -0,0 +1,170 @@
+import os
+import json
+import math
+import threading
+import numpy as np
+from flask import Blueprint, jsonify, request
+
+from latentscope.util.selection import SelectionError, parse, parse_filter, evaluate, filter_mask
+from latentscope.util.scopes import ScopeView, scope_state, read_rows
+from latentscope.util.tags import load_tag, tag_key, encode_indices, ENCODINGS
+
+# Create a Blueprint
+select_bp = Blueprint('select_bp', __name__)
+DATA_DIR = os.getenv('LATENT_SCOPE_DATA')
+
+# ===========================================================
+# Selections
+# ===========================================================
+
+# bitmaps of the terms of recent selections, with the version of the files they were computed from
+# (dataset, scope_id, embedding_id, kind, argument) -> (version, bitmap)
+BITMAPS = {}
+# the bitmaps take a byte per row, so the cache is bounded by their total size rather than their number
+MAX_BITMAP_BYTES = 256 * 2**20
+BITMAPS_LOCK = threading.Lock()
+
+def cached_bitmap(key, version, compute):
+    with BITMAPS_LOCK:
+        cached = BITMAPS.get(key)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    bitmap = compute()
+    with BITMAPS_LOCK:
+        BITMAPS.pop(key, None)
+        BITMAPS[key] = (version, bitmap)
+        # evict the oldest entries, but always keep the one just computed
+        size = sum(cached[1].nbytes for cached in BITMAPS.values())
+        while size > MAX_BITMAP_BYTES and len(BITMAPS) > 1:
+            size -= BITMAPS.pop(next(iter(BITMAPS)))[1].nbytes
+    return bitmap
+
+def bitmap_of(length, indices):
+    bitmap = np.zeros(length, dtype=bool)
+    indices = np.asarray(indices, dtype=np.int64)
+    bitmap[indices[(indices >= 0) & (indices < length)]] = True
+    return bitmap
+
+class Selection:
+    """Resolves the terms of a selection expression for a dataset, and optionally a scope"""
+    def __init__(self, dataset, scope_id=None, embedding_id=None):
+        import pyarrow.parquet as pq
+        self.dataset = dataset
+        self.scope_id = scope_id
+        self.input_file = os.path.join(DATA_DIR, dataset, "input.parquet")
+        self.length = pq.ParquetFile(self.input_file).metadata.num_rows
+        self.scope_file = os.path.join(DATA_DIR, dataset, "scopes", scope_id + ".parquet") if scope_id else None
+        if embedding_id is None and scope_id:
+            with open(os.path.join(DATA_DIR, dataset, "scopes", scope_id + ".json")) as f:
+                embedding_id = json.load(f).get("embedding_id")
+        self.embedding_id = embedding_id
+
+    def state(self):
+        if self.scope_file is None:
+            raise SelectionError("Clusters and scope columns need a scope_id")
+        return scope_state(self.scope_file)
+
+    def universe(self):
+        """Every row that can be selected: the rows of the scope, or of the whole input"""
+        if self.scope_file is None:
+            return np.ones(self.length, dtype=bool)
+        state = self.state()
+        return cached_bitmap((self.dataset, self.scope_id, None, "scope", ""), state.key,
+            lambda: bitmap_of(self.length, state.ls_index[state.alive]))
+
+    def resolve(self, kind, argument):
+        key = (self.dataset, self.scope_id, self.embedding_id, kind, argument)
+        if kind == "tag":
+            tagdir = os.path.join(DATA_DIR, self.dataset, "tags")
+            if tag_key(tagdir, argument) == (None, None, None):
+                raise SelectionError(f"Unknown tag {argument}")
+            return cached_bitmap(key, tag_key(tagdir, argument), lambda: bitmap_of(self.length, load_tag(tagdir, argument).indices))
+        if kind == "cluster":
+            try:
+                cluster = int(argument)
+            except ValueError:
+                raise SelectionError(f"Cluster ids are integers, got {argument}")
+            state = self.state()
+            return cached_bitmap(key, state.key, lambda: bitmap_of(self.length, state.ls_index[state.members.get(cluster, [])]))
+        if kind == "filter":
+            return self.resolve_filter(key, *parse_filter(argument))
+        if kind == "search":
+            return self.resolve_search(key, argument)
+        raise SelectionError(f"Unknown term {kind}")
+
+    def resolve_filter(self, key, column, type, value):
+        import pyarrow.parquet as pq
+        if column in pq.read_schema(self.input_file).names:
+            def compute():
+                values = pq.read_table(self.input_file, columns=[column]).column(column).to_pandas()
+                return filter_mask(values, type, value)
+            return cached_bitmap(key, os.stat(self.input_file).st_mtime_ns, compute)
+        # columns only the scope has, like label or x and y
+        state = self.state()
+        if column not in state.df.columns:
+            raise SelectionError(f"Unknown column {column}")
+        def compute():
+            matches = filter_mask(state.df[column], type, value) & state.alive
+            return bitmap_of(self.length, state.ls_index[matches])
+        return cached_bitmap(key, state.key, compute)
+
+    def resolve_search(self, key, argument):
+        from .search import nearest
+        if not self.embedding_id:
+            raise SelectionError("search() needs an embedding_id or a scope_id")
+        query = argument
+        if argument.startswith('"'):
+            query = json.loads(argument)
+        embedding_file = os.path.join(DATA_DIR, self.dataset, "embeddings", self.embedding_id + ".h5")
+        return cached_bitmap(key, os.stat(embedding_file).st_mtime_ns,
+            lambda: bitmap_of(self.length, nearest(self.dataset, self.embedding_id, query)[0]))
+
+"""
+Evaluate a selection expression over the tags, clusters, column filters and searches of a dataset
+POST {dataset, expression, scope_id?, embedding_id?, mode?, encoding?, page?}
+expression is for example: tag:👍 AND cluster:12 AND filter(score > 0.5) AND NOT tag:👎
+(see latentscope.util.selection for the syntax), clusters and scope columns need a scope_id
+and searches use the embedding_id, which defaults to the scope's.
+mode "indices" (the default) returns the count and the selected indices, encoded as json, runs or bitmap like /api/tags,
+"count" just the count and "rows" a page of the selected rows like /api/query
+"""
+@select_bp.route('/', methods=['POST'])
+def select():
+    per_page = 100
+    data = request.get_json()
+    dataset = data['dataset']
+    scope_id = data.get('scope_id')
+    mode = data.get('mode', 'indices')
+    encoding = data.get('encoding', 'json')
+    page = data.get('page', 0)
+    if mode not in ["indices", "count", "rows"]:
+        return jsonify({"error": f"Unknown mode {mode}, expected one of indices, count, rows"}), 400
+    if encoding not in ENCODINGS:
+        return jsonify({"error": f"Unknown encoding {encoding}, expected one of {', '.join(ENCODINGS)}"}), 400
+
+    try:
+        selection = Selection(dataset, scope_id, data.get('embedding_id'))
+        bitmap = evaluate(parse(data['expression']), selection.resolve, selection.universe())
+    except SelectionError as e:
+        return jsonify({"error": str(e)}), 400
+    count = int(bitmap.sum())
+
+    if mode == "count":
+        return jsonify({"count": count})
+    if mode == "indices":
+        return jsonify({"count": count, "indices": encode_indices(np.flatnonzero(bitmap), encoding, selection.length)})
+
+    indices = np.flatnonzero(bitmap)[page*per_page:page*per_page+per_page]
+    if scope_id:
+        rows = ScopeView(dataset, scope_id, DATA_DIR).to_pandas(indices=indices)
+        rows['ls_index'] = rows['index']
+    else:
+        rows = read_rows(selection.input_file, indices).to_pandas()
+        rows['ls_index'] = indices
+    return jsonify({
+        "rows": json.loads(rows.to_json(orient="records")),
+        "page": page,
+        "per_page": per_page,
+        "total": count,
+        "totalPages": math.ceil(count / per_page)
+    })
@@ -1,7 +1,8 @@
 import os
 import sys
-import numpy as np
+import json
 from flask import Blueprint, jsonify, request
+from latentscope.util.tags import list_tags, load_tag, update_tag, create_tag, encode_indices, ENCODINGS, delete_tag as remove_tag_files
 
 # Create a Blueprint
 tags_bp = Blueprint('tags_bp', __name__)
@@ -12,32 +13,39 @@ DATA_DIR = os.getenv('LATENT_SCOPE_DATA')
 # Tags
 # ===========================================================
 
-# cache of list of indices per tag per dataset
-tagsets = {}
+def tag_dir(dataset):
+    tagdir = os.path.join(DATA_DIR, dataset, "tags")
+    if not os.path.exists(tagdir):
+        os.makedirs(tagdir)
+    return tagdir
+
+def dataset_length(dataset):
+    with open(os.path.join(DATA_DIR, dataset, "meta.json")) as f:
+        return json.load(f).get("length")
+
+def tags_json(dataset, encoding="json"):
+    """
+    The tags of a dataset as a JSON object of tag name to indices, encoded as asked.
+    Tags are cached in memory (see latentscope.util.tags.load_tag) and only read again when their files change.
+    """
+    if encoding not in ENCODINGS:
+        return jsonify({"error": f"Unknown encoding {encoding}, expected one of {', '.join(ENCODINGS)}"}), 400
+    tagdir = tag_dir(dataset)
+    # bitmaps of every tag cover the whole dataset so they can be combined bit for bit
+    length = dataset_length(dataset) if encoding == "bitmap" else None
+    return jsonify({tag: encode_indices(load_tag(tagdir, tag).indices, encoding, length) for tag in list_tags(tagdir)})
 
 """
 Return the tagsets for a given dataset
 This is a JSON object with the tag name as the key and an array of indices as the value
+With encoding=runs each tag is {"encoding": "runs", "count": n, "runs": [start, length, ...]}
+and with encoding=bitmap {"encoding": "bitmap", "count": n, "length": rows, "bitmap": base64 bits}
 """
 @tags_bp.route("/", methods=['GET'])
 def tags():
     dataset = request.args.get('dataset')
-    tagdir = os.path.join(DATA_DIR, dataset, "tags")
-    if not os.path.exists(tagdir):
-        os.makedirs(tagdir)
-    if dataset not in tagsets:
-        tagsets[dataset] = {}
-    # search the dataset directory for all files ending in .indices
-    for f in os.listdir(tagdir):
-        if f.endswith(".indices"):
-            tag = f.split(".")[0]
-            indices = np.loadtxt(os.path.join(DATA_DIR, dataset, "tags", tag + ".indices"), dtype=int).tolist()
-            if type(indices) == int:
-                indices = [indices]
-            tagsets[dataset][tag] = indices
-
     # return an object with the tags for a given dataset
-    return jsonify(tagsets[dataset])
+    return tags_json(dataset, request.args.get('encoding', 'json'))
 
 """
 Create a new tag for a given dataset
@@ -46,29 +54,9 @@ Create a new tag for a given dataset
 def new_tag():
     dataset = request.args.get('dataset')
     tag = request.args.get('tag')
-    if dataset not in tagsets:
-        tagsets[dataset] = {}
-    # search the dataset directory for all files ending in .indices
-    tags = []
-    for f in os.listdir(os.path.join(DATA_DIR, dataset)):
-        if f.endswith(".indices"):
-            dtag = f.split(".")[0]
-            indices = np.loadtxt(os.path.join(DATA_DIR, dataset, "tags", dtag + ".indices"), dtype=int).tolist()
-            if type(indices) == int:
-                indices = [indices]
-            tagsets[dataset][dtag] = indices
-
-    if tag not in tagsets[dataset]:
-        tagsets[dataset][tag] = []
-        # create an empty file
-        filename = os.path.join(DATA_DIR, dataset, "tags", tag + ".indices")
-        with open(filename, 'w') as f:
-            f.write("")
-            f.close()
-
-
+    create_tag(tag_dir(dataset), tag)
     # return an object with the tags for a given dataset
-    return jsonify(tagsets[dataset])
+    return tags_json(dataset)
 
 """
 Add a data index to a tag
@@ -77,29 +65,10 @@ Add a data index to a tag
 def add_tag():
     dataset = request.args.get('dataset')
     tag = request.args.get('tag')
-    index = request.args.get('index')
-    if dataset not in tagsets:
-        ts = tagsets[dataset] = {}
-    else:
-        ts = tagsets[dataset]
-    if tag not in ts:
-        # read a tag file, which is just a csv with a single column into an array of integers
-        indices = np.loadtxt(os.path.join(DATA_DIR, dataset, "tags", tag + ".indices"), dtype=int).tolist()
-        if type(indices) == int:
-            indices = [indices]
-        ts[tag] = indices
-    else:
-        indices = ts[tag]
-
-    if not indices:
-        indices = []
-    if index not in indices:
-        indices.append(int(index))
-        ts[tag] = indices
-        # save the indices to a file
-        np.savetxt(os.path.join(DATA_DIR, dataset, "tags", tag + ".indices"), indices, fmt='%d')
+    index = int(request.args.get('index'))
+    update_tag(tag_dir(dataset), tag, load_tag(tag_dir(dataset), tag), add=[index])
     # return an object with the tags for a given dataset
-    return jsonify(tagsets[dataset])
+    return tags_json(dataset)
 
 """
 Add data indices to a tag
@@ -110,36 +79,9 @@ def add_tags():
     dataset = data.get('dataset')
     tag = data.get('tag')
     new_indices = data.get('indices')
-    # print("DATASET", dataset)
-    # print("tag", tag)
-    # print("indices", new_indices)
-
-    if dataset not in tagsets:
-        ts = tagsets[dataset] = {}
-    else:
-        ts = tagsets[dataset]
-    if tag not in ts:
-        # read a tag file, which is just a csv with a single column into an array of integers
-        indices = np.loadtxt(os.path.join(DATA_DIR, dataset, "tags", tag + ".indices"), dtype=int).tolist()
-        if type(indices) == int:
-            indices = [indices]
-        ts[tag] = indices
-    else:
-        indices = ts[tag]
-
-    if not indices:
-        indices = []
-
-    # new_indices_list = [int(idx) for idx in new_indices.split(',')]
-    new_indices_list = [int(idx) for idx in new_indices]
-    for idx in new_indices_list:
-        if idx not in indices:
-            indices.append(idx)
-    ts[tag] = indices
-    # save the indices to a file
-    np.savetxt(os.path.join(DATA_DIR, dataset, "tags", tag + ".indices"), indices, fmt='%d')
+    update_tag(tag_dir(dataset), tag, load_tag(tag_dir(dataset), tag), add=[int(idx) for idx in new_indices])
     # return an object with the tags for a given dataset
-    return jsonify(tagsets[dataset])
+    return tags_json(dataset)
 
 
 """
@@ -150,36 +92,13 @@ def remove_tag():
     dataset = request.args.get('dataset')
     tag = request.args.get('tag')
     index = int(request.args.get('index'))
-    # print("dataset", dataset)
-    # print("tag", tag)
-    # print("index", index)
-    if dataset not in tagsets:
-        ts = tagsets[dataset] = {}
-    else:
-        ts = tagsets[dataset]
-    if tag not in ts:
-        # read a tag file, which is just a csv with a single column into an array of integers
-        indices = np.loadtxt(os.path.join(DATA_DIR, dataset, "tags", tag + ".indices"), dtype=int).tolist()
-        if type(indices) == int:
-            indices = [indices]
-        ts[tag] = indices
-    else:
-        indices = ts[tag]
-    print("indices", indices)
-    if index in indices:
-        print("Removing", index)
-        indices.remove(index)
-        print("removed", indices)
-        ts[tag] = indices
-        # save the indices to a file
-        np.savetxt(os.path.join(DATA_DIR, dataset, "tags", tag + ".indices"), indices, fmt='%d')
-    print("returning", tagsets[dataset])
+    update_tag(tag_dir(dataset), tag, load_tag(tag_dir(dataset), tag), remove=[index])
     # return an object with the tags for a given dataset
-    return jsonify(tagsets[dataset])
+    return tags_json(dataset)
 
 
 """
-Add data indices to a tag
+Remove data indices from a tag
 """
 @tags_write_bp.route("/remove", methods=['POST'])
 def remove_tags():
@@ -187,51 +106,14 @@ def remove_tags():
     dataset = data.get('dataset')
     tag = data.get('tag')
     remove_indices = data.get('indices')
-    print("dataset", dataset)
-    print("tag", tag)
-    print("indices", remove_indices)
-
-    if dataset not in tagsets:
-        ts = tagsets[dataset] = {}
-    else:
-        ts = tagsets[dataset]
-    if tag not in ts:
-        # read a tag file, which is just a csv with a single column into an array of integers
-        indices = np.loadtxt(os.path.join(DATA_DIR, dataset, "tags", tag + ".indices"), dtype=int).tolist()
-        if type(indices) == int:
-            indices = [indices]
-        ts[tag] = indices
-    else:
-        indices = ts[tag]
-
-    if not indices:
-        indices = []
-
-    # new_indices_list = [int(idx) for idx in new_indices.split(',')]
-    new_indices_list = [int(idx) for idx in remove_indices]
-    for idx in new_indices_list:
-        if idx in indices:
-            indices.remove(idx)
-    ts[tag] = indices
-    # save the indices to a file
-    np.savetxt(os.path.join(DATA_DIR, dataset, "tags", tag + ".indices"), indices, fmt='%d')
+    update_tag(tag_dir(dataset), tag, load_tag(tag_dir(dataset), tag), remove=[int(idx) for idx in remove_indices])
     # return an object with the tags for a given dataset
-    return jsonify(tagsets[dataset])
+    return tags_json(dataset)
 
 
 @tags_write_bp.route("/delete", methods=['GET'])
 def delete_tag():
     dataset = request.args.get('dataset')
     tag = request.args.get('tag')
-    if dataset not in tagsets:
-        ts = tagsets[dataset] = {}
-    else:
-        ts = tagsets[dataset]
-    if tag in ts:
-        del ts[tag]
-    try:
-        os.remove(os.path.join(DATA_DIR, dataset, "tags", tag + ".indices"))
-    except FileNotFoundError:
-        pass
-    return jsonify(tagsets[dataset])
-
+    remove_tag_files(tag_dir(dataset), tag)
+    return tags_json(dataset)
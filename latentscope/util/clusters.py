@@ -0,0 +1,65 @@
+"""
+Helpers for working with the per-cluster index lists stored in the cluster label parquets.
+The indices column is an Arrow list array, which we handle as a pair of numpy arrays:
+offsets (length n_clusters + 1) and a flat array of row indices so that the rows of
+cluster i are flat[offsets[i]:offsets[i+1]].
+"""
+
+def group_indices(labels):
+    """
+    Group row indices by cluster label in a single sort.
+    Returns the sorted unique labels, the offsets and the flat row indices.
+    Rows within each cluster are kept in ascending order.
+    """
+    import numpy as np
+    labels = np.asarray(labels)
+    order = np.argsort(labels, kind="stable")
+    cluster_ids, counts = np.unique(labels[order], return_counts=True)
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return cluster_ids, offsets, order.astype(np.int64)
+
+
+def to_list_array(offsets, values):
+    """Build an Arrow list array from offsets and flat values without going through python lists."""
+    import numpy as np
+    import pyarrow as pa
+    return pa.ListArray.from_arrays(pa.array(np.asarray(offsets, dtype=np.int32)), pa.array(values))
+
+
+def from_list_array(array):
+    """Return (offsets, values) numpy arrays for an Arrow list array or chunked array."""
+    import numpy as np
+    import pyarrow as pa
+    if isinstance(array, pa.ChunkedArray):
+        array = array.combine_chunks()
+    lengths = array.value_lengths().fill_null(0).to_numpy(zero_copy_only=False)
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    values = array.flatten().to_numpy(zero_copy_only=False)
+    return offsets, values
+
+
+def read_cluster_indices(path, column="indices"):
+    """Read only the indices column of a cluster labels parquet in compact (offsets, values) form."""
+    import pyarrow.parquet as pq
+    table = pq.read_table(path, columns=[column])
+    return from_list_array(table.column(column))
+
+
+def read_cluster_labels(path, exclude=("indices",)):
+    """Read a cluster labels parquet into a DataFrame, skipping the (potentially large) excluded columns."""
+    import pandas as pd
+    import pyarrow.parquet as pq
+    schema = pq.read_schema(path)
+    columns = [name for name in schema.names if name not in exclude and not name.startswith("__index_level_")]
+    return pd.read_parquet(path, columns=columns)
+
+
+def write_cluster_labels(df, offsets, values, path):
+    """Write a cluster labels DataFrame to parquet, attaching the indices column as an Arrow list array."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    table = pa.Table.from_pandas(df.drop(columns=["indices"], errors="ignore"), preserve_index=False)
+    table = table.append_column("indices", to_list_array(offsets, values))
+    pq.write_table(table, path)
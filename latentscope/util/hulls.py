@@ -0,0 +1,108 @@
+"""
+Convex hull helpers for cluster outlines.
+Hulls are stored as lists of row indices (ls_index) so the frontend can look up the points.
+"""
+
+def _interior_mask(points):
+    """
+    Akl-Toussaint heuristic: points strictly inside the polygon spanned by the extreme points
+    along x, y, x+y and x-y can never be hull vertices, so we drop them before running qhull.
+    """
+    import numpy as np
+    from scipy.spatial import ConvexHull
+    x = points[:, 0]
+    y = points[:, 1]
+    extremes = np.unique([
+        x.argmin(), x.argmax(), y.argmin(), y.argmax(),
+        (x + y).argmin(), (x + y).argmax(), (x - y).argmin(), (x - y).argmax(),
+    ])
+    try:
+        polygon = extremes[ConvexHull(points[extremes]).vertices]
+    except Exception:
+        # fewer than 3 distinct extremes or they are collinear, nothing to filter
+        return np.zeros(len(points), dtype=bool)
+    # vertices are in counterclockwise order, a point is strictly inside if it is left of every edge
+    inside = np.ones(len(points), dtype=bool)
+    for a, b in zip(polygon, np.roll(polygon, -1)):
+        ax, ay = points[a]
+        bx, by = points[b]
+        inside &= (bx - ax) * (y - ay) - (by - ay) * (x - ax) > 0
+    return inside
+
+
+def simplify_hull(vertices, points, max_vertices):
+    """
+    Reduce an ordered hull to at most max_vertices by repeatedly dropping the vertex
+    that spans the smallest triangle with its neighbours (Visvalingam-Whyatt).
+    """
+    import numpy as np
+    vertices = np.asarray(vertices)
+    max_vertices = max(int(max_vertices), 3)
+    while len(vertices) > max_vertices:
+        p = points[vertices]
+        prev = np.roll(p, 1, axis=0)
+        nxt = np.roll(p, -1, axis=0)
+        areas = np.abs((prev[:, 0] - p[:, 0]) * (nxt[:, 1] - p[:, 1]) - (nxt[:, 0] - p[:, 0]) * (prev[:, 1] - p[:, 1]))
+        vertices = np.delete(vertices, areas.argmin())
+    return vertices
+
+
+def hull_indices(points, indices, max_vertices=None):
+    """
+    Return the hull of points as a list of the corresponding entries of indices.
+    Returns an empty list if a hull can't be computed (too few or collinear points).
+    """
+    import numpy as np
+    from scipy.spatial import ConvexHull
+    if len(points) < 3:
+        return []
+    candidates = np.flatnonzero(~_interior_mask(points))
+    try:
+        vertices = candidates[ConvexHull(points[candidates]).vertices]
+    except Exception:
+        return []
+    if max_vertices:
+        vertices = simplify_hull(vertices, points, max_vertices)
+    return np.asarray(indices)[vertices].tolist()
+
+
+def cluster_hulls(points, offsets, flat_indices, ids=None, max_vertices=None, workers=None):
+    """
+    Compute the hull of every cluster in parallel.
+    points is the (N, 2) array of coordinates and (offsets, flat_indices) the grouped rows of each cluster
+    as returned by latentscope.util.clusters.group_indices.
+    Returns one list of row positions per cluster, or of the matching ids if given (e.g. ls_index).
+    """
+    import numpy as np
+    from concurrent.futures import ThreadPoolExecutor
+    flat_indices = np.asarray(flat_indices)
+    ids = None if ids is None else np.asarray(ids)
+    # gather once so each cluster is a contiguous slice
+    grouped = np.asarray(points)[flat_indices]
+
+    def hull(i):
+        start, end = offsets[i], offsets[i+1]
+        members = flat_indices[start:end]
+        return hull_indices(grouped[start:end], members if ids is None else ids[members], max_vertices)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(hull, range(len(offsets) - 1)))
+
+
+def recalculate_hulls(df, clusters, max_vertices=None, touched=None):
+    """
+    Recompute the hulls in a scope's cluster lookup from the scope dataframe, in parallel.
+    If touched is given only the hulls of those clusters are recomputed.
+    """
+    import numpy as np
+    from latentscope.util.clusters import group_indices
+    cluster = df['cluster'].to_numpy()
+    rows = np.arange(len(df)) if touched is None else np.flatnonzero(np.isin(cluster, touched))
+    cluster_ids, offsets, flat_indices = group_indices(cluster[rows])
+    # group_indices gives positions within the selected rows, map them back to positions in df
+    hulls = cluster_hulls(df[['x', 'y']].to_numpy(), offsets, rows[flat_indices], ids=df['ls_index'].to_numpy(), max_vertices=max_vertices)
+    hull_lookup = dict(zip(cluster_ids.tolist(), hulls))
+    touched = None if touched is None else set(np.asarray(touched).tolist())
+    for c in clusters:
+        if touched is None or c["cluster"] in touched:
+            c["hull"] = hull_lookup.get(c["cluster"], [])
@@ -0,0 +1,283 @@
+"""
+BM25 full text search over the text column of a dataset, for keyword queries and for fusing with vector search.
+
+The index lives in <dataset>/lexical-index/: index.json lists its segments and each segment-NNN/ directory
+is an inverted index of a contiguous range of rows:
+    terms.txt           the segment's vocabulary, sorted, one term per line
+    offsets.npy         int64, the postings of term t are at offsets[t]:offsets[t + 1]
+    postings.npy        uint16 or uint32, row of each posting relative to the first row of the segment, sorted within a term
+    frequencies.npy     uint8 or uint16, how many times the term occurs in that row
+    lengths.npy         uint32, the number of tokens of each row
+The arrays are memory-mapped when searching, only the vocabularies are held in memory.
+
+Rows appended to the input are indexed as a new segment without touching the existing ones,
+segments are merged once there are more than MAX_SEGMENTS of them.
+"""
+import os
+import re
+import json
+import time
+import shutil
+
+# the BM25 parameters used by Lucene and most search engines
+K1 = 1.2
+B = 0.75
+MAX_SEGMENTS = 8
+TOKEN = re.compile(r"\w+")
+
+
+def index_dir(dataset_dir):
+    return os.path.join(dataset_dir, "lexical-index")
+
+
+def tokenize(text):
+    """Lowercase word tokens of a string, the same for indexing and for queries"""
+    if not isinstance(text, str):
+        text = "" if text is None or text != text else str(text)
+    return TOKEN.findall(text.lower())
+
+
+def read_index_meta(dataset_dir):
+    """The index.json of a dataset's lexical index, or None if it hasn't been built"""
+    path = os.path.join(index_dir(dataset_dir), "index.json")
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_index_meta(dataset_dir, meta):
+    path = os.path.join(index_dir(dataset_dir), "index.json")
+    with open(path + ".tmp", "w") as f:
+        json.dump(meta, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+class Segment:
+    """The inverted index of rows start to start + rows"""
+    def __init__(self, directory, start):
+        import numpy as np
+        self.directory = directory
+        self.start = start
+        with open(os.path.join(directory, "terms.txt"), encoding="utf-8") as f:
+            terms = f.read().split("\n") if os.path.getsize(os.path.join(directory, "terms.txt")) else []
+        self.terms = {term: i for i, term in enumerate(terms)}
+        self.offsets = np.load(os.path.join(directory, "offsets.npy"))
+        self.postings = np.load(os.path.join(directory, "postings.npy"), mmap_mode="r")
+        self.frequencies = np.load(os.path.join(directory, "frequencies.npy"), mmap_mode="r")
+        self.lengths = np.load(os.path.join(directory, "lengths.npy"), mmap_mode="r")
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def postings_of(self, term):
+        """(rows relative to the segment, frequencies) of a term, empty if the segment doesn't have it"""
+        t = self.terms.get(term)
+        if t is None:
+            return self.postings[:0], self.frequencies[:0]
+        return self.postings[self.offsets[t]:self.offsets[t + 1]], self.frequencies[self.offsets[t]:self.offsets[t + 1]]
+
+
+def write_segment(directory, terms, offsets, postings, frequencies, lengths):
+    """Write a segment's arrays, terms must be sorted and offsets index postings and frequencies by term"""
+    import numpy as np
+    os.makedirs(directory)
+    with open(os.path.join(directory, "terms.txt"), "w", encoding="utf-8") as f:
+        f.write("\n".join(terms))
+    np.save(os.path.join(directory, "offsets.npy"), np.asarray(offsets, dtype=np.int64))
+    # the narrowest type that fits: rows of segments of up to 65536 rows and frequencies under 256 take less
+    np.save(os.path.join(directory, "postings.npy"), np.asarray(postings, dtype=np.uint16 if len(lengths) <= 2**16 else np.uint32))
+    frequencies = np.minimum(np.asarray(frequencies, dtype=np.int64), np.iinfo(np.uint16).max)
+    np.save(os.path.join(directory, "frequencies.npy"), frequencies.astype(np.uint8 if len(frequencies) and frequencies.max() < 2**8 else np.uint16))
+    np.save(os.path.join(directory, "lengths.npy"), np.asarray(lengths, dtype=np.uint32))
+
+
+def build_segment(directory, texts):
+    """Tokenize an iterable of texts (one per row) into a new segment directory, returns the number of rows"""
+    import numpy as np
+    from array import array
+    from scipy.sparse import csc_matrix
+    vocabulary = {}
+    # 8 bytes per token rather than a list of python ints
+    term_ids, lengths = array("q"), array("q")
+    for text in texts:
+        tokens = tokenize(text)
+        term_ids.extend(vocabulary.setdefault(token, len(vocabulary)) for token in tokens)
+        lengths.append(len(tokens))
+    term_ids = np.frombuffer(term_ids, dtype=np.int64)
+    lengths = np.frombuffer(lengths, dtype=np.int64)
+    rows = np.repeat(np.arange(len(lengths)), lengths)
+    # a row by term matrix sums repeated tokens into frequencies, and its columns are the postings of each term
+    matrix = csc_matrix((np.ones(len(term_ids), dtype=np.int64), (rows, term_ids)), shape=(len(lengths), len(vocabulary)))
+    matrix.sum_duplicates()
+    terms = sorted(vocabulary)
+    matrix = matrix[:, np.array([vocabulary[term] for term in terms], dtype=np.int64)]
+    matrix.sort_indices()
+    write_segment(directory, terms, matrix.indptr, matrix.indices, matrix.data, lengths)
+    return len(lengths)
+
+
+def merge_segments(directory, segments):
+    """Merge segments of consecutive rows, in order, into one new segment directory"""
+    import numpy as np
+    base = segments[0].start
+    terms = sorted(set().union(*[segment.terms for segment in segments]))
+    ids = {term: i for i, term in enumerate(terms)}
+    term_ids, postings, frequencies = [], [], []
+    for segment in segments:
+        # the merged id of the term of every posting of the segment
+        mapping = np.array([ids[term] for term in segment.terms], dtype=np.int64)
+        term_ids.append(np.repeat(mapping, np.diff(segment.offsets)))
+        postings.append(np.asarray(segment.postings, dtype=np.int64) + (segment.start - base))
+        frequencies.append(np.asarray(segment.frequencies))
+    term_ids = np.concatenate(term_ids)
+    # segments are in row order so a stable sort by term keeps the rows of each term sorted
+    order = np.argsort(term_ids, kind="stable")
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(term_ids, minlength=len(terms)))])
+    write_segment(directory, terms, offsets, np.concatenate(postings)[order], np.concatenate(frequencies)[order],
+        np.concatenate([np.asarray(segment.lengths) for segment in segments]))
+
+
+def read_texts(input_file, text_column, start=0, batch_size=65536):
+    """The text column of the input's rows from start on, read in batches"""
+    import pyarrow.parquet as pq
+    row = 0
+    for batch in pq.ParquetFile(input_file).iter_batches(batch_size=batch_size, columns=[text_column]):
+        if row + len(batch) > start:
+            yield from batch.column(0).to_pylist()[max(start - row, 0):]
+        row += len(batch)
+
+
+class LexicalIndex:
+    """
+    BM25 search over the segments of a dataset's lexical index.
+    Scores are accumulated per query term from its postings in every segment, with the document frequencies
+    and average row length of the whole index, so they don't depend on how the rows are split into segments.
+    """
+    def __init__(self, meta, segments):
+        self.meta = meta
+        self.segments = segments
+        self.rows = sum(len(segment) for segment in segments)
+        self.average_length = meta["tokens"] / max(self.rows, 1)
+
+    @classmethod
+    def load(cls, dataset_dir):
+        meta = read_index_meta(dataset_dir)
+        if meta is None:
+            raise FileNotFoundError(f"No lexical index in {dataset_dir}, build it with ls-ingest-index")
+        segments = [Segment(os.path.join(index_dir(dataset_dir), s["id"]), s["start"]) for s in meta["segments"]]
+        return cls(meta, segments)
+
+    def __len__(self):
+        return self.rows
+
+    def scores(self, query, mask=None):
+        """The rows matching any term of the query and their BM25 scores, only among the rows of the boolean mask if given"""
+        import numpy as np
+        rows, weights = [], []
+        for term in set(tokenize(query)):
+            found = [(segment, *segment.postings_of(term)) for segment in self.segments]
+            frequency = sum(len(postings) for _, postings, _ in found)
+            if not frequency:
+                continue
+            idf = np.log(1 + (self.rows - frequency + 0.5) / (frequency + 0.5))
+            for segment, postings, frequencies in found:
+                if not len(postings):
+                    continue
+                postings = np.asarray(postings, dtype=np.int64)
+                tf = np.asarray(frequencies, dtype=np.float32)
+                norm = K1 * (1 - B + B * np.asarray(segment.lengths[postings], dtype=np.float32) / self.average_length)
+                rows.append(postings + segment.start)
+                weights.append(idf * tf * (K1 + 1) / (tf + norm))
+        if not rows:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.float32)
+        rows, weights = np.concatenate(rows), np.concatenate(weights)
+        if mask is not None:
+            keep = mask[rows]
+            rows, weights = rows[keep], weights[keep]
+        if len(rows) > self.rows // 8:
+            # common terms: accumulate into a dense array
+            totals = np.bincount(rows, weights=weights, minlength=self.rows)
+            rows = np.flatnonzero(totals)
+            return rows, totals[rows].astype(np.float32)
+        rows, inverse = np.unique(rows, return_inverse=True)
+        return rows, np.bincount(inverse.ravel(), weights=weights).astype(np.float32)
+
+    def search(self, query, k=150, mask=None):
+        """The k best matching rows for a query and their scores, by descending score"""
+        import numpy as np
+        rows, scores = self.scores(query, mask)
+        if len(rows) > k:
+            keep = np.argpartition(-scores, k - 1)[:k]
+            rows, scores = rows[keep], scores[keep]
+        order = np.lexsort((rows, -scores))
+        return rows[order], scores[order]
+
+
+def build_index(dataset_dir, text_column=None, rebuild=False):
+    """
+    Index the text column of a dataset's input.parquet, by default the text_column of its meta.json.
+    Only the rows added since the index was last built are indexed, as a new segment, unless rebuild is set
+    or the text column or the number of rows has gone down (the input was replaced), which rebuilds it from scratch.
+    Returns the index metadata, with the number of rows indexed by this call in "added".
+    """
+    import pyarrow.parquet as pq
+    input_file = os.path.join(dataset_dir, "input.parquet")
+    if text_column is None:
+        with open(os.path.join(dataset_dir, "meta.json")) as f:
+            text_column = json.load(f).get("text_column")
+    if text_column is None:
+        raise ValueError(f"No text column to index in {dataset_dir}")
+    rows = pq.ParquetFile(input_file).metadata.num_rows
+    directory = index_dir(dataset_dir)
+    meta = read_index_meta(dataset_dir)
+    if rebuild or meta is None or meta["text_column"] != text_column or meta["rows"] > rows:
+        if os.path.exists(directory):
+            shutil.rmtree(directory)
+        meta = None
+    if meta is None:
+        os.makedirs(directory)
+        meta = {"type": "bm25", "text_column": text_column, "rows": 0, "tokens": 0, "segments": [], "next_segment": 0}
+    if meta["rows"] == rows:
+        meta["added"] = 0
+        return meta
+
+    start = time.time()
+    segment_id = f"segment-{meta['next_segment']:03d}"
+    added = build_segment(os.path.join(directory, segment_id), read_texts(input_file, text_column, meta["rows"]))
+    segment = Segment(os.path.join(directory, segment_id), meta["rows"])
+    meta["segments"].append({"id": segment_id, "start": meta["rows"], "rows": added})
+    meta["rows"] += added
+    meta["added"] = added
+    meta["tokens"] += int(segment.lengths.sum())
+    meta["next_segment"] += 1
+
+    if len(meta["segments"]) > MAX_SEGMENTS:
+        merged_id = f"segment-{meta['next_segment']:03d}"
+        merge_segments(os.path.join(directory, merged_id),
+            [Segment(os.path.join(directory, s["id"]), s["start"]) for s in meta["segments"]])
+        old = meta["segments"]
+        meta["segments"] = [{"id": merged_id, "start": 0, "rows": meta["rows"]}]
+        meta["next_segment"] += 1
+    else:
+        old = []
+    meta["build_seconds"] = time.time() - start
+    write_index_meta(dataset_dir, meta)
+    # only remove merged segments once index.json no longer points at them
+    for s in old:
+        shutil.rmtree(os.path.join(directory, s["id"]))
+    return meta
+
+
+def reciprocal_rank_fusion(rankings, k=150, constant=60):
+    """
+    Fuse ranked lists of rows by summing 1 / (constant + rank) over the lists each row appears in.
+    Returns the k best rows and their fused scores.
+    """
+    import numpy as np
+    rows = np.concatenate([np.asarray(ranking, dtype=np.int64) for ranking in rankings])
+    scores = np.concatenate([1 / (constant + 1 + np.arange(len(ranking))) for ranking in rankings])
+    rows, inverse = np.unique(rows, return_inverse=True)
+    scores = np.bincount(inverse.ravel(), weights=scores, minlength=len(rows))
+    order = np.lexsort((rows, -scores))[:k]
+    return rows[order], scores[order]
@@ -0,0 +1,51 @@
+import time
+import random
+import threading
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket rate limiter.
+    Allows `rate` acquisitions per second on average with bursts of up to `capacity`.
+    A rate of None or 0 disables limiting.
+    """
+    def __init__(self, rate=None, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1, rate or 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        if not self.rate:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def retry_with_backoff(fn, max_retries=5, base_delay=1.0, max_delay=60.0, on_retry=None):
+    """
+    Call fn until it succeeds, sleeping with jittered exponential backoff between attempts.
+    The last exception is raised once max_retries retries have failed.
+    on_retry(attempt, exception, delay) is called before each sleep.
+    """
+    attempt = 0
+    while True:
+        try:
+            return fn()
+        except Exception as e:
+            if attempt >= max_retries:
+                raise
+            delay = min(max_delay, base_delay * 2 ** attempt) * random.uniform(0.5, 1.0)
+            if on_retry is not None:
+                on_retry(attempt, e, delay)
+            time.sleep(delay)
+            attempt += 1
@@ -0,0 +1,384 @@
+"""
+Reading scopes.
+A scope parquet has one row per (non deleted) input row, with ls_index being the row's position in input.parquet,
+so the two files line up by position and we never need a materialized copy of the input to read them together.
+
+Edits made in the app aren't written to the scope parquet right away, they are appended to an overlay
+(<scope>-edits.jsonl) that is applied whenever the scope is read and periodically compacted into the parquet.
+Each line is one edit:
+{"action": "change_cluster", "row_ids": [...], "cluster": 3, "label": "..."}
+{"action": "change_cluster_name", "cluster": 3, "label": "..."}
+{"action": "delete_rows", "row_ids": [...]}
+"""
+import os
+import json
+import threading
+
+# columns an edit can touch, they are always read when edits have to be applied
+EDIT_COLUMNS = ["ls_index", "cluster", "label"]
+
+_locks = {}
+_locks_lock = threading.Lock()
+
+
+def scope_lock(scope_file):
+    """Lock serializing the edits and compaction of a scope within this process"""
+    with _locks_lock:
+        return _locks.setdefault(os.path.abspath(scope_file), threading.RLock())
+
+
+def edits_file(scope_file):
+    return scope_file[:-len(".parquet")] + "-edits.jsonl"
+
+
+def read_edits(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def count_edits(path):
+    """Number of edits in an overlay, counted without parsing them"""
+    if not os.path.exists(path):
+        return 0
+    with open(path, "rb") as f:
+        return sum(block.count(b"\n") for block in iter(lambda: f.read(1 << 20), b""))
+
+
+def append_edit(path, edit):
+    with open(path, "a") as f:
+        f.write(json.dumps(edit) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def apply_edits(df, edits):
+    """Apply overlay edits in order to a scope DataFrame, returns the edited DataFrame"""
+    import numpy as np
+    for edit in edits:
+        if edit["action"] == "change_cluster":
+            rows = np.isin(df["ls_index"].to_numpy(), edit["row_ids"])
+            df.loc[rows, "cluster"] = edit["cluster"]
+            df.loc[rows, "label"] = edit["label"]
+        elif edit["action"] == "change_cluster_name":
+            df.loc[df["cluster"].to_numpy() == edit["cluster"], "label"] = edit["label"]
+        elif edit["action"] == "delete_rows":
+            df = df[~np.isin(df["ls_index"].to_numpy(), edit["row_ids"])].reset_index(drop=True)
+        else:
+            raise ValueError(f"Unknown scope edit: {edit['action']}")
+    return df
+
+
+def build_scope_table(dataset_dir, umap_id, cluster_id, cluster_labels_id):
+    """
+    Assemble a scope from its umap, cluster and cluster labels files with columnar operations.
+    Returns the scope table (x, y, cluster, raw_cluster, label, ls_index) and the cluster labels lookup,
+    one dict per cluster with everything but the indices.
+    """
+    import numpy as np
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+    from latentscope.util.clusters import read_cluster_labels
+    # the indices column isn't needed here so we skip reading it entirely
+    cluster_labels_df = read_cluster_labels(os.path.join(dataset_dir, "clusters", cluster_labels_id + ".parquet"))
+    # the label of cluster i is in row i, we keep the array around to look up each row's label below
+    cluster_label_array = pa.array(cluster_labels_df["label"].to_numpy(dtype=object), type=pa.string())
+
+    cluster_labels_df = cluster_labels_df.drop(columns=[col for col in ["indices", "labeled", "label_raw"] if col in cluster_labels_df.columns])
+    # change hulls to a list of lists
+    cluster_labels_df["hull"] = cluster_labels_df["hull"].apply(lambda x: x.tolist())
+    cluster_labels_df["cluster"] = cluster_labels_df.index
+    lookup = cluster_labels_df.to_dict(orient="records")
+
+    # only read the columns we need
+    umap_table = pq.read_table(os.path.join(dataset_dir, "umaps", umap_id + ".parquet"), columns=["x", "y"])
+    cluster_table = pq.read_table(os.path.join(dataset_dir, "clusters", cluster_id + ".parquet"), columns=["cluster", "raw_cluster"])
+    # the label of each row is a take on the label array with the row's cluster as index
+    labels = pc.take(cluster_label_array, cluster_table.column("cluster"))
+    scope_table = pa.Table.from_arrays(
+        umap_table.columns + cluster_table.columns + [labels, pa.array(np.arange(umap_table.num_rows))],
+        names=umap_table.column_names + cluster_table.column_names + ["label", "ls_index"]
+    )
+    return scope_table, lookup
+
+
+def touched_clusters(df, edit):
+    """Return the clusters whose rows change with an edit (renaming a cluster doesn't change any)"""
+    import numpy as np
+    if edit["action"] not in ("change_cluster", "delete_rows"):
+        return np.array([], dtype=np.int64)
+    clusters = df["cluster"].to_numpy()[np.isin(df["ls_index"].to_numpy(), edit["row_ids"])]
+    if edit["action"] == "change_cluster":
+        clusters = np.append(clusters, edit["cluster"])
+    return np.unique(clusters)
+
+
+def read_scope_table(scope_file, columns=None):
+    """Read a scope parquet as an Arrow table with its pending edits applied"""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    # edits change the cached state in place while holding the lock
+    with scope_lock(scope_file):
+        state = cached_scope_state(scope_file)
+        if state is not None:
+            return pa.Table.from_pandas(state.frame(columns), preserve_index=False)
+    edits = read_edits(edits_file(scope_file))
+    if not edits:
+        return pq.read_table(scope_file, columns=columns)
+    read_columns = None if columns is None else list(dict.fromkeys(list(columns) + EDIT_COLUMNS))
+    df = apply_edits(pq.read_table(scope_file, columns=read_columns).to_pandas(), edits)
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    return table if columns is None else table.select(columns)
+
+
+def read_scope(scope_file, columns=None):
+    """Read a scope parquet as a DataFrame with its pending edits applied"""
+    return read_scope_table(scope_file, columns).to_pandas()
+
+
+def compact_scope(scope_file):
+    """Write the pending edits of a scope into its parquet and clear the overlay"""
+    import pyarrow.parquet as pq
+    with scope_lock(scope_file):
+        path = edits_file(scope_file)
+        if not count_edits(path):
+            return False
+        state = cached_scope_state(scope_file)
+        table = read_scope_table(scope_file)
+        # write next to the parquet and swap it in so readers never see a partial file
+        pq.write_table(table, scope_file + ".tmp")
+        os.replace(scope_file + ".tmp", scope_file)
+        os.remove(path)
+        if state is not None:
+            # the cached state is exactly what we just wrote
+            state.key = scope_key(scope_file)
+        return True
+
+
+class ScopeState:
+    """
+    In memory copy of a scope with its edits applied, kept between requests by the server.
+    Rows never move: deleted rows are only marked as such, so a row's position stays valid and edits are
+    positional scatters through the ls_index -> position index instead of scans over the whole scope.
+    The rows of each cluster are kept up to date so hulls can be recomputed for just the touched clusters.
+    """
+    def __init__(self, df):
+        import numpy as np
+        from latentscope.util.clusters import group_indices
+        self.df = df.reset_index(drop=True)
+        self.alive = np.ones(len(self.df), dtype=bool)
+        self.ls_index = self.df["ls_index"].to_numpy()
+        self.points = self.df[["x", "y"]].to_numpy()
+        self.positions = np.full(self.ls_index.max() + 1 if len(self.ls_index) else 0, -1, dtype=np.int64)
+        self.positions[self.ls_index] = np.arange(len(self.ls_index))
+        cluster_ids, offsets, flat_indices = group_indices(self.df["cluster"].to_numpy())
+        self.members = {int(c): flat_indices[offsets[i]:offsets[i+1]] for i, c in enumerate(cluster_ids)}
+        # (parquet mtime, overlay size) of the files this state corresponds to
+        self.key = None
+
+    def __len__(self):
+        return int(self.alive.sum())
+
+    def locate(self, ls_indices):
+        """Positions of the given rows that are in the scope"""
+        import numpy as np
+        ls_indices = np.asarray(ls_indices, dtype=np.int64)
+        ls_indices = ls_indices[(ls_indices >= 0) & (ls_indices < len(self.positions))]
+        positions = self.positions[ls_indices]
+        return np.unique(positions[positions >= 0])
+
+    def remove_members(self, positions):
+        import numpy as np
+        clusters = self.df["cluster"].to_numpy()[positions]
+        for c in np.unique(clusters).tolist():
+            self.members[c] = np.setdiff1d(self.members[c], positions[clusters == c], assume_unique=True)
+        return np.unique(clusters)
+
+    def apply(self, edit):
+        """Apply an overlay edit in place, returns the clusters whose rows changed"""
+        import numpy as np
+        cluster_column = self.df.columns.get_loc("cluster")
+        label_column = self.df.columns.get_loc("label")
+        if edit["action"] == "change_cluster":
+            positions = self.locate(edit["row_ids"])
+            touched = np.union1d(self.remove_members(positions), [edit["cluster"]])
+            self.members[edit["cluster"]] = np.union1d(self.members.get(edit["cluster"], np.array([], dtype=np.int64)), positions)
+            self.df.iloc[positions, cluster_column] = edit["cluster"]
+            self.df.iloc[positions, label_column] = edit["label"]
+            return touched
+        if edit["action"] == "change_cluster_name":
+            self.df.iloc[self.members.get(edit["cluster"], []), label_column] = edit["label"]
+            return np.array([], dtype=np.int64)
+        if edit["action"] == "delete_rows":
+            positions = self.locate(edit["row_ids"])
+            touched = self.remove_members(positions)
+            self.alive[positions] = False
+            self.positions[self.ls_index[positions]] = -1
+            return touched
+        raise ValueError(f"Unknown scope edit: {edit['action']}")
+
+    def frame(self, columns=None):
+        """The scope (or some of its columns) as a DataFrame without the deleted rows"""
+        df = self.df if columns is None else self.df[list(columns)]
+        if self.alive.all():
+            return df
+        return df[self.alive].reset_index(drop=True)
+
+    def update_hulls(self, clusters, max_vertices=None, touched=None):
+        """Recompute the hulls in the cluster lookup, only for the touched clusters if given"""
+        import numpy as np
+        from latentscope.util.hulls import cluster_hulls
+        ids = list(self.members.keys()) if touched is None else [int(c) for c in touched]
+        groups = [self.members.get(c, np.array([], dtype=np.int64)) for c in ids]
+        offsets = np.zeros(len(groups) + 1, dtype=np.int64)
+        np.cumsum([len(g) for g in groups], out=offsets[1:])
+        flat_indices = np.concatenate(groups) if groups else np.array([], dtype=np.int64)
+        hull_lookup = dict(zip(ids, cluster_hulls(self.points, offsets, flat_indices, ids=self.ls_index, max_vertices=max_vertices)))
+        for c in clusters:
+            if touched is None or c["cluster"] in hull_lookup:
+                c["hull"] = hull_lookup.get(c["cluster"], [])
+
+
+_states = {}
+
+
+def scope_key(scope_file):
+    edits = edits_file(scope_file)
+    return (os.stat(scope_file).st_mtime_ns, os.path.getsize(edits) if os.path.exists(edits) else 0)
+
+
+def cached_scope_state(scope_file):
+    """The cached state of a scope if there is one and its files haven't changed since"""
+    with _locks_lock:
+        state = _states.get(os.path.abspath(scope_file))
+    if state is not None and state.key == scope_key(scope_file):
+        return state
+    return None
+
+
+def scope_state(scope_file):
+    """
+    The in memory state of a scope, loaded on first use and reloaded whenever the parquet or overlay changed
+    behind our back (e.g. ls-scope rebuilt it). Callers that edit it should hold the scope's lock and
+    refresh state.key after writing the edit to the overlay.
+    """
+    state = cached_scope_state(scope_file)
+    if state is None:
+        key = scope_key(scope_file)
+        with _locks_lock:
+            _states.pop(os.path.abspath(scope_file), None)
+        state = ScopeState(read_scope(scope_file))
+        state.key = key
+        with _locks_lock:
+            _states[os.path.abspath(scope_file)] = state
+    return state
+
+
+def read_rows(parquet_file, rows, columns=None):
+    """
+    Read the given rows (in the given order) of a parquet file, decoding only the row groups that contain them
+    so a page of rows costs about the same whatever the size of the file
+    """
+    import numpy as np
+    import pyarrow.parquet as pq
+    rows = np.asarray(rows, dtype=np.int64)
+    f = pq.ParquetFile(parquet_file)
+    sizes = [f.metadata.row_group(i).num_rows for i in range(f.num_row_groups)]
+    starts = np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64)
+    groups = np.unique(np.searchsorted(starts, rows, side="right") - 1)
+    table = f.read_row_groups(groups.tolist(), columns=columns)
+    # position of each row in the concatenation of the groups that were read
+    offsets = np.concatenate([[0], np.cumsum([sizes[g] for g in groups])]).astype(np.int64)
+    group_of = np.searchsorted(groups, np.searchsorted(starts, rows, side="right") - 1)
+    return table.take(offsets[group_of] + rows - starts[groups[group_of]])
+
+
+class ScopeView:
+    """
+    Lazily evaluated join of input.parquet with a scope's columns.
+    Nothing is read until to_table/to_pandas is called, and then only the requested columns and rows.
+    The columns are "index" (the ls_index of each row), the input columns and the scope columns,
+    which get an "_ls" suffix when they clash with an input column.
+    """
+    def __init__(self, dataset_id, scope_id, data_dir=None):
+        if data_dir is None:
+            from latentscope.util import get_data_dir
+            data_dir = get_data_dir()
+        self.input_file = os.path.join(data_dir, dataset_id, "input.parquet")
+        self.scope_file = os.path.join(data_dir, dataset_id, "scopes", scope_id + ".parquet")
+
+    def column_map(self):
+        """Map each column of the view to its (source, column) pair, source being "input" or "scope"."""
+        import pyarrow.parquet as pq
+        input_columns = [name for name in pq.read_schema(self.input_file).names if not name.startswith("__index_level_")]
+        scope_columns = [name for name in pq.read_schema(self.scope_file).names if not name.startswith("__index_level_")]
+        columns = {"index": ("scope", "ls_index")}
+        columns.update({name: ("input", name) for name in input_columns})
+        for name in scope_columns:
+            if name == "ls_index":
+                continue
+            columns[name + "_ls" if name in columns else name] = ("scope", name)
+        return columns
+
+    @property
+    def columns(self):
+        return list(self.column_map().keys())
+
+    def ls_index(self):
+        return read_scope_table(self.scope_file, columns=["ls_index"]).column("ls_index").to_numpy()
+
+    def __len__(self):
+        return len(self.ls_index())
+
+    def to_table(self, columns=None, indices=None):
+        """
+        Read the view as an Arrow table.
+        columns limits the columns that are read (defaults to all of them).
+        indices selects rows by ls_index in the given order, indices that aren't in the scope (e.g. deleted rows) are skipped.
+        """
+        import numpy as np
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        column_map = self.column_map()
+        if columns is None:
+            columns = list(column_map.keys())
+        missing = [name for name in columns if name not in column_map]
+        if missing:
+            raise KeyError(f"Columns not in scope view: {missing}")
+        input_columns = list(dict.fromkeys(column_map[name][1] for name in columns if column_map[name][0] == "input"))
+        scope_columns = list(dict.fromkeys(["ls_index"] + [column_map[name][1] for name in columns if column_map[name][0] == "scope"]))
+
+        scope_table = read_scope_table(self.scope_file, columns=scope_columns)
+        ls_index = scope_table.column("ls_index").to_numpy()
+        if indices is not None:
+            # ls_index stays sorted when rows are deleted, so we can find each row's position with a binary search
+            indices = np.asarray(indices, dtype=np.int64)
+            positions = np.searchsorted(ls_index, indices)
+            found = positions < len(ls_index)
+            found[found] = ls_index[positions[found]] == indices[found]
+            scope_table = scope_table.take(positions[found])
+            ls_index = indices[found]
+
+        if input_columns:
+            if indices is not None:
+                input_table = read_rows(self.input_file, ls_index, columns=input_columns)
+            else:
+                input_table = pq.read_table(self.input_file, columns=input_columns)
+                if len(ls_index) != input_table.num_rows:
+                    input_table = input_table.take(ls_index)
+        else:
+            input_table = pa.table({})
+
+        arrays = [input_table.column(column_map[name][1]) if column_map[name][0] == "input" else scope_table.column(column_map[name][1]) for name in columns]
+        return pa.Table.from_arrays(arrays, names=columns)
+
+    def to_pandas(self, columns=None, indices=None):
+        return self.to_table(columns, indices).to_pandas()
+
+    def export(self, path):
+        """Materialize the full view to a parquet file"""
+        import pyarrow.parquet as pq
+        pq.write_table(self.to_table(), path)
+        return path
@@ -0,0 +1,218 @@
+"""
+Selections are boolean expressions over the rows of a dataset, evaluated on the server so the client
+doesn't have to fetch and intersect the index lists of every tag, cluster, filter and search itself:
+
+    tag:👍 AND cluster:12 AND filter(score > 0.5) AND NOT tag:👎
+
+Terms:
+    tag:<name>                  rows with the tag, quote names with spaces or parentheses: tag:"to review"
+    cluster:<id>                rows of a cluster of the scope
+    filter(<column> <op> <value>)
+                                rows whose column matches, op is one of == != > < >= <= in contains
+                                (or the column filter names eq, gt, lt, gte, lte), the value is JSON or a bare word
+    search(<query>)             nearest neighbors of a query string
+
+NOT binds tightest, then AND, then OR, and parentheses group as usual. Keywords are case insensitive.
+Every term evaluates to a bitmap: a boolean numpy array with one entry per row of the input.
+"""
+import re
+
+# the symbols accepted in filter(...) and the column filter types they stand for
+FILTER_OPERATORS = {
+    "==": "eq", "!=": "ne", ">=": "gte", "<=": "lte", ">": "gt", "<": "lt",
+    "eq": "eq", "ne": "ne", "gt": "gt", "lt": "lt", "gte": "gte", "lte": "lte", "in": "in", "contains": "contains",
+}
+TERM_KINDS = ["tag", "cluster"]
+FUNCTION_KINDS = ["filter", "search"]
+
+
+class SelectionError(ValueError):
+    pass
+
+
+def filter_mask(values, type, value):
+    """Boolean mask of the rows of a pandas Series matching a column filter"""
+    import numpy as np
+    if type == "eq":
+        mask = values == value
+    elif type == "ne":
+        mask = values != value
+    elif type == "gt":
+        mask = values > value
+    elif type == "lt":
+        mask = values < value
+    elif type == "gte":
+        mask = values >= value
+    elif type == "lte":
+        mask = values <= value
+    elif type == "in":
+        mask = values.isin(value if isinstance(value, list) else [value])
+    elif type == "contains":
+        mask = values.str.contains(value, na=False)
+    else:
+        raise SelectionError(f"Unknown filter type {type}")
+    return np.asarray(mask.fillna(False), dtype=bool)
+
+
+def read_quoted(text, i):
+    """Read the double quoted string starting at text[i], returns the unescaped string and the position after it"""
+    import json
+    j = i + 1
+    while j < len(text) and text[j] != '"':
+        j += 2 if text[j] == "\\" else 1
+    if j >= len(text):
+        raise SelectionError(f"Unterminated string at {i}")
+    return json.loads(text[i:j + 1]), j + 1
+
+
+def tokenize(text):
+    """Split an expression into ("(", None), (")", None), ("and"|"or"|"not", None) and ("term", (kind, argument)) tokens"""
+    tokens = []
+    i = 0
+    while i < len(text):
+        if text[i].isspace():
+            i += 1
+            continue
+        if text[i] in "()":
+            tokens.append((text[i], None))
+            i += 1
+            continue
+        word = re.match(r"[A-Za-z_]+", text[i:])
+        word = word.group(0).lower() if word else ""
+        rest = text[i + len(word):]
+        if word in ("and", "or", "not") and (not rest or rest[0].isspace() or rest[0] in "()"):
+            tokens.append((word, None))
+            i += len(word)
+        elif word in TERM_KINDS and rest.startswith(":"):
+            i += len(word) + 1
+            if i < len(text) and text[i] == '"':
+                argument, i = read_quoted(text, i)
+            else:
+                end = re.compile(r"[\s()]|$").search(text, i).start()
+                argument, i = text[i:end], end
+            if not argument:
+                raise SelectionError(f"Missing value after {word}:")
+            tokens.append(("term", (word, argument)))
+        elif word in FUNCTION_KINDS and rest.startswith("("):
+            # everything up to the matching parenthesis outside of quotes is the argument
+            start = j = i + len(word) + 1
+            depth = 1
+            while j < len(text):
+                if text[j] == '"':
+                    _, j = read_quoted(text, j)
+                    continue
+                depth += {"(": 1, ")": -1}.get(text[j], 0)
+                if depth == 0:
+                    break
+                j += 1
+            if depth:
+                raise SelectionError(f"Unclosed {word}(")
+            tokens.append(("term", (word, text[start:j].strip())))
+            i = j + 1
+        else:
+            raise SelectionError(f"Unexpected {text[i:i + 20]!r} at {i}")
+    return tokens
+
+
+def parse(text):
+    """
+    Parse an expression into a tree of ("or", [nodes]), ("and", [nodes]), ("not", node) and ("term", kind, argument)
+    """
+    tokens = tokenize(text)
+    position = 0
+
+    def peek():
+        return tokens[position][0] if position < len(tokens) else None
+
+    def take():
+        nonlocal position
+        position += 1
+        return tokens[position - 1]
+
+    def parse_or():
+        nodes = [parse_and()]
+        while peek() == "or":
+            take()
+            nodes.append(parse_and())
+        return nodes[0] if len(nodes) == 1 else ("or", nodes)
+
+    def parse_and():
+        nodes = [parse_not()]
+        while peek() == "and":
+            take()
+            nodes.append(parse_not())
+        return nodes[0] if len(nodes) == 1 else ("and", nodes)
+
+    def parse_not():
+        if peek() == "not":
+            take()
+            return ("not", parse_not())
+        return parse_atom()
+
+    def parse_atom():
+        token = peek()
+        if token == "(":
+            take()
+            node = parse_or()
+            if peek() != ")":
+                raise SelectionError("Missing )")
+            take()
+            return node
+        if token == "term":
+            kind, argument = take()[1]
+            return ("term", kind, argument)
+        raise SelectionError("Expected a term" if token is None else f"Unexpected {token}")
+
+    if not tokens:
+        raise SelectionError("Empty expression")
+    node = parse_or()
+    if position < len(tokens):
+        raise SelectionError(f"Unexpected {tokens[position][0]} after a complete expression")
+    return node
+
+
+def parse_filter(argument):
+    """Split the argument of filter(...) into the column, the column filter type and the value"""
+    import json
+    if argument.startswith('"'):
+        column, i = read_quoted(argument, 0)
+    else:
+        match = re.match(r"[^\s=!<>]+", argument)
+        if not match:
+            raise SelectionError(f"Missing column in filter({argument})")
+        column, i = match.group(0), match.end()
+    match = re.compile(r"\s*(==|!=|>=|<=|>|<|[A-Za-z]+)\s*").match(argument, i)
+    if not match or match.group(1).lower() not in FILTER_OPERATORS:
+        raise SelectionError(f"Missing or unknown operator in filter({argument}), expected one of {' '.join(FILTER_OPERATORS)}")
+    value = argument[match.end():].strip()
+    if not value:
+        raise SelectionError(f"Missing value in filter({argument})")
+    try:
+        value = json.loads(value)
+    except ValueError:
+        # bare words are strings
+        pass
+    return column, FILTER_OPERATORS[match.group(1).lower()], value
+
+
+def evaluate(node, resolve, universe):
+    """
+    Evaluate a parsed expression to a bitmap.
+    resolve(kind, argument) returns the bitmap of a term and universe is the bitmap of every row that can be selected,
+    NOT is taken relative to it.
+    """
+    import numpy as np
+    terms = {}
+
+    def visit(node):
+        if node[0] == "term":
+            key = node[1:]
+            if key not in terms:
+                terms[key] = resolve(*key)
+            return terms[key]
+        if node[0] == "not":
+            return universe & ~visit(node[1])
+        masks = [visit(child) for child in node[1]]
+        return np.logical_and.reduce(masks) if node[0] == "and" else np.logical_or.reduce(masks)
+
+    return universe & visit(node)
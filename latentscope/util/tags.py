@@ -0,0 +1,317 @@
+"""
+Tags are sets of row indices (ls_index) of a dataset, stored in <dataset>/tags/.
+Each tag is a sorted array of unique int64 indices saved with numpy (<tag>.npy) plus an append-only
+delta (<tag>.delta) of raw int64 records written as rows are tagged and untagged:
+a record i >= 0 adds row i and a record ~i (i.e. -i - 1) removes it.
+The delta is folded into the .npy once it grows as large as the tag itself.
+
+Older versions stored tags as text files with one index per line (<tag>.indices),
+they are converted the first time the tag is read.
+
+Tags read with load_tag are cached per process and revalidated against the size and mtime of their files,
+so a tag is only read again when it was changed by another process.
+"""
+import os
+import threading
+
+# a tag's delta is compacted once it has more records than this or than the tag has rows
+COMPACT_MIN_RECORDS = 4096
+
+_locks = {}
+_locks_lock = threading.Lock()
+
+
+def tag_lock(tagdir, tag):
+    """Lock serializing the writes to a tag within this process"""
+    with _locks_lock:
+        return _locks.setdefault(os.path.abspath(tag_file(tagdir, tag)), threading.RLock())
+
+
+def tag_file(tagdir, tag):
+    return os.path.join(tagdir, tag + ".npy")
+
+
+def delta_file(tagdir, tag):
+    return os.path.join(tagdir, tag + ".delta")
+
+
+def legacy_tag_file(tagdir, tag):
+    return os.path.join(tagdir, tag + ".indices")
+
+
+class TagSet:
+    """The row indices of a tag as a sorted array of unique int64, with vectorized membership and set operations"""
+
+    def __init__(self, indices=None, assume_sorted=False):
+        import numpy as np
+        indices = np.asarray([] if indices is None else indices, dtype=np.int64).ravel()
+        self.indices = indices if assume_sorted else np.unique(indices)
+        # identifies the files the set was read from, see load_tag
+        self.key = None
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __contains__(self, index):
+        import numpy as np
+        i = np.searchsorted(self.indices, index)
+        return bool(i < len(self.indices) and self.indices[i] == index)
+
+    def contains(self, indices):
+        """Boolean mask of which of the given indices are in the tag"""
+        import numpy as np
+        indices = np.asarray(indices, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.indices, indices), max(len(self.indices) - 1, 0))
+        return (self.indices[positions] == indices) if len(self.indices) else np.zeros(indices.shape, dtype=bool)
+
+    def add(self, indices):
+        """Add indices to the tag, returns the ones that weren't in it yet"""
+        import numpy as np
+        new = np.unique(np.asarray(indices, dtype=np.int64))
+        new = new[~self.contains(new)]
+        if len(new):
+            # both are sorted, so this is a linear merge rather than a sort
+            self.indices = np.insert(self.indices, np.searchsorted(self.indices, new), new)
+        return new
+
+    def remove(self, indices):
+        """Remove indices from the tag, returns the ones that were in it"""
+        import numpy as np
+        old = np.unique(np.asarray(indices, dtype=np.int64))
+        old = old[self.contains(old)]
+        if len(old):
+            self.indices = np.delete(self.indices, np.searchsorted(self.indices, old))
+        return old
+
+    def __and__(self, other):
+        return TagSet(self.indices[other.contains(self.indices)], assume_sorted=True)
+
+    def __or__(self, other):
+        union = TagSet(self.indices, assume_sorted=True)
+        union.add(other.indices)
+        return union
+
+    def __sub__(self, other):
+        return TagSet(self.indices[~other.contains(self.indices)], assume_sorted=True)
+
+    def tolist(self):
+        return self.indices.tolist()
+
+
+_listings = {}
+
+
+def list_tags(tagdir):
+    """Names of the tags in a tags directory, including ones not yet converted from .indices files"""
+    if not os.path.exists(tagdir):
+        return []
+    # creating, converting or deleting a tag changes the directory's mtime, updating one in place doesn't
+    mtime = os.stat(tagdir).st_mtime_ns
+    with _locks_lock:
+        listing = _listings.get(os.path.abspath(tagdir))
+    if listing is not None and listing[0] == mtime:
+        return listing[1]
+    tags = set()
+    for f in os.listdir(tagdir):
+        for ext in [".npy", ".indices"]:
+            if f.endswith(ext):
+                tags.add(f[:-len(ext)])
+    tags = sorted(tags)
+    with _locks_lock:
+        _listings[os.path.abspath(tagdir)] = (mtime, tags)
+    return tags
+
+
+def read_legacy_tag(path):
+    """Read a tag from the old text format, one index per line (the file may be empty)"""
+    import numpy as np
+    with open(path) as f:
+        return np.array(f.read().split(), dtype=np.int64)
+
+
+def read_delta(path):
+    """Returns the (added, removed) indices recorded in a tag delta, in the order they were written"""
+    import numpy as np
+    if not os.path.exists(path):
+        return np.array([], dtype=np.int64), np.array([], dtype=bool)
+    records = np.fromfile(path, dtype="<i8")
+    # a torn final write leaves a partial record that fromfile already drops
+    removed = records < 0
+    return np.where(removed, ~records, records), removed
+
+
+def write_tag(tagdir, tag, tagset):
+    """Write the whole tag to its .npy and drop its delta and any legacy file"""
+    import numpy as np
+    with tag_lock(tagdir, tag):
+        path = tag_file(tagdir, tag)
+        with open(path + ".tmp", "wb") as f:
+            np.save(f, tagset.indices)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+        for stale in [delta_file(tagdir, tag), legacy_tag_file(tagdir, tag)]:
+            if os.path.exists(stale):
+                os.remove(stale)
+
+
+def read_tag(tagdir, tag):
+    """Read a tag into a TagSet, converting it from the old .indices format if needed"""
+    import numpy as np
+    with tag_lock(tagdir, tag):
+        path = tag_file(tagdir, tag)
+        if not os.path.exists(path):
+            legacy = legacy_tag_file(tagdir, tag)
+            if not os.path.exists(legacy):
+                raise FileNotFoundError(f"No tag {tag} in {tagdir}")
+            tagset = TagSet(read_legacy_tag(legacy))
+            write_tag(tagdir, tag, tagset)
+            return tagset
+        tagset = TagSet(np.load(path), assume_sorted=True)
+        values, removed = read_delta(delta_file(tagdir, tag))
+        if len(values):
+            # replay in runs of the same operation, the order between runs matters
+            breaks = np.flatnonzero(np.diff(removed)) + 1
+            for run_values, run_removed in zip(np.split(values, breaks), np.split(removed, breaks)):
+                if run_removed[0]:
+                    tagset.remove(run_values)
+                else:
+                    tagset.add(run_values)
+        return tagset
+
+
+def append_tag_delta(tagdir, tag, added=(), removed=()):
+    """Record added and removed indices in the tag's delta, durably, without rewriting the tag"""
+    import numpy as np
+    records = np.concatenate([
+        np.asarray(added, dtype=np.int64),
+        ~np.asarray(removed, dtype=np.int64),
+    ]).astype("<i8")
+    if not len(records):
+        return
+    with tag_lock(tagdir, tag):
+        fd = os.open(delta_file(tagdir, tag), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, records.tobytes())
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def update_tag(tagdir, tag, tagset, add=(), remove=()):
+    """
+    Add and remove indices from a tag that has been read into tagset and persist the change:
+    only the indices that changed are appended to the delta, which gets compacted once it is large.
+    Returns the (added, removed) indices.
+    """
+    with tag_lock(tagdir, tag):
+        added = tagset.add(add)
+        removed = tagset.remove(remove)
+        append_tag_delta(tagdir, tag, added, removed)
+        delta = delta_file(tagdir, tag)
+        records = os.path.getsize(delta) // 8 if os.path.exists(delta) else 0
+        if records > max(COMPACT_MIN_RECORDS, len(tagset)):
+            write_tag(tagdir, tag, tagset)
+        # the cached copy (if this is it) already has the change
+        tagset.key = tag_key(tagdir, tag)
+    return added, removed
+
+
+_tags = {}
+
+
+def tag_key(tagdir, tag):
+    """Changes whenever the tag's files do: the .npy is only ever replaced and the delta only grows"""
+    keys = []
+    for path in [tag_file(tagdir, tag), delta_file(tagdir, tag), legacy_tag_file(tagdir, tag)]:
+        try:
+            stat = os.stat(path)
+            keys.append((stat.st_mtime_ns, stat.st_size))
+        except FileNotFoundError:
+            keys.append(None)
+    return tuple(keys)
+
+
+def load_tag(tagdir, tag):
+    """The cached TagSet of a tag, read again only if its files changed since it was cached"""
+    path = os.path.abspath(tag_file(tagdir, tag))
+    with tag_lock(tagdir, tag):
+        key = tag_key(tagdir, tag)
+        with _locks_lock:
+            tagset = _tags.get(path)
+        if tagset is None or tagset.key != key:
+            tagset = read_tag(tagdir, tag)
+            # reading converts legacy tags, so take the key of what is on disk now
+            tagset.key = tag_key(tagdir, tag)
+            with _locks_lock:
+                _tags[path] = tagset
+        return tagset
+
+
+def create_tag(tagdir, tag):
+    """Create an empty tag unless it already exists"""
+    os.makedirs(tagdir, exist_ok=True)
+    with tag_lock(tagdir, tag):
+        if not os.path.exists(tag_file(tagdir, tag)) and not os.path.exists(legacy_tag_file(tagdir, tag)):
+            write_tag(tagdir, tag, TagSet())
+
+
+def delete_tag(tagdir, tag):
+    with _locks_lock:
+        _tags.pop(os.path.abspath(tag_file(tagdir, tag)), None)
+    with tag_lock(tagdir, tag):
+        for path in [tag_file(tagdir, tag), delta_file(tagdir, tag), legacy_tag_file(tagdir, tag)]:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def encode_runs(indices):
+    """Run-length encode sorted unique indices as a flat [start, length, start, length, ...] list"""
+    import numpy as np
+    indices = np.asarray(indices, dtype=np.int64)
+    if not len(indices):
+        return []
+    breaks = np.flatnonzero(np.diff(indices) != 1) + 1
+    starts = indices[np.concatenate([[0], breaks])]
+    lengths = np.diff(np.concatenate([[0], breaks, [len(indices)]]))
+    return np.column_stack([starts, lengths]).ravel().tolist()
+
+
+def encode_bitmap(indices, length=None):
+    """Base64 of a bitmap with bit i (little endian within each byte) set for every index i"""
+    import base64
+    import numpy as np
+    indices = np.asarray(indices, dtype=np.int64)
+    if length is None:
+        length = int(indices[-1]) + 1 if len(indices) else 0
+    bits = np.zeros(length, dtype=bool)
+    bits[indices] = True
+    return base64.b64encode(np.packbits(bits, bitorder="little").tobytes()).decode("ascii")
+
+
+def decode_bitmap(data, length):
+    """Boolean mask of length rows from a base64 bitmap made by encode_bitmap"""
+    import base64
+    import numpy as np
+    bits = np.unpackbits(np.frombuffer(base64.b64decode(data), dtype=np.uint8), bitorder="little").astype(bool)
+    mask = np.zeros(length, dtype=bool)
+    mask[:min(length, len(bits))] = bits[:length]
+    return mask
+
+
+ENCODINGS = ["json", "runs", "bitmap"]
+
+
+def encode_indices(indices, encoding="json", length=None):
+    """
+    A JSON-able form of sorted indices: the plain list for "json",
+    otherwise a dict with the count and the runs or base64 bitmap of the indices.
+    """
+    if encoding in (None, "", "json"):
+        return indices.tolist()
+    if encoding == "runs":
+        return {"encoding": "runs", "count": len(indices), "runs": encode_runs(indices)}
+    if encoding == "bitmap":
+        length = max(length or 0, int(indices[-1]) + 1 if len(indices) else 0)
+        return {"encoding": "bitmap", "count": len(indices), "length": length, "bitmap": encode_bitmap(indices, length)}
+    raise ValueError(f"Unknown encoding {encoding}, expected one of {', '.join(ENCODINGS)}")
@@ -0,0 +1,235 @@
+"""
+Transaction log of the edits made to a scope.
+Every scope has an append-only <scope>-transactions.jsonl with one transaction per line:
+{"action": "change_cluster", "timestamp": "...", "payload": {...}}
+Scopes from older versions kept the log as a JSON array in <scope>-transactions.json,
+it is still read and comes before any JSONL lines.
+
+The log can rebuild the state of a scope at any position: we start from the scope as built by ls-scope
+(the last "create_scope" transaction) or from a checkpoint and apply the transactions after it.
+"undo" transactions take back the given number of transactions still in effect before them.
+Checkpoints are snapshots of the scope parquet and cluster lookup in <scope>-checkpoints/.
+"""
+import os
+import json
+from datetime import datetime
+
+
+def transactions_file(scope_file):
+    return scope_file[:-len(".parquet")] + "-transactions.jsonl"
+
+
+def legacy_transactions_file(scope_file):
+    return scope_file[:-len(".parquet")] + "-transactions.json"
+
+
+def checkpoints_dir(scope_file):
+    return scope_file[:-len(".parquet")] + "-checkpoints"
+
+
+def append_transaction(scope_file, action, payload):
+    """Append a transaction to the scope's log and make sure it is on disk before returning"""
+    line = json.dumps({
+        "action": action,
+        "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "payload": payload
+    }) + "\n"
+    fd = os.open(transactions_file(scope_file), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        # a single write in append mode, so concurrent writers can't interleave or overwrite each other
+        os.write(fd, line.encode("utf-8"))
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def read_transactions(scope_file):
+    transactions = []
+    legacy = legacy_transactions_file(scope_file)
+    if os.path.exists(legacy):
+        with open(legacy) as f:
+            transactions.extend(json.load(f))
+    path = transactions_file(scope_file)
+    if os.path.exists(path):
+        with open(path) as f:
+            transactions.extend(json.loads(line) for line in f if line.strip())
+    return transactions
+
+
+def effective_transactions(transactions, end=None):
+    """
+    Return the positions of the transactions in transactions[:end] that are still in effect,
+    i.e. made after the scope was last built and not taken back by an undo.
+    """
+    effective = []
+    for i, transaction in enumerate(transactions[:end]):
+        if transaction["action"] == "create_scope":
+            effective = []
+        elif transaction["action"] == "undo":
+            count = min(transaction["payload"]["count"], len(effective))
+            del effective[len(effective) - count:]
+        else:
+            effective.append(i)
+    return effective
+
+
+def last_build(transactions, end=None):
+    """Position of the last "create_scope" transaction in transactions[:end], or -1 for the original build"""
+    builds = [i for i, transaction in enumerate(transactions[:end]) if transaction["action"] == "create_scope"]
+    return builds[-1] if builds else -1
+
+
+def read_scope_meta(scope_file):
+    with open(scope_file[:-len(".parquet")] + ".json") as f:
+        return json.load(f)
+
+
+def write_scope_meta(scope_file, scope_meta):
+    with open(scope_file[:-len(".parquet")] + ".json", "w") as f:
+        json.dump(scope_meta, f, indent=2)
+
+
+def apply_transaction(df, lookup, transaction):
+    """
+    Apply a transaction to the scope DataFrame and cluster lookup.
+    Returns the edited DataFrame and the clusters whose rows changed.
+    """
+    import numpy as np
+    from latentscope.util.scopes import apply_edits, touched_clusters
+    action = transaction["action"]
+    payload = transaction["payload"]
+    if action == "change_cluster":
+        edit = {"action": "change_cluster", "row_ids": payload["row_ids"], "cluster": payload["new_cluster"], "label": lookup[payload["new_cluster"]]["label"]}
+    elif action == "change_cluster_name":
+        lookup[payload["cluster"]]["label"] = payload["new_label"]
+        edit = {"action": "change_cluster_name", "cluster": payload["cluster"], "label": payload["new_label"]}
+    elif action == "delete_rows":
+        edit = {"action": "delete_rows", "row_ids": payload["row_ids"]}
+    elif action == "new_cluster":
+        if payload["cluster"] < len(lookup):
+            lookup[payload["cluster"]]["label"] = payload["label"]
+        else:
+            lookup.append({"cluster": payload["cluster"], "label": payload["label"], "hull": [], "description": ""})
+        return df, np.array([], dtype=np.int64)
+    else:
+        raise ValueError(f"Unknown scope transaction: {action}")
+    touched = touched_clusters(df, edit)
+    return apply_edits(df, [edit]), touched
+
+
+def checkpoint_scope(scope_file, auto=False):
+    """
+    Snapshot the current state of a scope so replays can start from here instead of from scratch.
+    auto marks checkpoints taken by the server rather than asked for, only those are pruned.
+    """
+    from latentscope.util.scopes import scope_lock, read_scope_table
+    import pyarrow.parquet as pq
+    with scope_lock(scope_file):
+        transactions = read_transactions(scope_file)
+        position = len(transactions)
+        directory = checkpoints_dir(scope_file)
+        os.makedirs(directory, exist_ok=True)
+        pq.write_table(read_scope_table(scope_file), os.path.join(directory, f"{position:06d}.parquet"))
+        with open(os.path.join(directory, f"{position:06d}.json"), "w") as f:
+            json.dump({
+                "transaction": position,
+                "build": last_build(transactions),
+                "effective": effective_transactions(transactions),
+                "cluster_labels_lookup": read_scope_meta(scope_file)["cluster_labels_lookup"],
+                "auto": auto,
+            }, f)
+    return position
+
+
+def list_checkpoints(scope_file):
+    """Transaction positions of a scope's checkpoints, oldest first"""
+    directory = checkpoints_dir(scope_file)
+    if not os.path.exists(directory):
+        return []
+    return sorted(int(f[:-len(".json")]) for f in os.listdir(directory) if f.endswith(".json"))
+
+
+def prune_checkpoints(scope_file, keep):
+    """Remove all but the latest keep automatic checkpoints, ones asked for are always kept"""
+    directory = checkpoints_dir(scope_file)
+    automatic = []
+    for position in list_checkpoints(scope_file):
+        with open(os.path.join(directory, f"{position:06d}.json")) as f:
+            if json.load(f).get("auto"):
+                automatic.append(position)
+    for position in automatic[:max(len(automatic) - keep, 0)]:
+        for ext in [".json", ".parquet"]:
+            os.remove(os.path.join(directory, f"{position:06d}{ext}"))
+
+
+def replay_scope(scope_file, end=None, transactions=None):
+    """
+    Rebuild a scope as it was after transactions[:end] (by default after the whole log).
+    We start from the latest checkpoint of the same build whose transactions in effect are still in effect at end,
+    or from the scope built from its source files, and apply the rest.
+    Returns the scope DataFrame and cluster labels lookup.
+    """
+    import numpy as np
+    import pyarrow.parquet as pq
+    from latentscope.util.scopes import build_scope_table
+    from latentscope.util.hulls import recalculate_hulls
+    if transactions is None:
+        transactions = read_transactions(scope_file)
+    end = len(transactions) if end is None else end
+    effective = effective_transactions(transactions, end)
+    build = last_build(transactions, end)
+    scope_meta = read_scope_meta(scope_file)
+
+    df = None
+    directory = checkpoints_dir(scope_file)
+    for name in reversed([f"{position:06d}.json" for position in list_checkpoints(scope_file)]):
+        with open(os.path.join(directory, name)) as f:
+            checkpoint = json.load(f)
+        if checkpoint["transaction"] <= end and checkpoint["build"] == build and effective[:len(checkpoint["effective"])] == checkpoint["effective"]:
+            df = pq.read_table(os.path.join(directory, name[:-len(".json")] + ".parquet")).to_pandas()
+            lookup = checkpoint["cluster_labels_lookup"]
+            tail = effective[len(checkpoint["effective"]):]
+            break
+    if df is None:
+        dataset_dir = os.path.dirname(os.path.dirname(scope_file))
+        table, lookup = build_scope_table(dataset_dir, scope_meta["umap_id"], scope_meta["cluster_id"], scope_meta["cluster_labels"]["id"])
+        df = table.to_pandas()
+        # clusters added in the app before new clusters were logged only exist in the scope metadata
+        logged = {t["payload"]["cluster"] for t in transactions if t["action"] == "new_cluster"}
+        lookup.extend(dict(c, hull=[]) for c in scope_meta["cluster_labels_lookup"][len(lookup):] if c["cluster"] not in logged)
+        tail = effective
+
+    touched = []
+    for i in tail:
+        df, changed = apply_transaction(df, lookup, transactions[i])
+        touched.append(changed)
+    if touched:
+        recalculate_hulls(df, lookup, scope_meta.get("cluster", {}).get("max_hull_vertices"), np.unique(np.concatenate(touched)))
+    return df, lookup
+
+
+def undo_scope(scope_file, count=1):
+    """
+    Take back the last count transactions in effect: the scope parquet and metadata are rewritten
+    with the replayed state and an "undo" transaction is logged. Returns the number of transactions undone.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    from latentscope.util.scopes import scope_lock, edits_file
+    with scope_lock(scope_file):
+        transactions = read_transactions(scope_file)
+        count = min(count, len(effective_transactions(transactions)))
+        if count == 0:
+            return 0
+        df, lookup = replay_scope(scope_file, transactions=transactions + [{"action": "undo", "payload": {"count": count}}])
+        pq.write_table(pa.Table.from_pandas(df, preserve_index=False), scope_file + ".tmp")
+        os.replace(scope_file + ".tmp", scope_file)
+        # the replayed state includes every pending edit
+        if os.path.exists(edits_file(scope_file)):
+            os.remove(edits_file(scope_file))
+        scope_meta = read_scope_meta(scope_file)
+        scope_meta["cluster_labels_lookup"] = lookup
+        scope_meta["rows"] = len(df)
+        write_scope_meta(scope_file, scope_meta)
+        append_transaction(scope_file, "undo", {"count": count})
+    return count
@@ -0,0 +1,497 @@
+"""
+Nearest neighbor search over the embeddings of a dataset.
+The cosine similarity of unit vectors is their dot product, so the embeddings are normalized once into a
+float32 matrix saved next to the .h5 (embeddings/<embedding>-normalized.npy), which searches memory-map
+instead of loading it, and a search is a matrix product of the normalized queries with blocks of rows.
+
+For large embeddings an approximate index can be built ahead of time (ls-embed-index) into embeddings/<embedding>-index/:
+an inverted file (IVFIndex) that only scores the rows of the partitions closest to the query, or binary codes
+(BinaryIndex) that take 1/32 of the memory and are re-ranked with the full vectors.
+"""
+import os
+import threading
+
+
+def normalized_file(embedding_file):
+    return embedding_file[:-len(".h5")] + "-normalized.npy"
+
+
+def normalize(vectors):
+    """Scale the rows of a float32 matrix to unit length, leaving zero rows as they are"""
+    import numpy as np
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+_normalized_locks = {}
+_normalized_locks_lock = threading.Lock()
+
+
+def write_normalized(embedding_file, block_size=100_000):
+    """
+    Write the normalized embeddings of an .h5 file to its -normalized.npy, block by block.
+    ls-embed does this when it writes the embeddings, so searches normally find the file already there.
+    """
+    import h5py
+    import numpy as np
+    path = normalized_file(embedding_file)
+    # a temporary file of our own, so concurrent writers (e.g. the server and a job) never share one
+    tmp = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+    with h5py.File(embedding_file, "r") as f:
+        embeddings = f["embeddings"]
+        out = np.lib.format.open_memmap(tmp, mode="w+", dtype=np.float32, shape=embeddings.shape)
+        for start in range(0, embeddings.shape[0], block_size):
+            out[start:start + block_size] = normalize(embeddings[start:start + block_size])
+        out.flush()
+        del out
+    os.replace(tmp, path)
+    return path
+
+
+def normalized_is_current(embedding_file):
+    path = normalized_file(embedding_file)
+    return os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(embedding_file)
+
+
+def read_normalized(embedding_file):
+    """Memory-map the normalized embeddings, writing them first if they are missing or older than the .h5"""
+    import numpy as np
+    if not normalized_is_current(embedding_file):
+        with _normalized_locks_lock:
+            lock = _normalized_locks.setdefault(os.path.abspath(embedding_file), threading.Lock())
+        with lock:
+            # another thread may have written it while we waited
+            if not normalized_is_current(embedding_file):
+                write_normalized(embedding_file)
+    return np.load(normalized_file(embedding_file), mmap_mode="r")
+
+
+def top_k(indices, scores, k):
+    """Keep the k highest scores of each row (and their indices), sorted by descending score"""
+    import numpy as np
+    if scores.shape[1] > k:
+        keep = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        indices = np.take_along_axis(indices, keep, axis=1)
+        scores = np.take_along_axis(scores, keep, axis=1)
+    order = np.argsort(-scores, axis=1, kind="stable")
+    return np.take_along_axis(indices, order, axis=1), np.take_along_axis(scores, order, axis=1)
+
+
+def to_distances(indices, scores, k):
+    """
+    (queries, k) arrays of indices and cosine distances from top_k output, with index -1 and distance inf
+    where there were fewer than k results (or the score was -inf, i.e. the row was masked out)
+    """
+    import numpy as np
+    padded = np.full((len(indices), k), -1, dtype=np.int64)
+    distances = np.full((len(indices), k), np.inf, dtype=np.float32)
+    found = min(k, indices.shape[1])
+    valid = np.isfinite(scores[:, :found])
+    padded[:, :found] = np.where(valid, indices[:, :found], -1)
+    distances[:, :found] = np.where(valid, 1 - scores[:, :found], np.inf)
+    return padded, distances
+
+
+def search_rows(vectors, rows, queries, k, block_size=65536):
+    """
+    Exact search of normalized queries among the given rows of vectors only, for searches restricted to
+    few enough rows that scoring just them is cheaper than scanning everything. Returns top_k output.
+    """
+    import numpy as np
+    results = []
+    for start in range(0, len(rows), block_size):
+        block = rows[start:start + block_size]
+        scores = queries @ np.asarray(vectors[block]).T
+        results.append(top_k(np.broadcast_to(block, scores.shape), scores, k))
+    if not results:
+        return np.zeros((len(queries), 0), dtype=np.int64), np.zeros((len(queries), 0), dtype=np.float32)
+    return top_k(np.concatenate([r[0] for r in results], axis=1), np.concatenate([r[1] for r in results], axis=1), k)
+
+
+def selective(mask, rows, block_size=65536):
+    """Whether a search mask allows so few rows that it's faster to score just them"""
+    return int(mask.sum()) <= max(block_size, rows // 16)
+
+
+class ExactIndex:
+    """
+    Exact cosine search over a (memory-mapped) matrix of normalized embeddings.
+    Rows are scored in blocks so only a block of scores per query is ever in memory, blocks are searched
+    on a thread pool (numpy releases the GIL in the matrix product) and the top k of every block are merged.
+    """
+    def __init__(self, vectors, block_size=65536, threads=None):
+        self.vectors = vectors
+        self.block_size = block_size
+        self.threads = threads or os.cpu_count()
+
+    @classmethod
+    def from_embedding(cls, embedding_file, **kwargs):
+        return cls(read_normalized(embedding_file), **kwargs)
+
+    def __len__(self):
+        return self.vectors.shape[0]
+
+    def search_block(self, queries, start, k, mask=None):
+        import numpy as np
+        scores = queries @ self.vectors[start:start + self.block_size].T
+        if mask is not None:
+            scores[:, ~mask[start:start + self.block_size]] = -np.inf
+        indices = np.broadcast_to(np.arange(start, start + scores.shape[1]), scores.shape)
+        return top_k(indices, scores, k)
+
+    def search(self, queries, k=150, mask=None):
+        """
+        Find the k nearest rows to each query (a vector or a matrix with one query per row),
+        only among the rows where the boolean mask is set if one is given.
+        Returns (indices, distances) arrays of shape (queries, k) sorted by cosine distance, like sklearn's kneighbors,
+        padded with index -1 and distance inf when there are fewer than k rows to return.
+        """
+        import numpy as np
+        from concurrent.futures import ThreadPoolExecutor
+        queries = normalize(np.atleast_2d(queries))
+        if mask is not None and selective(mask, len(self), self.block_size):
+            return to_distances(*search_rows(self.vectors, np.flatnonzero(mask), queries, k, self.block_size), k)
+        block_k = min(k, len(self))
+        if block_k == 0:
+            return to_distances(np.zeros((len(queries), 0), dtype=np.int64), np.zeros((len(queries), 0), dtype=np.float32), k)
+        starts = range(0, len(self), self.block_size)
+        if self.threads > 1 and len(starts) > 1:
+            with ThreadPoolExecutor(min(self.threads, len(starts))) as pool:
+                results = list(pool.map(lambda start: self.search_block(queries, start, block_k, mask), starts))
+        else:
+            results = [self.search_block(queries, start, block_k, mask) for start in starts]
+        indices, scores = top_k(np.concatenate([r[0] for r in results], axis=1), np.concatenate([r[1] for r in results], axis=1), block_k)
+        return to_distances(indices, scores, k)
+
+
+def index_dir(embedding_file):
+    return embedding_file[:-len(".h5")] + "-index"
+
+
+def read_index_meta(embedding_file):
+    """The metadata of the search index built for an embedding, or None if there is none or it's older than the embedding"""
+    import json
+    path = os.path.join(index_dir(embedding_file), "index.json")
+    if not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(embedding_file):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def spherical_kmeans(vectors, n_clusters, iterations=10, seed=42, block_size=65536):
+    """k-means on unit vectors by cosine similarity, returns the (normalized) centroids"""
+    import numpy as np
+    from scipy.sparse import csr_matrix
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), n_clusters, replace=False)]
+    for _ in range(iterations):
+        assignments = assign_nearest(vectors, centroids, block_size)
+        # the sum of the members of each cluster as a single sparse product
+        membership = csr_matrix((np.ones(len(vectors), dtype=np.float32), (assignments, np.arange(len(vectors)))), shape=(n_clusters, len(vectors)))
+        sums = np.asarray(membership @ vectors)
+        empty = np.asarray(membership.sum(axis=1)).ravel() == 0
+        # restart empty clusters from random points
+        sums[empty] = vectors[rng.choice(len(vectors), empty.sum(), replace=False)]
+        centroids = normalize(sums)
+    return centroids
+
+
+def assign_nearest(vectors, centroids, block_size=65536):
+    """Index of the most similar centroid for every vector, computed in blocks"""
+    import numpy as np
+    assignments = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), block_size):
+        assignments[start:start + block_size] = np.argmax(np.asarray(vectors[start:start + block_size]) @ centroids.T, axis=1)
+    return assignments
+
+
+class IVFIndex:
+    """
+    Approximate cosine search with an inverted file: the normalized vectors are partitioned by their nearest
+    k-means centroid and stored grouped by partition, so a query only scores the vectors of the nprobe
+    partitions whose centroids are closest to it.
+    Saved to embeddings/<embedding>-index/ and memory-mapped when loaded.
+    """
+    type = "ivf"
+    # the search parameter trading speed for recall, tuned when the index is built
+    parameter = "nprobe"
+
+    def __init__(self, centroids, offsets, ids, vectors, nprobe=16):
+        self.centroids = centroids
+        self.offsets = offsets
+        self.ids = ids
+        self.vectors = vectors
+        self.nprobe = nprobe
+
+    def __len__(self):
+        return len(self.ids)
+
+    def parameter_range(self, k):
+        return 1, len(self.centroids)
+
+    @classmethod
+    def build(cls, vectors, nlist=None, sample_size=None, iterations=10, seed=42, block_size=65536, directory=None):
+        """
+        Partition a matrix of normalized vectors, the partitions are trained on a sample of them.
+        With a directory the grouped vectors are written straight to its vectors.npy instead of being copied in memory.
+        """
+        import numpy as np
+        rng = np.random.default_rng(seed)
+        if nlist is None:
+            nlist = max(1, int(2 * np.sqrt(len(vectors))))
+        nlist = min(nlist, len(vectors))
+        sample_size = min(len(vectors), sample_size or max(64 * nlist, 10_000))
+        sample = np.asarray(vectors[np.sort(rng.choice(len(vectors), sample_size, replace=False))])
+        centroids = spherical_kmeans(sample, nlist, iterations, seed, block_size)
+        assignments = assign_nearest(vectors, centroids, block_size)
+        ids = np.argsort(assignments, kind="stable")
+        offsets = np.zeros(nlist + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignments, minlength=nlist), out=offsets[1:])
+        if directory is None:
+            grouped = np.empty(vectors.shape, dtype=np.float32)
+        else:
+            os.makedirs(directory, exist_ok=True)
+            grouped = np.lib.format.open_memmap(os.path.join(directory, "vectors.npy"), mode="w+", dtype=np.float32, shape=vectors.shape)
+        for start in range(0, len(ids), block_size):
+            grouped[start:start + block_size] = vectors[ids[start:start + block_size]]
+        return cls(centroids, offsets, ids, grouped)
+
+    def save(self, directory, meta):
+        import json
+        import numpy as np
+        os.makedirs(directory, exist_ok=True)
+        for name in ["centroids", "offsets", "ids", "vectors"]:
+            path = os.path.join(directory, name + ".npy")
+            array = getattr(self, name)
+            if isinstance(array, np.memmap) and array.filename == os.path.abspath(path):
+                # built in place
+                array.flush()
+                continue
+            np.save(path, array)
+        # written last, an index without its index.json is incomplete
+        with open(os.path.join(directory, "index.json"), "w") as f:
+            json.dump(dict(meta, type=self.type, nprobe=self.nprobe, nlist=len(self.centroids)), f, indent=2)
+
+    @classmethod
+    def load(cls, directory, meta, embedding_file=None):
+        import numpy as np
+        arrays = {name: np.load(os.path.join(directory, name + ".npy"), mmap_mode="r") for name in ["centroids", "offsets", "ids", "vectors"]}
+        return cls(np.asarray(arrays["centroids"]), np.asarray(arrays["offsets"]), arrays["ids"], arrays["vectors"], meta.get("nprobe", 16))
+
+    def positions(self, ids):
+        """Where the vectors of the given rows are stored (they are grouped by partition)"""
+        import numpy as np
+        if getattr(self, "_positions", None) is None:
+            self._positions = np.empty(len(self.ids), dtype=np.int64)
+            self._positions[self.ids] = np.arange(len(self.ids))
+        return self._positions[ids]
+
+    def search(self, queries, k=150, nprobe=None, mask=None):
+        """
+        Same as ExactIndex.search. A mask that leaves few rows is searched exactly, otherwise
+        more partitions are probed in proportion to the rows it filters out, so filtered searches still find k rows.
+        """
+        import numpy as np
+        queries = normalize(np.atleast_2d(queries))
+        nprobe = nprobe or self.nprobe
+        if mask is not None:
+            kept = max(int(mask.sum()), 1)
+            # probing nprobe·rows/kept partitions scores about nprobe/nlist·rows²/kept vectors, more than the kept rows
+            # themselves once kept/rows < sqrt(nprobe/nlist), so the growth of nprobe is bounded by sqrt(nlist/nprobe)
+            if selective(mask, len(self)) or kept ** 2 < nprobe / len(self.centroids) * len(self) ** 2:
+                positions = np.sort(self.positions(np.flatnonzero(mask)))
+                found, scores = search_rows(self.vectors, positions, queries, k)
+                return to_distances(self.ids[found], scores, k)
+            nprobe = int(np.ceil(nprobe * len(self) / kept))
+        nprobe = min(nprobe, len(self.centroids))
+        probes = np.argpartition(-(queries @ self.centroids.T), nprobe - 1, axis=1)[:, :nprobe]
+        indices = np.full((len(queries), k), -1, dtype=np.int64)
+        distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+        for q, query in enumerate(queries):
+            ranges = [(self.offsets[p], self.offsets[p + 1]) for p in np.sort(probes[q])]
+            positions = np.concatenate([np.arange(start, end) for start, end in ranges])
+            candidates = np.concatenate([self.vectors[start:end] for start, end in ranges])
+            if mask is not None:
+                keep = mask[self.ids[positions]]
+                positions, candidates = positions[keep], candidates[keep]
+            found, scores = top_k(positions[None, :], (candidates @ query)[None, :], k)
+            indices[q], distances[q] = [a[0] for a in to_distances(self.ids[found], scores, k)]
+        return indices, distances
+
+
+def popcount_rows(bits):
+    """Number of set bits in each row of a uint8 matrix"""
+    import numpy as np
+    if hasattr(np, "bitwise_count"):
+        # numpy >= 2.0, counted 8 bytes at a time when the rows allow it
+        if bits.shape[1] % 8 == 0:
+            bits = np.ascontiguousarray(bits).view(np.uint64)
+        return np.bitwise_count(bits).sum(axis=1, dtype=np.uint32)
+    table = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+    return table[bits].sum(axis=1, dtype=np.uint32)
+
+
+class BinaryIndex:
+    """
+    Compressed search with one bit per dimension: the sign of each component of the centered normalized vectors,
+    packed 8 to a byte, so 384 float32 dimensions take 48 bytes instead of 1536 and only these codes are kept in memory.
+    A query ranks every row by the Hamming distance between their codes (a popcount of their xor), and the
+    closest candidates are re-ranked by exact cosine similarity against the memory-mapped normalized matrix.
+    """
+    type = "binary"
+    parameter = "candidates"
+
+    def __init__(self, mean, codes, vectors, candidates=1500, block_size=1_000_000):
+        self.mean = mean
+        self.codes = codes
+        self.vectors = vectors
+        self.candidates = candidates
+        self.block_size = block_size
+
+    def __len__(self):
+        return len(self.codes)
+
+    def parameter_range(self, k):
+        return k, len(self)
+
+    def encode(self, vectors):
+        import numpy as np
+        return np.packbits(np.asarray(vectors) > self.mean, axis=1)
+
+    @classmethod
+    def build(cls, vectors, block_size=65536, directory=None):
+        import numpy as np
+        mean = np.zeros(vectors.shape[1], dtype=np.float64)
+        for start in range(0, len(vectors), block_size):
+            mean += np.asarray(vectors[start:start + block_size]).sum(axis=0)
+        index = cls((mean / max(len(vectors), 1)).astype(np.float32), None, vectors)
+        index.codes = np.concatenate([index.encode(vectors[start:start + block_size]) for start in range(0, len(vectors), block_size)]) \
+            if len(vectors) else np.zeros((0, (vectors.shape[1] + 7) // 8), dtype=np.uint8)
+        return index
+
+    def save(self, directory, meta):
+        import json
+        import numpy as np
+        os.makedirs(directory, exist_ok=True)
+        for name in ["mean", "codes"]:
+            np.save(os.path.join(directory, name + ".npy"), getattr(self, name))
+        with open(os.path.join(directory, "index.json"), "w") as f:
+            json.dump(dict(meta, type=self.type, candidates=self.candidates), f, indent=2)
+
+    @classmethod
+    def load(cls, directory, meta, embedding_file):
+        import numpy as np
+        # the codes are what we search, so they are read into memory, the full vectors are only paged in for re-ranking
+        return cls(np.load(os.path.join(directory, "mean.npy")), np.load(os.path.join(directory, "codes.npy")),
+            read_normalized(embedding_file), meta.get("candidates", 1500))
+
+    def search(self, queries, k=150, candidates=None, mask=None):
+        """Same as ExactIndex.search, a mask that leaves few rows is searched exactly"""
+        import numpy as np
+        queries = normalize(np.atleast_2d(queries))
+        if mask is not None and selective(mask, len(self)):
+            return to_distances(*search_rows(self.vectors, np.flatnonzero(mask), queries, k), k)
+        candidates = min(max(candidates or self.candidates, k), len(self))
+        indices = np.full((len(queries), k), -1, dtype=np.int64)
+        distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+        if candidates == 0:
+            return indices, distances
+        for q, code in enumerate(self.encode(queries)):
+            # the closest codes of each block, then of all blocks
+            nearest, hamming = [], []
+            for start in range(0, len(self), self.block_size):
+                block = popcount_rows(np.bitwise_xor(self.codes[start:start + self.block_size], code))
+                if mask is not None:
+                    # further than any code can be
+                    block[~mask[start:start + self.block_size]] = self.codes.shape[1] * 8 + 1
+                keep = np.argpartition(block, candidates - 1)[:candidates] if len(block) > candidates else np.arange(len(block))
+                nearest.append(keep + start)
+                hamming.append(block[keep])
+            nearest, hamming = np.concatenate(nearest), np.concatenate(hamming)
+            if len(nearest) > candidates:
+                nearest = nearest[np.argpartition(hamming, candidates - 1)[:candidates]]
+            if mask is not None:
+                nearest = nearest[mask[nearest]]
+            # re-rank with the full vectors, read in row order
+            nearest = np.sort(nearest)
+            found, scores = top_k(nearest[None, :], (np.asarray(self.vectors[nearest]) @ queries[q])[None, :], k)
+            indices[q], distances[q] = [a[0] for a in to_distances(found, scores, k)]
+        return indices, distances
+
+
+INDEX_TYPES = {"ivf": IVFIndex, "binary": BinaryIndex}
+
+
+def recall(index, exact, queries, k=150, **kwargs):
+    """Fraction of the exact k nearest neighbors of the queries (among the rows of the mask, if one is passed) that the index finds"""
+    import numpy as np
+    expected, _ = exact.search(queries, k, mask=kwargs.get("mask"))
+    found, _ = index.search(queries, k, **kwargs)
+    return float(np.mean([len(np.intersect1d(e[e >= 0], f)) / max(np.sum(e >= 0), 1) for e, f in zip(expected, found)]))
+
+
+def build_index(embedding_file, type="ivf", target_recall=0.95, k=150, queries=100, seed=42, **kwargs):
+    """
+    Build a search index of the given type for an embedding and save it next to it. The index's search parameter
+    (nprobe or candidates) is set to (about) the smallest value whose recall@k against exact search reaches
+    target_recall, with a sample of the embeddings as queries. kwargs are passed on to the index's build.
+    Returns the index metadata.
+    """
+    import time
+    import shutil
+    import numpy as np
+    if type not in INDEX_TYPES:
+        raise ValueError(f"Unknown index type {type}, expected one of {', '.join(INDEX_TYPES)}")
+    start = time.perf_counter()
+    vectors = read_normalized(embedding_file)
+    # built next to any index built before, which may be of another type, and swapped in once complete
+    building = index_dir(embedding_file) + ".building"
+    if os.path.exists(building):
+        shutil.rmtree(building)
+    index = INDEX_TYPES[type].build(vectors, directory=building, **{key: value for key, value in kwargs.items() if value is not None})
+    built = time.perf_counter() - start
+
+    exact = ExactIndex(vectors)
+    sample = np.asarray(vectors[np.sort(np.random.default_rng(seed + 1).choice(len(vectors), min(queries, len(vectors)), replace=False))])
+    recalls = {}
+    def measure(value):
+        recalls[value] = recall(index, exact, sample, k, **{index.parameter: value})
+        print(f"{index.parameter} {value}: recall@{k} {recalls[value]:.3f}", flush=True)
+        return recalls[value] >= target_recall
+    # double until the target is reached, then bisect between the last two tries
+    low, high = index.parameter_range(k)
+    value = low
+    while not measure(value) and value < high:
+        value = min(value * 2, high)
+    low = max(low, value // 2)
+    while value - low > 1 and value - low > value // 16:
+        middle = (low + value) // 2
+        if measure(middle):
+            value = middle
+        else:
+            low = middle
+    setattr(index, index.parameter, value)
+
+    meta = {
+        "rows": len(vectors),
+        "dimensions": vectors.shape[1],
+        "k": k,
+        "recall": recalls[value],
+        "recalls": {str(n): r for n, r in sorted(recalls.items())},
+        "build_seconds": built,
+    }
+    index.save(building, meta)
+    if os.path.exists(index_dir(embedding_file)):
+        shutil.rmtree(index_dir(embedding_file))
+    os.replace(building, index_dir(embedding_file))
+    return read_index_meta(embedding_file)
+
+
+def load_index(embedding_file, exact=False):
+    """The search index of an embedding: the index built for it if any (and exact isn't asked for), else exact search"""
+    meta = None if exact else read_index_meta(embedding_file)
+    if meta is not None and meta["type"] in INDEX_TYPES:
+        return INDEX_TYPES[meta["type"]].load(index_dir(embedding_file), meta, embedding_file)
+    return ExactIndex.from_embedding(embedding_file)
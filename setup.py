@@ -81,11 +81,13 @@ setup(
             'ls-serve=latentscope.server:start',
             'ls-init=latentscope:main',
             'ls-ingest=latentscope.scripts.ingest:main',
+            'ls-ingest-index=latentscope.scripts.ingest:index',
             'ls-list-models=latentscope:list_models',
             'ls-embed=latentscope.scripts.embed:main',
             'ls-embed-debug=latentscope.scripts.embed:debug',
             'ls-embed-truncate=latentscope.scripts.embed:truncate',
             'ls-embed-importer=latentscope.scripts.embed:importer',
+            'ls-embed-index=latentscope.scripts.embed:index',
             'ls-umap=latentscope.scripts.umapper:main',
             'ls-cluster=latentscope.scripts.cluster:main',
             'ls-label=latentscope.scripts.label_clusters:main',
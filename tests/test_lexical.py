@@ -0,0 +1,113 @@
+"""
+The BM25 index: rows appended to the input are indexed as new segments, segments get merged,
+and either way searches score the same as an index rebuilt from scratch.
+"""
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from latentscope.util import lexical
+from latentscope.util.lexical import LexicalIndex, build_index, tokenize, reciprocal_rank_fusion
+
+WORDS = ["cat", "dog", "fish", "bird", "tree", "rock", "cloud", "river", "stone", "leaf"]
+QUERIES = ["cat", "dog fish", "river stone leaf", "cat dog bird tree", "nothing"]
+
+
+def make_texts(rows, seed):
+    rng = np.random.default_rng(seed)
+    # a skewed vocabulary, so terms have very different document frequencies
+    p = 1 / np.arange(1, len(WORDS) + 1)
+    return [" ".join(rng.choice(WORDS, rng.integers(0, 12), p=p / p.sum())) for _ in range(rows)]
+
+
+@pytest.fixture
+def dataset_dir(tmp_path):
+    with open(tmp_path / "meta.json", "w") as f:
+        json.dump({"text_column": "text"}, f)
+    return str(tmp_path)
+
+
+def write_input(dataset_dir, texts):
+    pd.DataFrame({"text": texts}).to_parquet(f"{dataset_dir}/input.parquet")
+
+
+def results(dataset_dir, mask=None):
+    index = LexicalIndex.load(dataset_dir)
+    return {query: index.scores(query, mask) for query in QUERIES}
+
+
+def assert_same_results(left, right):
+    for query in QUERIES:
+        np.testing.assert_array_equal(left[query][0], right[query][0])
+        np.testing.assert_allclose(left[query][1], right[query][1], rtol=1e-5)
+
+
+def test_tokenize():
+    assert tokenize("The cat's 2 Dogs!") == ["the", "cat", "s", "2", "dogs"]
+    assert tokenize(None) == tokenize(float("nan")) == []
+
+
+def test_appended_rows_score_like_a_rebuild(dataset_dir):
+    texts = make_texts(500, 0)
+    write_input(dataset_dir, texts[:300])
+    assert build_index(dataset_dir)["added"] == 300
+    write_input(dataset_dir, texts[:420])
+    assert build_index(dataset_dir)["added"] == 120
+    write_input(dataset_dir, texts)
+    meta = build_index(dataset_dir)
+    assert meta["added"] == 80
+    assert [(s["start"], s["rows"]) for s in meta["segments"]] == [(0, 300), (300, 120), (420, 80)]
+    assert build_index(dataset_dir)["added"] == 0
+    incremental = results(dataset_dir)
+
+    assert len(build_index(dataset_dir, rebuild=True)["segments"]) == 1
+    assert_same_results(incremental, results(dataset_dir))
+
+
+def test_merged_segments_score_like_a_rebuild(dataset_dir, monkeypatch):
+    monkeypatch.setattr(lexical, "MAX_SEGMENTS", 2)
+    texts = make_texts(400, 1)
+    for rows in [100, 150, 290, 400]:
+        write_input(dataset_dir, texts[:rows])
+        meta = build_index(dataset_dir)
+        assert len(meta["segments"]) <= 2
+    # the third segment triggered a merge, the fourth was added after it
+    assert [(s["start"], s["rows"]) for s in meta["segments"]] == [(0, 290), (290, 110)]
+    merged = results(dataset_dir)
+
+    build_index(dataset_dir, rebuild=True)
+    assert_same_results(merged, results(dataset_dir))
+
+
+def test_bm25_scores(dataset_dir):
+    write_input(dataset_dir, ["cat cat dog", "dog", "cat fish fish fish", ""])
+    build_index(dataset_dir)
+    index = LexicalIndex.load(dataset_dir)
+    rows, scores = index.scores("cat")
+    # two of four rows have cat, the average row has 2 tokens
+    idf = np.log(1 + (4 - 2 + 0.5) / (2 + 0.5))
+    expected = [idf * tf * 2.2 / (tf + 1.2 * (0.25 + 0.75 * length / 2)) for tf, length in [(2, 3), (1, 4)]]
+    np.testing.assert_array_equal(rows, [0, 2])
+    np.testing.assert_allclose(scores, expected, rtol=1e-5)
+
+
+def test_masked_search(dataset_dir):
+    write_input(dataset_dir, make_texts(300, 2))
+    build_index(dataset_dir)
+    index = LexicalIndex.load(dataset_dir)
+    mask = np.zeros(300, dtype=bool)
+    mask[::3] = True
+    rows, scores = index.search("cat dog", k=10, mask=mask)
+    assert len(rows) == 10 and mask[rows].all()
+    assert (np.diff(scores) <= 0).all()
+    all_rows, all_scores = index.scores("cat dog")
+    assert np.allclose(scores, np.sort(all_scores[mask[all_rows]])[::-1][:10])
+
+
+def test_reciprocal_rank_fusion():
+    rows, scores = reciprocal_rank_fusion([[3, 1, 2], [1, 4]], k=3)
+    # 1 is ranked by both, then 3 (ranked first once) and 4 (second once) come ahead of 2 (third once)
+    assert rows.tolist() == [1, 3, 4]
+    np.testing.assert_allclose(scores, [1 / 62 + 1 / 61, 1 / 61, 1 / 62])
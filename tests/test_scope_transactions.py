@@ -0,0 +1,164 @@
+"""
+Invariants of the scope edit overlay, transaction log, checkpoints and undo:
+undoing edits restores the scope parquet and cluster lookup, checkpoints don't change what a replay produces
+and compaction doesn't change what readers see.
+"""
+import os
+import json
+import threading
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+import pytest
+from flask import Flask
+
+from latentscope.server import bulk
+from latentscope.util import scopes
+from latentscope.util.hulls import recalculate_hulls
+from latentscope.util.scopes import build_scope_table, read_scope, read_scope_table, compact_scope, edits_file
+from latentscope.util.transactions import replay_scope, undo_scope, checkpoint_scope, checkpoints_dir, list_checkpoints, read_scope_meta
+
+ROWS = 300
+CLUSTERS = 4
+
+
+@pytest.fixture
+def scope_file(tmp_path, monkeypatch):
+    """A small dataset with a scope built from a umap, clusters and labels, like ls-scope writes it"""
+    rng = np.random.default_rng(0)
+    dataset_dir = tmp_path / "dataset"
+    for sub in ["umaps", "clusters", "scopes"]:
+        (dataset_dir / sub).mkdir(parents=True)
+    cluster = rng.integers(0, CLUSTERS, ROWS)
+    pd.DataFrame({"x": rng.random(ROWS), "y": rng.random(ROWS)}).to_parquet(dataset_dir / "umaps" / "umap-001.parquet")
+    pd.DataFrame({"cluster": cluster, "raw_cluster": cluster}).to_parquet(dataset_dir / "clusters" / "cluster-001.parquet")
+    labels = pd.DataFrame({
+        "label": [f"cluster {c}" for c in range(CLUSTERS)],
+        "description": [""] * CLUSTERS,
+        "hull": [np.array([], dtype=np.int64)] * CLUSTERS,
+    })
+    labels.to_parquet(dataset_dir / "clusters" / "cluster-001-labels-default.parquet")
+    # cluster labels files come with the hulls of their clusters
+    table, lookup = build_scope_table(str(dataset_dir), "umap-001", "cluster-001", "cluster-001-labels-default")
+    recalculate_hulls(table.to_pandas(), lookup)
+    labels["hull"] = [np.array(c["hull"], dtype=np.int64) for c in lookup]
+    labels.to_parquet(dataset_dir / "clusters" / "cluster-001-labels-default.parquet")
+    table, lookup = build_scope_table(str(dataset_dir), "umap-001", "cluster-001", "cluster-001-labels-default")
+    path = str(dataset_dir / "scopes" / "scopes-001.parquet")
+    pq.write_table(table, path)
+    with open(path[:-len(".parquet")] + ".json", "w") as f:
+        json.dump({
+            "id": "scopes-001",
+            "umap_id": "umap-001",
+            "cluster_id": "cluster-001",
+            "cluster_labels": {"id": "cluster-001-labels-default"},
+            "cluster_labels_lookup": lookup,
+            "rows": ROWS,
+        }, f)
+
+    monkeypatch.setattr(bulk, "DATA_DIR", str(tmp_path))
+    # every test starts without a cached scope state
+    monkeypatch.setattr(scopes, "_states", {})
+    return path
+
+
+@pytest.fixture
+def client():
+    app = Flask(__name__)
+    app.register_blueprint(bulk.bulk_write_bp, url_prefix="/api/bulk")
+    return app.test_client()
+
+
+def scope_args(**kwargs):
+    return dict(dataset_id="dataset", scope_id="scopes-001", **kwargs)
+
+
+def make_edits(client):
+    assert client.post("/api/bulk/change-cluster", json=scope_args(row_ids=[1, 2, 3, 50], new_cluster=2)).status_code == 200
+    assert client.post("/api/bulk/delete-rows", json=scope_args(row_ids=[4, 5, 200])).status_code == 200
+    assert client.get("/api/bulk/change-cluster-name", query_string=scope_args(cluster=1, new_label="renamed")).status_code == 200
+    assert client.post("/api/bulk/change-cluster", json=scope_args(row_ids=[10, 11, 4], new_cluster=0)).status_code == 200
+
+
+def wait_for_background_work():
+    for thread in threading.enumerate():
+        if thread is not threading.current_thread() and not thread.daemon:
+            thread.join()
+
+
+def assert_lookups_equal(left, right):
+    assert [(c["cluster"], c["label"], list(c["hull"])) for c in left] == [(c["cluster"], c["label"], list(c["hull"])) for c in right]
+
+
+def test_undo_restores_the_scope(scope_file, client):
+    before = pq.read_table(scope_file).to_pandas()
+    lookup = read_scope_meta(scope_file)["cluster_labels_lookup"]
+
+    make_edits(client)
+    assert len(read_scope(scope_file)) == ROWS - 3
+
+    response = client.get("/api/bulk/undo", query_string=scope_args(count=4))
+    assert response.json["undone"] == 4
+    # undo writes the replayed state to the parquet itself and drops the overlay
+    assert not os.path.exists(edits_file(scope_file))
+    pd.testing.assert_frame_equal(pq.read_table(scope_file).to_pandas(), before)
+    assert_lookups_equal(read_scope_meta(scope_file)["cluster_labels_lookup"], lookup)
+    assert read_scope_meta(scope_file)["rows"] == ROWS
+
+
+def test_undo_takes_back_only_the_last_edits(scope_file, client):
+    make_edits(client)
+    undo_scope(scope_file, 2)
+    df = read_scope(scope_file)
+    assert len(df) == ROWS - 3
+    assert (df.loc[df["ls_index"].isin([1, 2, 3, 50]), "cluster"] == 2).all()
+    # the rename of cluster 1 was undone
+    assert "renamed" not in set(df["label"])
+    assert "renamed" not in [c["label"] for c in read_scope_meta(scope_file)["cluster_labels_lookup"]]
+
+
+def test_checkpoints_dont_change_replays(scope_file, client):
+    make_edits(client)
+    position = checkpoint_scope(scope_file)
+    assert position == 4
+    assert client.post("/api/bulk/delete-rows", json=scope_args(row_ids=[7, 8])).status_code == 200
+
+    df, lookup = replay_scope(scope_file)
+    # the same replay without the checkpoint, from the scope's source files
+    for f in os.listdir(checkpoints_dir(scope_file)):
+        os.remove(os.path.join(checkpoints_dir(scope_file), f))
+    expected_df, expected_lookup = replay_scope(scope_file)
+    pd.testing.assert_frame_equal(df, expected_df)
+    assert_lookups_equal(lookup, expected_lookup)
+    pd.testing.assert_frame_equal(df, read_scope(scope_file))
+
+
+def test_edits_are_checkpointed_automatically(scope_file, client, monkeypatch):
+    monkeypatch.setattr(bulk, "COMPACT_AFTER_EDITS", 2)
+    monkeypatch.setattr(bulk, "CHECKPOINT_AFTER_TRANSACTIONS", 2)
+    monkeypatch.setattr(bulk, "KEEP_CHECKPOINTS", 1)
+    make_edits(client)
+    wait_for_background_work()
+    # only the latest automatic checkpoint is kept (the background compactions may run after the next edit)
+    assert len(list_checkpoints(scope_file)) == 1
+    assert list_checkpoints(scope_file)[0] in (3, 4)
+    expected = read_scope(scope_file)
+    assert client.post("/api/bulk/delete-rows", json=scope_args(row_ids=[20, 21])).status_code == 200
+    undo_scope(scope_file, 1)
+    pd.testing.assert_frame_equal(pq.read_table(scope_file).to_pandas(), expected)
+
+
+def test_compaction_leaves_the_scope_unchanged(scope_file, client):
+    make_edits(client)
+    from_state = read_scope_table(scope_file)
+    # without the cached state the overlay is applied to the parquet as it is read
+    scopes._states.clear()
+    from_overlay = read_scope_table(scope_file)
+    assert from_overlay.equals(from_state)
+
+    assert compact_scope(scope_file)
+    assert not os.path.exists(edits_file(scope_file))
+    scopes._states.clear()
+    assert read_scope_table(scope_file).equals(from_state)
+    assert pq.read_table(scope_file).equals(from_state)
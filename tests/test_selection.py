@@ -0,0 +1,77 @@
+"""
+Parsing and evaluating selection expressions: precedence, quoting, NOT relative to the selectable rows
+and the errors malformed expressions raise.
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from latentscope.util.selection import SelectionError, parse, parse_filter, evaluate, filter_mask
+
+ROWS = 20
+TAGS = {"a": [0, 1, 2, 3, 10], "to review": [3, 4, 5]}
+CLUSTERS = np.arange(ROWS) % 4
+
+
+def resolve(kind, argument):
+    bitmap = np.zeros(ROWS, dtype=bool)
+    if kind == "tag":
+        bitmap[TAGS[argument]] = True
+    elif kind == "cluster":
+        bitmap = CLUSTERS == int(argument)
+    return bitmap
+
+
+def select(expression, universe=None):
+    universe = np.ones(ROWS, dtype=bool) if universe is None else universe
+    return np.flatnonzero(evaluate(parse(expression), resolve, universe)).tolist()
+
+
+def test_precedence():
+    assert parse("tag:a OR tag:b AND NOT cluster:3") == \
+        ("or", [("term", "tag", "a"), ("and", [("term", "tag", "b"), ("not", ("term", "cluster", "3"))])])
+    assert parse("(tag:a or tag:b) and cluster:3") == \
+        ("and", [("or", [("term", "tag", "a"), ("term", "tag", "b")]), ("term", "cluster", "3")])
+
+
+def test_quoted_terms_and_functions():
+    assert parse('tag:"to review" and not filter("my col" contains "x)")') == \
+        ("and", [("term", "tag", "to review"), ("not", ("term", "filter", '"my col" contains "x)"'))])
+    assert parse_filter('"my col" contains "x)"') == ("my col", "contains", "x)")
+    assert parse_filter("score >= 0.5") == ("score", "gte", 0.5)
+    assert parse_filter("label in [\"a\", \"b\"]") == ("label", "in", ["a", "b"])
+    assert parse_filter("label eq cats") == ("label", "eq", "cats")
+
+
+def test_evaluate():
+    cluster_3 = np.flatnonzero(CLUSTERS == 3).tolist()
+    expected = sorted(set(range(ROWS)) - set(TAGS["a"]) - set(cluster_3))
+    assert select("NOT (tag:a OR cluster:3)") == expected
+    assert select('tag:a AND NOT tag:"to review"') == [0, 1, 2, 10]
+    assert select("cluster:2 or tag:a and cluster:1") == sorted(set(np.flatnonzero(CLUSTERS == 2)) | {1})
+
+
+def test_not_is_relative_to_the_universe():
+    # e.g. the rows left in a scope after some were deleted
+    universe = np.ones(ROWS, dtype=bool)
+    universe[[5, 6, 7, 10]] = False
+    assert select("NOT tag:a", universe) == [i for i in range(ROWS) if i not in TAGS["a"] and universe[i]]
+    assert select("tag:a", universe) == [0, 1, 2, 3]
+
+
+def test_filter_mask():
+    values = pd.Series(["cat", "dog", None, "catalog"])
+    assert filter_mask(values, "contains", "cat").tolist() == [True, False, False, True]
+    assert filter_mask(pd.Series([1.0, None, 3.0]), "gt", 1).tolist() == [False, False, True]
+
+
+@pytest.mark.parametrize("expression", ["", "tag:a AND", "((tag:a)", "tag:a tag:b", "cluster:", "foo", "filter(score > 1", 'tag:"a'])
+def test_malformed_expressions(expression):
+    with pytest.raises(SelectionError):
+        parse(expression)
+
+
+@pytest.mark.parametrize("argument", ["score ~ 3", "score >", ">= 3"])
+def test_malformed_filters(argument):
+    with pytest.raises(SelectionError):
+        parse_filter(argument)
@@ -0,0 +1,76 @@
+"""
+Tags as sorted arrays with an append-only delta: adds and removals (~i records) replay in order,
+compaction folds the delta into the .npy without changing the tag and legacy .indices files are converted.
+"""
+import os
+
+import numpy as np
+import pytest
+
+from latentscope.util import tags
+from latentscope.util.tags import TagSet, create_tag, read_tag, update_tag, read_delta, delta_file, tag_file, legacy_tag_file
+
+
+@pytest.fixture
+def tagdir(tmp_path):
+    create_tag(str(tmp_path), "t")
+    return str(tmp_path)
+
+
+def test_tagset_operations():
+    a = TagSet([5, 1, 3, 3])
+    assert a.tolist() == [1, 3, 5]
+    assert a.add([2, 3, 7]).tolist() == [2, 7]
+    assert a.remove([1, 4]).tolist() == [1]
+    assert a.tolist() == [2, 3, 5, 7]
+    assert a.contains([0, 2, 7, 8]).tolist() == [False, True, True, False]
+    assert 5 in a and 4 not in a
+    b = TagSet([3, 4, 7])
+    assert (a & b).tolist() == [3, 7]
+    assert (a | b).tolist() == [2, 3, 4, 5, 7]
+    assert (a - b).tolist() == [2, 5]
+    assert TagSet().contains([1]).tolist() == [False]
+
+
+def test_delta_records_removals(tagdir):
+    tagset = read_tag(tagdir, "t")
+    update_tag(tagdir, "t", tagset, add=[1, 2, 3])
+    update_tag(tagdir, "t", tagset, remove=[2, 0])
+    update_tag(tagdir, "t", tagset, add=[2, 0])
+    update_tag(tagdir, "t", tagset, remove=[0])
+    values, removed = read_delta(delta_file(tagdir, "t"))
+    # only what changed is recorded, removals as ~i
+    assert values.tolist() == [1, 2, 3, 2, 0, 2, 0]
+    assert removed.tolist() == [False, False, False, True, False, False, True]
+    assert np.fromfile(delta_file(tagdir, "t"), dtype="<i8")[3] == ~2
+    # the .npy is untouched, the tag is the .npy with the delta replayed in order
+    assert np.load(tag_file(tagdir, "t")).tolist() == []
+    assert read_tag(tagdir, "t").tolist() == [1, 2, 3] == tagset.tolist()
+
+
+def test_torn_delta_record_is_ignored(tagdir):
+    update_tag(tagdir, "t", read_tag(tagdir, "t"), add=[4, 6])
+    with open(delta_file(tagdir, "t"), "ab") as f:
+        f.write(b"\x01\x02\x03")
+    assert read_tag(tagdir, "t").tolist() == [4, 6]
+
+
+def test_compaction(tagdir, monkeypatch):
+    monkeypatch.setattr(tags, "COMPACT_MIN_RECORDS", 4)
+    tagset = read_tag(tagdir, "t")
+    update_tag(tagdir, "t", tagset, add=[1, 2, 3])
+    update_tag(tagdir, "t", tagset, remove=[2])
+    assert os.path.exists(delta_file(tagdir, "t"))
+    # a fifth record is more than COMPACT_MIN_RECORDS and than the tag has rows
+    update_tag(tagdir, "t", tagset, add=[9])
+    assert not os.path.exists(delta_file(tagdir, "t"))
+    assert np.load(tag_file(tagdir, "t")).tolist() == [1, 3, 9]
+    assert read_tag(tagdir, "t").tolist() == [1, 3, 9]
+
+
+def test_legacy_tags_are_converted(tagdir):
+    with open(legacy_tag_file(tagdir, "old"), "w") as f:
+        f.write("5\n2\n5\n")
+    assert read_tag(tagdir, "old").tolist() == [2, 5]
+    assert not os.path.exists(legacy_tag_file(tagdir, "old"))
+    assert np.load(tag_file(tagdir, "old")).tolist() == [2, 5]
@@ -0,0 +1,77 @@
+"""
+Masked top-k search with the exact, IVF and binary indexes: only rows of the mask are returned,
+padded with index -1 and distance inf when the mask has fewer than k rows.
+"""
+import numpy as np
+import pytest
+
+from latentscope.util.vectors import ExactIndex, IVFIndex, BinaryIndex, normalize
+
+# more rows than a search block, so large masks take the filtered path of each index rather than the exhaustive one
+ROWS = 80_000
+DIMENSIONS = 8
+K = 20
+
+
+@pytest.fixture(scope="module")
+def vectors():
+    rng = np.random.default_rng(0)
+    return normalize(rng.standard_normal((ROWS, DIMENSIONS)).astype(np.float32))
+
+
+@pytest.fixture(scope="module")
+def queries():
+    return np.random.default_rng(1).standard_normal((3, DIMENSIONS)).astype(np.float32)
+
+
+@pytest.fixture(scope="module", params=["exact", "ivf", "binary"])
+def index(request, vectors):
+    if request.param == "exact":
+        return ExactIndex(vectors, block_size=4096)
+    if request.param == "ivf":
+        index = IVFIndex.build(vectors, nlist=64)
+        index.nprobe = 8
+        return index
+    index = BinaryIndex.build(vectors)
+    index.candidates = 2000
+    return index
+
+
+def expected_neighbors(vectors, queries, mask, k):
+    scores = normalize(queries) @ vectors.T
+    scores[:, ~mask] = -np.inf
+    return np.argsort(-scores, axis=1, kind="stable")[:, :k]
+
+
+def test_few_rows_are_searched_exactly(index, vectors, queries):
+    mask = np.zeros(ROWS, dtype=bool)
+    mask[np.random.default_rng(2).choice(ROWS, 500, replace=False)] = True
+    indices, distances = index.search(queries, K, mask=mask)
+    assert indices.shape == distances.shape == (len(queries), K)
+    for found, expected in zip(indices, expected_neighbors(vectors, queries, mask, K)):
+        assert set(found.tolist()) == set(expected.tolist())
+    assert (np.diff(distances, axis=1) >= 0).all()
+
+
+def test_large_masks_only_return_their_rows(index, vectors, queries):
+    mask = np.random.default_rng(3).random(ROWS) < 0.9
+    indices, distances = index.search(queries, K, mask=mask)
+    assert (indices >= 0).all()
+    assert mask[indices].all()
+    assert np.isfinite(distances).all()
+    if isinstance(index, ExactIndex):
+        for found, expected in zip(indices, expected_neighbors(vectors, queries, mask, K)):
+            assert set(found.tolist()) == set(expected.tolist())
+
+
+def test_results_are_padded(index, queries):
+    rows = [7, 70, 7000, 70_000]
+    mask = np.zeros(ROWS, dtype=bool)
+    mask[rows] = True
+    indices, distances = index.search(queries, K, mask=mask)
+    assert (np.sort(indices[:, :len(rows)], axis=1) == rows).all()
+    assert (indices[:, len(rows):] == -1).all()
+    assert np.isinf(distances[:, len(rows):]).all()
+
+    indices, distances = index.search(queries, K, mask=np.zeros(ROWS, dtype=bool))
+    assert (indices == -1).all() and np.isinf(distances).all()